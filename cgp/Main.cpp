@@ -394,7 +394,8 @@ int main(int argc, const char** args) {
 	//assert(("should not abort", false));
 	// Asserts floating point compatibility at compile time
 	static_assert(std::numeric_limits<float>::is_iec559, "IEEE 754 required");
-	srand(time(NULL));
+	// processes started within the same second, e.g. fan-out workers, must not share the random sequence
+	srand(static_cast<unsigned int>(time(NULL)) ^ std::random_device{}());
 	std::vector<std::string> arguments(args + 1, args + argc);
 
 	std::cout << "... INIT CONFIGURATION CHECK ..." << std::endl;
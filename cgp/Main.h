@@ -20,6 +20,7 @@
 #include <functional>
 #include <unordered_map>
 #include <csignal>
+#include <random>
 #include "StringTemplate.h"
 #include "CGPStream.h"
 #include "Cgp.h"
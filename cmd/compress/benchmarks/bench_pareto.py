@@ -0,0 +1,139 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# bench_pareto.py: Benchmark of cgp.pareto against the quadratic notebook_utils implementation.
+
+import argparse
+import time
+from typing import Callable, List
+import numpy as np
+import pandas as pd
+from cgp.pareto import get_non_dominated, get_pareto_ranks, ParetoArchive
+from notebook_utils import is_pareto_efficient_simple
+
+def create_costs(points: int, objectives: int, distribution: str, seed: int = 42) -> np.ndarray:
+    """
+    Creates random costs without duplicates, so both implementations must agree.
+
+    Args:
+        points (int): Number of points.
+        objectives (int): Number of objectives.
+        distribution (str): "uniform" for mostly dominated points, "front" for points near a single front.
+        seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+        np.ndarray: An (points, objectives) array.
+    """
+    generator = np.random.default_rng(seed)
+    costs = generator.random((points, objectives))
+    if distribution == "front":
+        costs = costs / costs.sum(axis=1, keepdims=True) + generator.random((points, objectives)) * 1e-3
+    return costs
+
+def measure(function: Callable, *args, repeat: int = 1) -> float:
+    """
+    Measures the best wall time of the function.
+
+    Args:
+        function (Callable): The measured function.
+        *args: Arguments of the function.
+        repeat (int, optional): Number of measurements. Defaults to 1.
+
+    Returns:
+        float: The best time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def insert_chunks(df: pd.DataFrame, chunk_size: int = 100000) -> ParetoArchive:
+    """
+    Inserts the costs into an archive chunk by chunk as a streaming statistics reader would.
+
+    Args:
+        df (pd.DataFrame): The costs.
+        chunk_size (int, optional): Number of rows inserted at once. Defaults to 100000.
+
+    Returns:
+        ParetoArchive: The archive.
+    """
+    archive = ParetoArchive(list(df.columns))
+    for start in range(0, len(df.index), chunk_size):
+        archive.insert(df.iloc[start:start+chunk_size])
+    return archive
+
+def run_benchmark(sizes: List[int], objectives: List[int], distributions: List[str], reference_limit: int, repeat: int = 1) -> pd.DataFrame:
+    """
+    Runs the benchmark and checks that the fast implementation matches the reference.
+
+    Args:
+        sizes (List[int]): Numbers of points.
+        objectives (List[int]): Numbers of objectives.
+        distributions (List[str]): Cost distributions.
+        reference_limit (int): Maximum number of points evaluated by the quadratic reference.
+        repeat (int, optional): Number of measurements. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: Timings of the reference, the non-dominated filter, ranking and the archive.
+
+    Raises:
+        ValueError: If the results differ from the reference.
+    """
+    rows = []
+    for distribution in distributions:
+        for objective_count in objectives:
+            for size in sizes:
+                costs = create_costs(size, objective_count, distribution)
+                efficient = get_non_dominated(costs)
+                reference_time = None
+                if size <= reference_limit:
+                    if not np.array_equal(is_pareto_efficient_simple(costs), efficient):
+                        raise ValueError(f"results differ for {size} points with {objective_count} objectives")
+                    reference_time = measure(is_pareto_efficient_simple, costs, repeat=repeat)
+                columns = [f"f{i}" for i in range(objective_count)]
+                df = pd.DataFrame(costs, columns=columns)
+                if len(insert_chunks(df)) != efficient.sum():
+                    raise ValueError(f"archive differs for {size} points with {objective_count} objectives")
+                rows.append({
+                    "distribution": distribution,
+                    "objectives": objective_count,
+                    "points": size,
+                    "front": int(efficient.sum()),
+                    "reference": reference_time,
+                    "non_dominated": measure(get_non_dominated, costs, repeat=repeat),
+                    "ranks": measure(get_pareto_ranks, costs, repeat=repeat) if size <= reference_limit else None,
+                    "archive": measure(insert_chunks, df, repeat=repeat)
+                })
+                print(rows[-1])
+    df = pd.DataFrame(rows)
+    df["speedup"] = df["reference"] / df["non_dominated"]
+    return df
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Pareto front computation")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000, 1000000], help="Numbers of points")
+    parser.add_argument("--objectives", nargs="+", type=int, default=[2, 3, 4, 5], help="Numbers of objectives")
+    parser.add_argument("--distributions", nargs="+", default=["uniform", "front"], choices=["uniform", "front"], help="Cost distributions")
+    parser.add_argument("--reference-limit", type=int, default=20000, help="Largest input evaluated by the quadratic reference")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of measurements")
+    parser.add_argument("--output", default=None, help="CSV file to store the results")
+    args = parser.parse_args()
+    df = run_benchmark(args.sizes, args.objectives, args.distributions, args.reference_limit, repeat=args.repeat)
+    print(df.to_string(index=False))
+    if args.output:
+        df.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# bench_pipeline.py: Offline benchmark of the experiment pipeline hot paths on synthetic models and data.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+import torch
+from cgp.cgp_adapter import CGP
+from cgp.cgp_configuration import CGPConfiguration
+from cgp.cgp_statistics import STATISTICS_COLUMNS
+from cgp.pareto import get_statistics_front
+from experiments.composite.experiment import MultiExperiment
+from experiments.experiment import Experiment
+from models.adapters.model_adapter import ModelAdapter
+from models.selector import FilterSelector, FilterSelectorCombination, FilterSelectorCombinations
+from models.tensor_dataset import InMemoryDataset
+
+suites = ["lenet", "mobilenet", "common"]
+
+def measure(function: Callable, repeat: int = 3, number: int = 1) -> dict:
+    """
+    Measures wall time of the function.
+
+    Args:
+        function (Callable): The measured function without arguments.
+        repeat (int, optional): Number of measurements. Defaults to 3.
+        number (int, optional): Number of calls per measurement. Defaults to 1.
+
+    Returns:
+        dict: The best and mean time of one call in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {"best": min(times), "mean": sum(times) / len(times), "repeat": repeat, "number": number}
+
+def create_lenet_adapter(directory: Path, seed: int = 42) -> ModelAdapter:
+    """
+    Creates LeNet-5 quantised by PTQ with random weights calibrated on random images.
+
+    Args:
+        directory (Path): Directory where the state dictionary is saved, clones of the adapter load it.
+        seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+        ModelAdapter: The LeNet-5 adapter.
+    """
+    from models.adapters.base import LeNet5Adapater
+    from models.ptq_quantized_lenet import PTQQuantizedLeNet5
+    torch.manual_seed(seed)
+    model = PTQQuantizedLeNet5(str(directory / "lenet.state_dict.pth"))
+    model.eval()
+    model._prepare()
+    with torch.inference_mode():
+        model(torch.randn(256, 1, 28, 28))
+    model._convert()
+    model.save()
+    return LeNet5Adapater(model)
+
+def create_mobilenet_adapter(directory: Path, seed: int = 42) -> ModelAdapter:
+    """
+    Creates quantised MobileNetV2 with random weights, the pretrained weights are not downloaded.
+
+    Args:
+        directory (Path): Directory where the state dictionary is saved, clones of the adapter load it.
+        seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+        ModelAdapter: The MobileNetV2 adapter.
+    """
+    import torchvision.models.quantization as quantization_models
+    from models.adapters.mobilenet_adapter import MobileNetV2Adapter
+    torch.manual_seed(seed)
+    model = quantization_models.mobilenet_v2(weights=None, quantize=True, backend="qnnpack")
+    path = directory / "mobilenet_v2.state_dict.pth"
+    torch.save(model.state_dict(), path)
+    return MobileNetV2Adapter(str(path))
+
+def create_dataset(shape: List[int], classes: int, images: int, seed: int = 42) -> InMemoryDataset:
+    """
+    Creates random normalised images with random labels.
+
+    Args:
+        shape (List[int]): Shape of a single image.
+        classes (int): Number of classes.
+        images (int): Number of images.
+        seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+        InMemoryDataset: The dataset.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    return InMemoryDataset(torch.randn(images, *shape, generator=generator), torch.randint(0, classes, (images, ), generator=generator))
+
+def create_experiment(directory: Path, adapter: ModelAdapter, layer_name: str, dataset_size: int = 1) -> Experiment:
+    """
+    Creates an experiment approximating all weights of the layer from the same weights,
+    as MobileNet experiments do.
+
+    Args:
+        directory (Path): Directory of the experiment.
+        adapter (ModelAdapter): The model adapter.
+        layer_name (str): Name of the approximated layer.
+        dataset_size (int, optional): CGP dataset size. Defaults to 1.
+
+    Returns:
+        Experiment: The experiment.
+    """
+    weight_count = adapter.get_train_weights(layer_name).numel()
+    config = CGPConfiguration()
+    config.path = directory / layer_name / Experiment.train_cgp_name
+    config.path.parent.mkdir(exist_ok=True, parents=True)
+    for key, value in {"function_count": 27, "function_input_arity": 2, "function_output_arity": 1, "dataset_size": dataset_size,
+                       "input_count": weight_count, "output_count": weight_count, "population_max": 32, "row_count": 5, "col_count": 5}.items():
+        config.set_attribute(key, value)
+
+    combinations = FilterSelectorCombinations()
+    for _ in range(dataset_size):
+        combination = FilterSelectorCombination()
+        combination.add(FilterSelector(layer_name, [(slice(None), slice(None), slice(None), slice(None))], []))
+        combination.add(FilterSelector(layer_name, [], [(slice(None), slice(None), slice(None), slice(None))]))
+        combinations.add(combination)
+
+    experiment = Experiment(config, adapter, CGP(None), dtype=torch.int8, e_fitness="SE")
+    experiment.set_feature_maps_combinations(combinations)
+    return experiment
+
+def create_weight_lines(experiment: Experiment, seed: int = 42) -> List[str]:
+    """
+    Creates lines of a synthetic chromosome weight file in the format written by the CGP binary.
+
+    Args:
+        experiment (Experiment): The experiment.
+        seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+        List[str]: One line of weights per dataset item.
+    """
+    generator = np.random.default_rng(seed)
+    return [" ".join(generator.integers(-128, 128, experiment.config.get_output_count()).astype(str)) + "\n" for _ in range(experiment.config.get_dataset_size())]
+
+def create_statistics_file(file: Path, rows: int, chromosome_size: int = 512, seed: int = 42) -> Path:
+    """
+    Creates a synthetic CGP statistics file with random objectives and chromosomes.
+
+    Args:
+        file (Path): Destination file.
+        rows (int): Number of rows.
+        chromosome_size (int, optional): Length of the chromosome strings. Defaults to 512.
+        seed (int, optional): Seed of the random generator. Defaults to 42.
+
+    Returns:
+        Path: The statistics file.
+    """
+    generator = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "run": 1,
+        "generation": np.arange(rows),
+        "timestamp": np.arange(rows) * 1000,
+        "error": generator.integers(0, 1 << 20, rows),
+        "quantized_energy": generator.integers(0, 1 << 16, rows),
+        "energy": generator.random(rows),
+        "area": generator.random(rows),
+        "quantized_delay": generator.integers(0, 1 << 12, rows),
+        "delay": generator.random(rows),
+        "depth": generator.integers(1, 32, rows),
+        "gate_count": generator.integers(1, 256, rows),
+        "chromosome": "x" * chromosome_size
+    }, columns=STATISTICS_COLUMNS)
+    file.parent.mkdir(exist_ok=True, parents=True)
+    df.to_csv(file, index=False)
+    return file
+
+class DiscoveryExperiment(MultiExperiment):
+    """
+    Multi experiment over synthetic experiment folders used to measure discovery without a model.
+    """
+    def create_experiment_from_name(self, config: CGPConfiguration) -> Experiment:
+        return Experiment(config, self._model_adapter, self._cgp, self.dtype, **self.args)
+
+def create_experiment_tree(directory: Path, experiments: int) -> Path:
+    """
+    Creates folders of experiments containing only their train configuration.
+
+    Args:
+        directory (Path): Root of the tree.
+        experiments (int): Number of experiments.
+
+    Returns:
+        Path: The root.
+    """
+    for i in range(experiments):
+        config = CGPConfiguration()
+        config.path = directory / f"layer_mse_{i}_5_5" / Experiment.train_cgp_name
+        config.path.parent.mkdir(exist_ok=True, parents=True)
+        for key, value in {"function_count": 27, "input_count": 9, "output_count": 16, "dataset_size": 1, "row_count": 5, "col_count": 5, "mse_threshold": i}.items():
+            config.set_attribute(key, value)
+        config.apply_extra_attributes()
+        config.save()
+    return directory
+
+def run_model_suite(name: str, adapter: ModelAdapter, layer_name: str, dataset: InMemoryDataset, directory: Path, repeat: int, batch_size: int) -> Dict[str, dict]:
+    """
+    Measures the model dependent stages of the pipeline.
+
+    Args:
+        name (str): Prefix of the result names.
+        adapter (ModelAdapter): The model adapter.
+        layer_name (str): Name of the approximated layer.
+        dataset (InMemoryDataset): Images used for evaluation.
+        directory (Path): Working directory.
+        repeat (int): Number of measurements.
+        batch_size (int): Evaluation batch size.
+
+    Returns:
+        Dict[str, dict]: Measurements keyed by stage name.
+    """
+    results = {}
+    experiment = create_experiment(directory, adapter, layer_name)
+    config = experiment.config
+
+    def prepare_cgp():
+        experiment.reset()
+        experiment._prepare_cgp(config)
+    results[f"{name}.prepare_cgp"] = measure(prepare_cgp, repeat=repeat)
+    results[f"{name}.create_train_file"] = measure(lambda: experiment._cgp.create_train_file(str(directory / f"{name}.train.data")), repeat=repeat)
+
+    lines = create_weight_lines(experiment)
+    results[f"{name}.parse_weights"] = measure(lambda: experiment.parse_weights(lines), repeat=repeat)
+    weights_vector, combinations = experiment.parse_weights(lines)
+    results[f"{name}.inject_weights"] = measure(lambda: adapter.inject_weights(weights_vector, combinations, inline=False), repeat=repeat)
+
+    # evaluation reads the synthetic images instead of the dataset on disk
+    adapter.get_test_data = lambda **kwargs: dataset
+    evaluation = measure(lambda: adapter.evaluate(batch_size=batch_size, top=[1, 5], include_loss=True), repeat=repeat)
+    results[f"{name}.evaluate_1k_images"] = dict([(key, value * 1000 / len(dataset) if key in ["best", "mean"] else value) for key, value in evaluation.items()])
+    return results
+
+def run_common_suite(directory: Path, repeat: int, experiments: int, statistics_rows: int) -> Dict[str, dict]:
+    """
+    Measures the model independent stages: configuration cloning, experiment discovery and Pareto front of statistics.
+
+    Args:
+        directory (Path): Working directory.
+        repeat (int): Number of measurements.
+        experiments (int): Number of synthetic experiments discovered.
+        statistics_rows (int): Number of rows of the synthetic statistics file.
+
+    Returns:
+        Dict[str, dict]: Measurements keyed by stage name.
+    """
+    results = {}
+    root = create_experiment_tree(directory / "experiments", experiments)
+    config = CGPConfiguration(root / f"layer_mse_0_5_5" / Experiment.train_cgp_name)
+    results["config.clone"] = measure(config.clone, repeat=repeat, number=1000)
+
+    multi_experiment = DiscoveryExperiment(root, None, CGP(None), e_fitness="SE")
+    results["multi_experiment.get_experiments"] = measure(lambda: list(multi_experiment.get_experiments()), repeat=repeat)
+    results["multi_experiment.get_experiments_with_glob"] = measure(lambda: list(multi_experiment.get_experiments_with_glob("layer_mse_*")), repeat=repeat)
+
+    statistics_file = create_statistics_file(directory / "statistics" / "statistics.1.csv", statistics_rows)
+    results["pareto.statistics_front"] = measure(lambda: get_statistics_front([statistics_file], usecols=["run", "generation"]), repeat=repeat)
+    return results
+
+def compare_results(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """
+    Compares the best times with the baseline and prints the ratios.
+
+    Args:
+        results (Dict[str, dict]): Current measurements.
+        baseline (Dict[str, dict]): Baseline measurements.
+        tolerance (float): Allowed relative slowdown, 0.1 allows 10 % slower stages.
+
+    Returns:
+        List[str]: Names of the stages slower than allowed.
+    """
+    regressions = []
+    print(f"{'stage':<45} {'baseline [s]':>14} {'current [s]':>14} {'ratio':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<45} {'-':>14} {result['best']:>14.6f} {'-':>8}")
+            continue
+        ratio = result["best"] / baseline[name]["best"] if baseline[name]["best"] > 0 else float("inf")
+        status = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            status = " REGRESSION"
+        print(f"{name:<45} {baseline[name]['best']:>14.6f} {result['best']:>14.6f} {ratio:>8.3f}{status}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the experiment pipeline on synthetic models and data without network or GPU")
+    parser.add_argument("--suites", nargs="+", default=suites, choices=suites, help="Benchmark suites")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of measurements")
+    parser.add_argument("--images", type=int, default=1000, help="Number of evaluated images")
+    parser.add_argument("--batch-size", type=int, default=256, help="Evaluation batch size")
+    parser.add_argument("--lenet-layer", type=str, default="conv2", help="Approximated LeNet-5 layer")
+    parser.add_argument("--mobilenet-layer", type=str, default="features.8.conv.0.0", help="Approximated MobileNetV2 layer")
+    parser.add_argument("--experiments", type=int, default=200, help="Number of synthetic experiments discovered")
+    parser.add_argument("--statistics-rows", type=int, default=200000, help="Number of rows of the synthetic statistics file")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch threads, keeps results comparable across machines")
+    parser.add_argument("--output", type=str, default=None, help="JSON file to store the results")
+    parser.add_argument("--compare", type=str, default=None, help="JSON file with baseline results")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    # datastore paths are derived during imports and experiment creation
+    os.environ.setdefault("datastore", tempfile.gettempdir())
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        if "lenet" in args.suites:
+            results.update(run_model_suite("lenet", create_lenet_adapter(directory), args.lenet_layer, create_dataset([1, 28, 28], 10, args.images),
+                                           directory, args.repeat, args.batch_size))
+        if "mobilenet" in args.suites:
+            results.update(run_model_suite("mobilenet", create_mobilenet_adapter(directory), args.mobilenet_layer, create_dataset([3, 224, 224], 1000, args.images),
+                                           directory, args.repeat, args.batch_size))
+        if "common" in args.suites:
+            results.update(run_common_suite(directory, args.repeat, args.experiments, args.statistics_rows))
+
+    for name, result in results.items():
+        print(f"{name:<45} best {result['best']:.6f}s mean {result['mean']:.6f}s")
+
+    report = {
+        "meta": {"python": platform.python_version(), "torch": torch.__version__, "machine": platform.machine(), "threads": torch.get_num_threads(), "arguments": vars(args)},
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stages are slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# bench_startup.py: Benchmark of the CLI startup asserting import time budget and absence of heavy modules.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import List
+
+heavy_modules = ["torch", "torchvision", "datasets", "pandas", "seaborn", "matplotlib", "numpy"]
+
+startup_cases = [
+    ["--help"],
+    ["single_channel:train-pbs", "--help"],
+    ["mobilenet:model-metrics", "--help"],
+    ["model-metrics-plan", "--help"]
+]
+
+measure_script = """
+import argparse, json, sys, time
+start = time.perf_counter()
+import commands.manager as manager
+parser = argparse.ArgumentParser()
+manager.register_commands(parser, {argv!r})
+try:
+    parser.parse_args({argv!r})
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "modules": [module for module in {heavy_modules!r} if module in sys.modules]}}))
+"""
+
+def measure_startup(argv: List[str], repeat: int = 3) -> dict:
+    """
+    Measures import and parser construction time of the CLI in a fresh interpreter.
+
+    Args:
+        argv (List[str]): Command line arguments of the CLI.
+        repeat (int, optional): Number of measurements, the best one is reported. Defaults to 3.
+
+    Returns:
+        dict: The best time in seconds and heavy modules imported during the startup.
+    """
+    root = Path(__file__).absolute().parent.parent
+    script = measure_script.format(argv=argv, heavy_modules=heavy_modules)
+    # defaults of experiment arguments are derived from the datastore
+    environment = dict(os.environ)
+    environment.setdefault("datastore", str(root / "data_store"))
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], cwd=root, env=environment, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result["time"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI startup time")
+    parser.add_argument("--budget", type=float, default=0.5, help="Maximum startup time in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of measurements")
+    args = parser.parse_args()
+
+    failed = False
+    for argv in startup_cases:
+        result = measure_startup(argv, repeat=args.repeat)
+        status = "ok"
+        if result["time"] > args.budget:
+            status = f"over budget {args.budget:.3f}s"
+            failed = True
+        if result["modules"]:
+            status = f"imports {', '.join(result['modules'])}"
+            failed = True
+        print(f"{' '.join(argv):<40} {result['time']:.3f}s {status}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,9 @@
 
 import torch
 import subprocess
-from typing import TextIO
+from typing import Optional, TextIO
 from cgp.cgp_configuration import CGPConfiguration
+from tracing import traced, unwatch_process, watch_process
 from pathlib import Path
 import os
 
@@ -141,6 +142,7 @@ class CGP(object):
                 stream.write(" " + " ".join(["x"] * no_care_output_values))
             stream.write("\n")
 
+    @traced("cgp.create_train_file")
     def create_train_file(self, file: str):
         """
         Creates a training file with the current training data.
@@ -172,6 +174,7 @@ class CGP(object):
 
         return [str(self._binary), command, str(self.config.path), *other_args, *args]
 
+    @traced("cgp.execute")
     def _execute(self, command: str = "train", mode="w", other_args=[], cwd: str = None):
         """
         Executes a CGP command.
@@ -189,11 +192,34 @@ class CGP(object):
         print(args)
         with self.config.open_stdout(mode) as stdout, self.config.open_stderr(mode) as stderr:
             process = subprocess.Popen(args, stdout=stdout, stderr=None, text=True, cwd=os.getcwd())
-            process.wait()
+            watch_process(process.pid)
+            try:
+                process.wait()
+            finally:
+                unwatch_process(process.pid)
             print("Return code:", process.returncode)
             if process.returncode != 0:
                 raise CGPProcessError(process.returncode)
 
+    def spawn(self, command: str = "train", config: Optional[CGPConfiguration] = None, mode="w", env: Optional[dict] = None) -> subprocess.Popen:
+        """
+        Starts a CGP command without waiting for it to finish.
+
+        Args:
+            command (str): Command to execute.
+            config (Optional[CGPConfiguration]): Configuration of the process, its stdout and stderr files must be set. Defaults to the adapter configuration.
+            mode (str): Mode for opening the output streams.
+            env (Optional[dict]): Environment of the process. Defaults to the current environment.
+
+        Returns:
+            subprocess.Popen: The started process.
+        """
+        config = config or self.config
+        args = [str(self._binary), command, str(config.path), *config.to_args()]
+        print(args)
+        with config.open_stdout(mode) as stdout, config.open_stderr(mode) as stderr:
+            return subprocess.Popen(args, stdout=stdout, stderr=stderr, text=True, cwd=os.getcwd(), env=env)
+
     def train(self):
         """
         Trains the CGP model.
@@ -18,6 +18,8 @@ import contextlib
 import subprocess
 import os
 import copy
+from commands.datastore import open_file
+from tracing import traced
 
 class CGPConfiguration:
     ignored_arguments = set(["stdout", "stderr"])
@@ -133,6 +135,7 @@ class CGPConfiguration:
         cloned_instance._extra_attributes = copy.deepcopy(self._extra_attributes)
         return cloned_instance
 
+    @traced("config.load")
     def load(self, config_file: str = None):
         """
         Loads the configuration from a file.
@@ -147,7 +150,7 @@ class CGPConfiguration:
             raise ValueError(
                 "either config file must be passed to the load function or the class constructor must have been provided a configuration file as argument"
             )
-        with open(config_file or self.path, "r") as f:
+        with open_file(config_file or self.path, "r") as f:
             for line in f:
                 line = line.strip()
                 # Skip empty lines
@@ -156,6 +159,7 @@ class CGPConfiguration:
                     key, value = line[:colon_index], line[colon_index+1:]
                     self._attributes[key.strip()] = self._parse_value(value.strip())
 
+    @traced("config.save")
     def save(self, config_file: str = None):
         """
         Saves the current configuration to a file.
@@ -272,6 +276,19 @@ class CGPConfiguration:
     def get_attribute(self, name):
         return self._extra_attributes.get(name) or self._attributes.get(name, None)
 
+    def get_path(self, name) -> Optional[Path]:
+        """
+        Gets a file attribute as a local path. File attributes are stored as Windows paths.
+
+        Args:
+            name (str): Name of the file attribute.
+
+        Returns:
+            Optional[Path]: The path or None if the attribute is not set.
+        """
+        value = self.get_attribute(name)
+        return Path(self._path_to_string(value)) if value is not None else None
+
     def get_learning_rate_file(self):
         return self.get_attribute(self.COMMAND_LEARNING_RATE_FILE)
 
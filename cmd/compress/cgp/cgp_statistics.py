@@ -0,0 +1,204 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# cgp_statistics.py: Streaming readers of CGP statistics CSV files, optionally stored in zip archives.
+
+import csv
+import io
+import os
+import random
+import zipfile
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Optional, Tuple, Union
+import pandas as pd
+from commands.datastore import exists, open_file
+
+STATISTICS_COLUMNS = ["run", "generation", "timestamp", "error", "quantized_energy", "energy", "area", "quantized_delay", "delay", "depth", "gate_count", "chromosome"]
+
+def resolve_statistics_file(file: Union[Path, str]) -> Path:
+    """
+    Resolves the statistics file, falling back to its zipped variant when the plain file does not exist.
+    Files stored in an experiment archive are resolved to their path and opened from the archive.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+
+    Returns:
+        Path: The existing statistics file.
+    """
+    file = Path(file)
+    zipped_file = file.with_name(file.name + ".zip")
+    if not file.exists() and (zipped_file.exists() or (not exists(file) and exists(zipped_file))):
+        return zipped_file
+    return file
+
+def open_statistics(file: Union[Path, str]) -> BinaryIO:
+    """
+    Opens the statistics file for binary reading. Zip archives are opened as their first member.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+
+    Returns:
+        BinaryIO: The opened file.
+    """
+    file = resolve_statistics_file(file)
+    if file.suffix == ".zip":
+        archive = zipfile.ZipFile(open_file(file, "rb"))
+        try:
+            return archive.open(archive.namelist()[0])
+        finally:
+            # the opened member keeps the underlying file open
+            archive.close()
+    return open_file(file, "rb")
+
+def _parse_header(line: bytes) -> Optional[List[str]]:
+    fields = next(csv.reader([line.decode().rstrip("\r\n")]), [])
+    return fields if "error" in fields else None
+
+def get_column_names(file: Union[Path, str]) -> Tuple[List[str], bool]:
+    """
+    Gets column names of the statistics file from its first line.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+
+    Returns:
+        Tuple[List[str], bool]: Column names and whether the file has a header.
+    """
+    with open_statistics(file) as f:
+        header = _parse_header(f.readline())
+    return (header, True) if header is not None else (STATISTICS_COLUMNS, False)
+
+def _parse_lines(lines: Iterable[bytes], names: List[str], usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    lines = list(lines)
+    if not lines:
+        return pd.DataFrame(columns=usecols or names)
+    return pd.read_csv(io.BytesIO(b"\n".join(lines)), header=None, names=names, usecols=usecols)
+
+def _iterate_lines(f: BinaryIO, has_header: bool) -> Iterable[bytes]:
+    if has_header:
+        f.readline()
+    for line in f:
+        line = line.rstrip(b"\r\n")
+        if line:
+            yield line
+
+def _read_tail_lines(f: BinaryIO, rows: int, has_header: bool, block_size: int) -> List[bytes]:
+    position = f.seek(0, os.SEEK_END)
+    data = b""
+    while position > 0 and data.rstrip(b"\r\n").count(b"\n") < rows:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        data = f.read(read_size) + data
+
+    lines = data.rstrip(b"\r\n").split(b"\n")
+    # the first line is incomplete unless the beginning of the file was reached
+    lines = lines[1:] if position > 0 or has_header else lines
+    return [line.rstrip(b"\r") for line in lines if line.rstrip(b"\r")][-rows:]
+
+def read_statistics(file: Union[Path, str], usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Reads the whole statistics file.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+        usecols (Optional[List[str]], optional): Columns to parse. Defaults to all columns.
+
+    Returns:
+        pd.DataFrame: The statistics.
+    """
+    names, has_header = get_column_names(file)
+    with open_statistics(file) as f:
+        return pd.read_csv(f, header=0 if has_header else None, names=names, usecols=usecols)
+
+def iterate_statistics(file: Union[Path, str], usecols: Optional[List[str]] = None, chunk_size: int = 100000) -> Iterable[pd.DataFrame]:
+    """
+    Streams the statistics file in chunks of rows.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+        usecols (Optional[List[str]], optional): Columns to parse. Defaults to all columns.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to 100000.
+
+    Returns:
+        Iterable[pd.DataFrame]: The chunks in file order.
+    """
+    names, has_header = get_column_names(file)
+    with open_statistics(file) as f:
+        for chunk in pd.read_csv(f, header=0 if has_header else None, names=names, usecols=usecols, chunksize=chunk_size):
+            yield chunk
+
+def read_statistics_tail(file: Union[Path, str], rows: int, usecols: Optional[List[str]] = None, block_size: int = 1 << 20) -> pd.DataFrame:
+    """
+    Reads the last rows of the statistics file. Plain files are read by seeking from their end,
+    zip archives are streamed once keeping only the last rows in memory.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+        rows (int): Number of rows to read.
+        usecols (Optional[List[str]], optional): Columns to parse. Defaults to all columns.
+        block_size (int, optional): Number of bytes read at once when seeking. Defaults to 1 MiB.
+
+    Returns:
+        pd.DataFrame: The last rows.
+    """
+    names, has_header = get_column_names(file)
+    with open_statistics(file) as f:
+        if f.seekable() and not isinstance(f, zipfile.ZipExtFile):
+            lines = _read_tail_lines(f, rows, has_header, block_size)
+        else:
+            lines = deque(_iterate_lines(f, has_header), maxlen=rows)
+    return _parse_lines(lines, names, usecols=usecols)
+
+def sample_statistics(file: Union[Path, str], rows: int, usecols: Optional[List[str]] = None, keep_last: bool = True, seed: Optional[int] = None) -> pd.DataFrame:
+    """
+    Samples rows of the statistics file using reservoir sampling in one streaming pass.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+        rows (int): Number of rows to sample, including the last row when keep_last is set.
+        usecols (Optional[List[str]], optional): Columns to parse. Defaults to all columns.
+        keep_last (bool, optional): Whether to always include the last row, the best solution. Defaults to True.
+        seed (Optional[int], optional): Seed of the random generator. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The sampled rows in file order.
+    """
+    names, has_header = get_column_names(file)
+    generator = random.Random(seed)
+    reservoir_size = rows - 1 if keep_last else rows
+    reservoir: List[Tuple[int, bytes]] = []
+    pending = None
+    seen = 0
+    with open_statistics(file) as f:
+        for line in _iterate_lines(f, has_header):
+            if keep_last:
+                line, pending = pending, line
+                if line is None:
+                    continue
+            if seen < reservoir_size:
+                reservoir.append((seen, line))
+            else:
+                slot = generator.randint(0, seen)
+                if slot < reservoir_size:
+                    reservoir[slot] = (seen, line)
+            seen += 1
+
+    if seen < reservoir_size:
+        raise ValueError(f"cannot sample {reservoir_size} rows from {seen} rows of {file}")
+    lines = [line for _, line in sorted(reservoir)]
+    if keep_last and pending is not None:
+        lines.append(pending)
+    return _parse_lines(lines, names, usecols=usecols)
@@ -0,0 +1,148 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# chromosome_dedup.py: Index of already evaluated chromosomes shared across runs and experiments.
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+import pandas as pd
+
+class ChromosomeDedupIndex(object):
+    """
+    Index of evaluation results keyed by chromosome hash. A chromosome produces the same weights
+    and metrics whenever it is evaluated on the same train data and gate parameters, so the key
+    combines digest of those files with hash of the chromosome.
+
+    Attributes:
+        total (int): Number of rows whose results were requested.
+        evaluated (int): Number of rows which were actually evaluated.
+    """
+    def __init__(self) -> None:
+        """
+        Initializes an empty index.
+        """
+        self._results: Dict[str, dict] = {}
+        self._file_digests: Dict[Tuple[str, int, int], str] = {}
+        self.total = 0
+        self.evaluated = 0
+
+    def _get_file_digest(self, file: Union[Path, str]) -> str:
+        stat = os.stat(file)
+        key = (str(Path(file).absolute()), stat.st_size, stat.st_mtime_ns)
+        if key not in self._file_digests:
+            digest = hashlib.sha256()
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            self._file_digests[key] = digest.hexdigest()
+        return self._file_digests[key]
+
+    def get_context_digest(self, *files: Union[Path, str]) -> str:
+        """
+        Computes digest of files the chromosome evaluation depends on. Missing files are skipped.
+
+        Args:
+            *files (Union[Path, str]): The files, such as train data and gate parameters.
+
+        Returns:
+            str: Hexadecimal digest.
+        """
+        digest = hashlib.sha256()
+        for file in files:
+            digest.update((self._get_file_digest(file) if Path(file).exists() else "-").encode())
+        return digest.hexdigest()
+
+    def get_keys(self, context_digest: str, chromosomes: pd.Series) -> pd.Series:
+        """
+        Computes index keys of the chromosomes.
+
+        Args:
+            context_digest (str): Digest returned by get_context_digest.
+            chromosomes (pd.Series): The chromosomes.
+
+        Returns:
+            pd.Series: Keys aligned with the chromosomes.
+        """
+        return chromosomes.map(lambda chromosome: context_digest[:16] + ":" + hashlib.sha1(chromosome.encode()).hexdigest())
+
+    def get_pending(self, keys: pd.Series) -> pd.Series:
+        """
+        Selects keys which need to be evaluated, that is first occurrences of keys not present in the index.
+
+        Args:
+            keys (pd.Series): The keys.
+
+        Returns:
+            pd.Series: Boolean mask of keys to be evaluated.
+        """
+        return ~keys.isin(self._results.keys()) & ~keys.duplicated()
+
+    def add(self, keys: pd.Series, results: pd.DataFrame, columns: List[str]):
+        """
+        Adds evaluation results to the index.
+
+        Args:
+            keys (pd.Series): Keys aligned with the results.
+            results (pd.DataFrame): The evaluated rows.
+            columns (List[str]): Columns holding the results.
+        """
+        for key, (_, row) in zip(keys, results[columns].iterrows()):
+            self._results[key] = row.to_dict()
+        self.evaluated += len(results.index)
+
+    def load(self, keys: pd.Series, results: pd.DataFrame):
+        """
+        Loads results evaluated earlier, for example by an interrupted job, without counting them as evaluated.
+
+        Args:
+            keys (pd.Series): Keys aligned with the results.
+            results (pd.DataFrame): The previously evaluated rows.
+        """
+        for key, (_, row) in zip(keys, results.iterrows()):
+            self._results.setdefault(key, row.to_dict())
+
+    def fan_out(self, df: pd.DataFrame, keys: pd.Series, columns: List[str]) -> pd.DataFrame:
+        """
+        Fills results of every row from the index. Rows without results are dropped.
+
+        Args:
+            df (pd.DataFrame): Rows to be filled.
+            keys (pd.Series): Keys aligned with the rows.
+            columns (List[str]): Columns holding the results.
+
+        Returns:
+            pd.DataFrame: The filled rows.
+        """
+        known = keys.isin(self._results.keys())
+        df = df.loc[known, :].copy()
+        results = pd.DataFrame([self._results[key] for key in keys[known]], index=df.index, columns=columns)
+        for column in columns:
+            df[column] = results[column]
+        self.total += len(df.index)
+        return df
+
+    def get_ratio(self) -> float:
+        """
+        Gets ratio of rows whose results were reused instead of being evaluated.
+
+        Returns:
+            float: The dedup ratio.
+        """
+        return (self.total - self.evaluated) / self.total if self.total else 0.0
+
+    def report(self):
+        """
+        Prints the dedup statistics.
+        """
+        print(f"evaluated {self.evaluated} unique chromosomes for {self.total} rows, dedup ratio: {self.get_ratio():.2%}")
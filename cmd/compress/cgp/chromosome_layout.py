@@ -0,0 +1,186 @@
+# Copyright 2024 Mari�n Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# chromosome_layout.py: Parsing of serialized chromosomes and their re-layout to a different grid size.
+
+import re
+from typing import Dict, List, Optional, Self, Tuple
+from cgp.cgp_configuration import CGPConfiguration
+
+header_fields = ["input_count", "output_count", "col_count", "row_count", "function_input_arity", "look_back_parameter", "dataset_size"]
+_header_pattern = re.compile(r"^\{([\d,]+)\}")
+_gate_pattern = re.compile(r"\(\[(\d+)\]([\d,]+)\)")
+_outputs_pattern = re.compile(r"\(([\d,]*)\)$")
+
+class ChromosomeLayout(object):
+    """
+    Serialized chromosome in the format written by the CGP binary, {header}([id]inputs...,function)...(outputs).
+    Gates are stored column by column, gate i lies in column i // row_count and row i % row_count, and pin
+    of the output k of gate i is input_count + i * function_output_arity + k.
+
+    Attributes:
+        header (Dict[str, int]): Header values named by header_fields.
+        gates (List[Tuple[List[int], int]]): Input pins and function of every gate.
+        outputs (List[int]): Pins connected to the chromosome outputs.
+    """
+    def __init__(self, header: Dict[str, int], gates: List[Tuple[List[int], int]], outputs: List[int]) -> None:
+        """
+        Initializes the chromosome.
+
+        Args:
+            header (Dict[str, int]): Header values named by header_fields.
+            gates (List[Tuple[List[int], int]]): Input pins and function of every gate.
+            outputs (List[int]): Pins connected to the chromosome outputs.
+        """
+        self.header = header
+        self.gates = gates
+        self.outputs = outputs
+
+    @classmethod
+    def parse(cls, chromosome: str) -> Self:
+        """
+        Parses the serialized chromosome.
+
+        Args:
+            chromosome (str): The serialized chromosome.
+
+        Returns:
+            ChromosomeLayout: The parsed chromosome.
+
+        Raises:
+            ValueError: If the chromosome is malformed.
+        """
+        chromosome = chromosome.strip()
+        header = _header_pattern.match(chromosome)
+        outputs = _outputs_pattern.search(chromosome)
+        if header is None or outputs is None:
+            raise ValueError("invalid format of the chromosome: " + chromosome[:64])
+        values = [int(value) for value in header.group(1).split(",")]
+        if len(values) != len(header_fields):
+            raise ValueError("invalid format of the chromosome header: " + header.group(0))
+        header = dict(zip(header_fields, values))
+        gates = []
+        for gate in _gate_pattern.findall(chromosome):
+            genes = [int(gene) for gene in gate[1].split(",")]
+            if len(genes) != header["function_input_arity"] + 1:
+                raise ValueError(f"invalid format of the chromosome gate {gate[0]}")
+            gates.append((genes[:-1], genes[-1]))
+        if len(gates) != header["row_count"] * header["col_count"]:
+            raise ValueError(f"chromosome has {len(gates)} gates, expected {header['row_count'] * header['col_count']}")
+        return cls(header, gates, [int(pin) for pin in outputs.group(1).split(",") if pin])
+
+    def to_string(self) -> str:
+        """
+        Serializes the chromosome in the format of the CGP binary.
+
+        Returns:
+            str: The serialized chromosome.
+        """
+        header = "{" + ",".join(str(self.header[field]) for field in header_fields) + "}"
+        gates = "".join(f"([{i + self.header['input_count']}]" + ",".join(str(pin) for pin in inputs) + f",{function})" for i, (inputs, function) in enumerate(self.gates))
+        return header + gates + "(" + ",".join(str(pin) for pin in self.outputs) + ")"
+
+    def is_compatible(self, config: CGPConfiguration) -> bool:
+        """
+        Checks whether the chromosome solves the same problem as the configuration, that is whether it has
+        the same inputs, outputs, function arity and dataset size. Grid size may differ.
+
+        Args:
+            config (CGPConfiguration): The configuration.
+
+        Returns:
+            bool: True if the chromosome can be used by the configuration after re-layout.
+        """
+        for field in ["input_count", "output_count", "function_input_arity", "dataset_size"]:
+            value = config.get_attribute(field)
+            if value is not None and int(float(value)) != self.header[field]:
+                return False
+        function_count = config.get_attribute(CGPConfiguration.COMMAND_FUNCTION_COUNT)
+        return function_count is None or all(function < int(function_count) for _, function in self.gates)
+
+    def get_active_gates(self, function_output_arity: int = 1) -> List[int]:
+        """
+        Gets gates the outputs depend on. All input pins of a gate are followed, because arity of
+        the gate functions is known only to the CGP binary.
+
+        Args:
+            function_output_arity (int, optional): Output arity of the gates. Defaults to 1.
+
+        Returns:
+            List[int]: Indices of the active gates in ascending order.
+        """
+        input_count = self.header["input_count"]
+        active = set()
+        pending = [pin for pin in self.outputs if pin >= input_count]
+        while pending:
+            gate = (pending.pop() - input_count) // function_output_arity
+            if gate in active:
+                continue
+            active.add(gate)
+            pending.extend(pin for pin in self.gates[gate][0] if pin >= input_count)
+        return sorted(active)
+
+    def relayout(self, row_count: int, col_count: int, look_back_parameter: Optional[int] = None, function_output_arity: int = 1) -> Optional[Self]:
+        """
+        Places active gates to a grid of a different size while preserving the circuit. Gates keep their
+        topological order and each is placed to the first column after its sources which has a free row.
+        Connections must respect the look back parameter, as the CGP binary only mutates within those bounds.
+        Inactive gates are filled by the first pin allowed in their column and the first function.
+
+        Args:
+            row_count (int): Rows of the new grid.
+            col_count (int): Columns of the new grid.
+            look_back_parameter (Optional[int], optional): Look back parameter of the new grid. Defaults to col_count.
+            function_output_arity (int, optional): Output arity of the gates. Defaults to 1.
+
+        Returns:
+            Optional[ChromosomeLayout]: The re-laid out chromosome or None if the circuit does not fit the grid.
+        """
+        look_back_parameter = look_back_parameter or col_count
+        input_count = self.header["input_count"]
+        gate_of = lambda pin: (pin - input_count) // function_output_arity
+        placement: Dict[int, int] = {}
+        used = [0] * col_count
+        for gate in self.get_active_gates(function_output_arity):
+            inputs, _ = self.gates[gate]
+            if any(gate_of(pin) not in placement for pin in inputs if pin >= input_count):
+                return None
+            source_columns = [placement[gate_of(pin)] // row_count for pin in inputs if pin >= input_count]
+            column = max(source_columns) + 1 if source_columns else 0
+            while column < col_count and used[column] == row_count:
+                column += 1
+            if column == col_count:
+                return None
+            if any(column - source_column > look_back_parameter for source_column in source_columns):
+                return None
+            if column >= look_back_parameter and any(pin < input_count for pin in inputs):
+                return None
+            placement[gate] = column * row_count + used[column]
+            used[column] += 1
+
+        for pin in self.outputs:
+            if pin < input_count and col_count >= look_back_parameter:
+                return None
+            if pin >= input_count and col_count - placement[gate_of(pin)] // row_count > look_back_parameter:
+                return None
+
+        remap = lambda pin: pin if pin < input_count else input_count + placement[gate_of(pin)] * function_output_arity + (pin - input_count) % function_output_arity
+        gates = []
+        for column in range(col_count):
+            # the first pin allowed in the column, see CGP::build_indices
+            free_pin = 0 if column < look_back_parameter else (column - look_back_parameter) * row_count * function_output_arity + input_count
+            gates.extend(([free_pin] * self.header["function_input_arity"], 0) for _ in range(row_count))
+        for gate, index in placement.items():
+            inputs, function = self.gates[gate]
+            gates[index] = ([remap(pin) for pin in inputs], function)
+        header = {**self.header, "row_count": row_count, "col_count": col_count, "look_back_parameter": look_back_parameter}
+        return ChromosomeLayout(header, gates, [remap(pin) for pin in self.outputs])
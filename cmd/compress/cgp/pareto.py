@@ -0,0 +1,286 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# pareto.py: Non-dominated sorting of CGP solutions by their minimised objectives.
+
+from bisect import bisect_right
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+from cgp.cgp_statistics import iterate_statistics
+
+pareto_objectives = ["error", "energy", "delay", "gate_count"]
+
+def _get_costs(df: pd.DataFrame, objectives: List[str]) -> np.ndarray:
+    return df[objectives].apply(pd.to_numeric, errors="coerce").fillna(np.inf).to_numpy(dtype=np.float64)
+
+def _get_dominated_by(front: np.ndarray, candidates: np.ndarray, block_size: int = 1 << 22) -> np.ndarray:
+    """
+    Checks which candidates are dominated by any point of the front. Equal points do not dominate each other.
+
+    Args:
+        front (np.ndarray): An (n_front, n_costs) array.
+        candidates (np.ndarray): An (n_candidates, n_costs) array.
+        block_size (int, optional): Maximum number of compared values held in memory. Defaults to 4M.
+
+    Returns:
+        np.ndarray: An (n_candidates, ) boolean array.
+    """
+    dominated = np.zeros(candidates.shape[0], dtype=bool)
+    if front.shape[0] == 0 or candidates.shape[0] == 0:
+        return dominated
+    step = max(1, block_size // max(1, front.shape[0] * front.shape[1]))
+    for start in range(0, candidates.shape[0], step):
+        block = candidates[start:start+step, None, :]
+        dominated[start:start+step] = np.any(np.all(front <= block, axis=2) & np.any(front < block, axis=2), axis=1)
+    return dominated
+
+def _get_unique(costs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds unique points sorted lexicographically, which is considerably faster than np.unique along an axis.
+
+    Args:
+        costs (np.ndarray): An (n_points, n_costs) array.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The unique points and index of the unique point of every input point.
+    """
+    order = np.lexsort(costs.T[::-1])
+    ordered = costs[order]
+    first = np.ones(ordered.shape[0], dtype=bool)
+    first[1:] = np.any(ordered[1:] != ordered[:-1], axis=1)
+    inverse = np.empty(ordered.shape[0], dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    return ordered[first], inverse
+
+def _get_front_2d(costs: np.ndarray) -> np.ndarray:
+    # unique points are sorted lexicographically, so a point is dominated iff an earlier point has lower or equal second cost
+    second = costs[:, 1]
+    efficient = np.ones(costs.shape[0], dtype=bool)
+    efficient[1:] = second[1:] < np.minimum.accumulate(second)[:-1]
+    return efficient
+
+def _get_front_3d(costs: np.ndarray) -> np.ndarray:
+    """
+    Sweeps lexicographically sorted unique points keeping the staircase of the last two costs of
+    the front found so far. The staircase is ordered by the second cost with decreasing third cost,
+    so a point is dominated iff the last step with lower or equal second cost has lower or equal third cost.
+    """
+    efficient = np.zeros(costs.shape[0], dtype=bool)
+    seconds, thirds = [], []
+    for i, (_, second, third) in enumerate(costs.tolist()):
+        position = bisect_right(seconds, second)
+        if position > 0 and thirds[position - 1] <= third:
+            continue
+        efficient[i] = True
+        end = position
+        while end < len(seconds) and thirds[end] >= third:
+            end += 1
+        seconds[position:end] = [second]
+        thirds[position:end] = [third]
+    return efficient
+
+def _get_front_kung(costs: np.ndarray, leaf_size: int = 32) -> np.ndarray:
+    """
+    Kung's divide and conquer on lexicographically sorted unique points. Points of the second half
+    cannot dominate points of the first half, so only the second half is filtered by the first front.
+    """
+    if costs.shape[0] <= leaf_size:
+        return ~_get_dominated_by(costs, costs)
+    middle = costs.shape[0] // 2
+    top = _get_front_kung(costs[:middle], leaf_size=leaf_size)
+    bottom = _get_front_kung(costs[middle:], leaf_size=leaf_size)
+    candidates = np.flatnonzero(bottom)
+    bottom[candidates] = ~_get_dominated_by(costs[:middle][top], costs[middle:][candidates])
+    return np.concatenate((top, bottom))
+
+def _get_front_kd(costs: np.ndarray, pivot_count: int = 1024) -> np.ndarray:
+    """
+    Prunes lexicographically sorted unique points by the front of pivots with the lowest sum of per-objective
+    ranks, which typically dominate most of the points, and runs Kung's algorithm on the survivors.
+    """
+    if costs.shape[0] <= 4 * pivot_count:
+        return _get_front_kung(costs)
+    ranks = np.argsort(np.argsort(costs, axis=0, kind="stable"), axis=0, kind="stable").sum(axis=1)
+    pivots = np.sort(np.argpartition(ranks, pivot_count)[:pivot_count])
+    pivots = pivots[_get_front_kung(costs[pivots])]
+    alive = np.arange(costs.shape[0])
+    for pivot in costs[pivots[np.argsort(ranks[pivots], kind="stable")]]:
+        candidates = costs[alive]
+        alive = alive[~(np.all(pivot <= candidates, axis=1) & np.any(pivot < candidates, axis=1))]
+    efficient = np.zeros(costs.shape[0], dtype=bool)
+    efficient[alive] = _get_front_kung(costs[alive])
+    return efficient
+
+def _get_front(costs: np.ndarray) -> np.ndarray:
+    if costs.shape[1] == 1:
+        return costs[:, 0] == costs[0, 0]
+    if costs.shape[1] == 2:
+        return _get_front_2d(costs)
+    if costs.shape[1] == 3:
+        return _get_front_3d(costs)
+    return _get_front_kd(costs)
+
+def get_non_dominated(costs: np.ndarray) -> np.ndarray:
+    """
+    Finds points which are not dominated by any other point. All costs are minimised and equal points
+    are either all non-dominated or all dominated. Two and three objectives are solved by O(n log n)
+    sweeps, more objectives by Kung's divide and conquer algorithm.
+
+    Args:
+        costs (np.ndarray): An (n_points, n_costs) array.
+
+    Returns:
+        np.ndarray: An (n_points, ) boolean array, indicating whether each point is non-dominated.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    if costs.shape[0] == 0:
+        return np.zeros(0, dtype=bool)
+    unique, inverse = _get_unique(costs.reshape(costs.shape[0], -1))
+    return _get_front(unique)[inverse]
+
+def _get_pareto_ranks_2d(costs: np.ndarray) -> np.ndarray:
+    # minimal second cost of every front is non-decreasing with the rank, so the rank is found by bisection
+    minimums = []
+    ranks = np.empty(costs.shape[0], dtype=np.int64)
+    for i, second in enumerate(costs[:, 1].tolist()):
+        rank = bisect_right(minimums, second)
+        if rank == len(minimums):
+            minimums.append(second)
+        else:
+            minimums[rank] = second
+        ranks[i] = rank + 1
+    return ranks
+
+def get_pareto_ranks(costs: np.ndarray) -> np.ndarray:
+    """
+    Assigns every point the index of its non-dominated front, the first front has rank 1.
+
+    Args:
+        costs (np.ndarray): An (n_points, n_costs) array of minimised costs.
+
+    Returns:
+        np.ndarray: An (n_points, ) integer array of front ranks.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    if costs.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    unique, inverse = _get_unique(costs.reshape(costs.shape[0], -1))
+    if unique.shape[1] == 2:
+        return _get_pareto_ranks_2d(unique)[inverse]
+
+    ranks = np.zeros(unique.shape[0], dtype=np.int64)
+    remaining = np.arange(unique.shape[0])
+    rank = 1
+    while remaining.size:
+        # remaining points stay sorted and unique, so the front is computed without sorting again
+        front = _get_front(unique[remaining])
+        ranks[remaining[front]] = rank
+        remaining = remaining[~front]
+        rank += 1
+    return ranks[inverse]
+
+class ParetoArchive(object):
+    """
+    Incrementally updated set of non-dominated solutions. Inserted batches are reduced to their own
+    front first, so the archive is compared only with the few solutions which can enter it.
+
+    Attributes:
+        objectives (List[str]): Minimised objective columns.
+        front (pd.DataFrame): The non-dominated solutions inserted so far.
+        inserted (int): Number of inserted solutions.
+    """
+    def __init__(self, objectives: List[str] = pareto_objectives) -> None:
+        """
+        Initializes an empty archive.
+
+        Args:
+            objectives (List[str], optional): Minimised objective columns. Defaults to error, energy, delay and gate count.
+        """
+        self.objectives = objectives
+        self.front = pd.DataFrame()
+        self.inserted = 0
+        self._costs = np.zeros((0, len(objectives)), dtype=np.float64)
+
+    def insert(self, df: pd.DataFrame) -> int:
+        """
+        Inserts solutions into the archive, removing archived solutions dominated by them.
+
+        Args:
+            df (pd.DataFrame): Solutions with objective columns.
+
+        Returns:
+            int: Number of inserted solutions which entered the archive.
+        """
+        self.inserted += len(df.index)
+        if df.empty:
+            return 0
+        costs = _get_costs(df, self.objectives)
+        candidates = get_non_dominated(costs)
+        candidates[candidates] = ~_get_dominated_by(self._costs, costs[candidates])
+        if not candidates.any():
+            return 0
+        kept = ~_get_dominated_by(costs[candidates], self._costs)
+        self._costs = np.concatenate((self._costs[kept], costs[candidates]))
+        accepted = df.loc[candidates, :]
+        self.front = pd.concat([self.front.loc[kept, :], accepted], ignore_index=True) if not self.front.empty else accepted.reset_index(drop=True)
+        return int(candidates.sum())
+
+    def insert_statistics(self, file: Union[Path, str], usecols: Optional[List[str]] = None, chunk_size: int = 100000) -> int:
+        """
+        Streams the statistics file into the archive chunk by chunk.
+
+        Args:
+            file (Union[Path, str]): Path to the statistics file.
+            usecols (Optional[List[str]], optional): Columns to keep, the objectives are always read. Defaults to all columns.
+            chunk_size (int, optional): Number of rows read at once. Defaults to 100000.
+
+        Returns:
+            int: Number of read solutions which entered the archive.
+        """
+        usecols = list(dict.fromkeys(self.objectives + usecols)) if usecols is not None else None
+        return sum(self.insert(chunk) for chunk in iterate_statistics(file, usecols=usecols, chunk_size=chunk_size))
+
+    def __len__(self) -> int:
+        return len(self.front.index)
+
+def get_statistics_front(files: Iterable[Union[Path, str]], objectives: List[str] = pareto_objectives, usecols: Optional[List[str]] = None, chunk_size: int = 100000) -> pd.DataFrame:
+    """
+    Computes the non-dominated solutions of statistics files without loading them whole.
+
+    Args:
+        files (Iterable[Union[Path, str]]): Paths to the statistics files.
+        objectives (List[str], optional): Minimised objective columns. Defaults to error, energy, delay and gate count.
+        usecols (Optional[List[str]], optional): Columns to keep. Defaults to all columns.
+        chunk_size (int, optional): Number of rows read at once. Defaults to 100000.
+
+    Returns:
+        pd.DataFrame: The non-dominated solutions.
+    """
+    archive = ParetoArchive(objectives)
+    for file in files:
+        archive.insert_statistics(file, usecols=usecols, chunk_size=chunk_size)
+    return archive.front
+
+def get_fronts(df: pd.DataFrame, objectives: List[str] = pareto_objectives) -> pd.Series:
+    """
+    Computes front ranks of the DataFrame rows. Missing objective values are treated as the worst.
+
+    Args:
+        df (pd.DataFrame): Solutions with objective columns.
+        objectives (List[str], optional): Minimised objective columns. Defaults to error, energy, delay and gate count.
+
+    Returns:
+        pd.Series: Front ranks aligned with the rows.
+    """
+    return pd.Series(get_pareto_ranks(_get_costs(df, objectives)), index=df.index, name="Front")
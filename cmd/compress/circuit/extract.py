@@ -13,10 +13,14 @@
 # extract.py: Extract and prepare Verilog circuit data to Pandas friendly format.
 
 import glob
+import hashlib
+import io
+import os
 import re
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Optional, Tuple, Union
 from decimal import *
 
 # Dictionary to maintain order of keys for various operations
@@ -60,6 +64,29 @@ key_order = {
 
 key_order_with_id = {**key_order, "id": 100}
 
+def read_tail(file: Union[Path, str], line_count: int, block_size: int = 4096) -> List[str]:
+    """
+    Reads the last lines of a text file by seeking from its end.
+
+    Args:
+        file (Union[Path, str]): The text file.
+        line_count (int): Number of lines to read.
+        block_size (int, optional): Number of bytes read at once. Defaults to 4096.
+
+    Returns:
+        List[str]: The last lines, as they would be returned by readlines().
+    """
+    with open(file, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b""
+        # One extra newline guarantees the first, possibly partial, line is not returned
+        while position > 0 and data.count(b"\n") <= line_count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    return io.StringIO(data.decode(errors="replace"), newline=None).readlines()[-line_count:]
+
 class DataExtractor(object):
     """
     A class to extract power, area, and timing data from specified files and save the processed data.
@@ -69,18 +96,26 @@ class DataExtractor(object):
         input_dir (Path): Directory containing the input files.
         output_file (Path): Path to the CSV file where the extracted data will be saved.
         output_file_text (Path): Path to the text file where the extracted data will be saved in text format.
+        cache_file (Path): Path to the CSV file with already parsed reports.
+        max_workers (Optional[int]): Number of threads parsing the reports.
     """    
-    def __init__(self, basedir: str) -> None:
+    cache_columns = ["kind", "file", "size", "mtime_ns", "name", "value", "unit"]
+    tail_lines = 6
+
+    def __init__(self, basedir: str, max_workers: Optional[int] = None) -> None:
         """
         Initializes the DataExtractor with a base directory.
 
         Args:
             basedir (str): The base directory where input and output files are located.
+            max_workers (Optional[int], optional): Number of threads parsing the reports. Defaults to None.
         """        
         self.basedir = Path(basedir)
         self.input_dir = self.basedir / "res"
         self.output_file = self.basedir / "parameters.csv"
         self.output_file_text = self.basedir / "parameters.txt"
+        self.cache_file = self.basedir / "reports.cache.csv"
+        self.max_workers = max_workers
     
     def _get_power_files(self):
         """
@@ -131,95 +166,181 @@ class DataExtractor(object):
             f.writelines(line + "\n" for line in df_string)
         
 
-    def _extract_powers(self) -> pd.DataFrame:
+    def get_report_digest(self) -> str:
         """
-        Extracts power data from power files.
+        Computes digest identifying the current set of reports by their names, sizes and modification times.
 
         Returns:
-            pd.DataFrame: A DataFrame containing power values and units.
-        """        
-        power_values = []
-        power_units = []
-        index = []
-        for file in self._get_power_files():
-            with open(file, "r") as f:
-                file_name = Path(file).name
-                total_line = f.readlines()[-2].strip()
-                segments = re.split("\s+", total_line)
+            str: Hexadecimal SHA-256 digest.
+        """
+        digest = hashlib.sha256()
+        for file in sorted(self._get_power_files() + self._get_timing_files() + self._get_area_files()):
+            stat = os.stat(file)
+            digest.update(f"{Path(file).name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def _load_cache(self) -> Dict[Tuple[str, str], Dict[str, str]]:
+        """
+        Loads previously parsed reports.
+
+        Returns:
+            Dict[Tuple[str, str], Dict[str, str]]: Parsed records keyed by report kind and file path.
+        """
+        if not self.cache_file.exists():
+            return {}
+        df = pd.read_csv(self.cache_file, dtype=str, keep_default_na=False)
+        return dict([((record["kind"], record["file"]), record) for record in df.to_dict("records")])
+
+    def _save_cache(self, records: List[Dict[str, str]]):
+        """
+        Persists parsed reports so unchanged reports are not parsed again.
+
+        Args:
+            records (List[Dict[str, str]]): Parsed records.
+        """
+        temporary_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        pd.DataFrame(records, columns=DataExtractor.cache_columns).to_csv(temporary_file, index=False)
+        os.replace(temporary_file, self.cache_file)
+
+    def _parse_power_report(self, file_name: str, lines: List[str]) -> Tuple[str, str]:
+        """
+        Parses total power from the tail of power report.
+
+        Returns:
+            Tuple[str, str]: The power value and its unit.
+        """
+        total_line = lines[-2].strip()
+        segments = re.split("\s+", total_line)
+
+        if segments[0] != "Total":
+            raise ValueError(f'[{file_name}] expecting "Total" in the beginning of the line: "{total_line}"')
+        if len(segments) != 9:
+            raise ValueError(f"[{file_name}] expected 9 segments; got: {len(segments)}")
+        if any([not segments[i].endswith("W") for i in range(2, len(segments), 2)]):
+            raise ValueError(f'[{file_name}] unexpected format of the power line: "{total_line}"')
+        return segments[-2], segments[-1]
+
+    def _parse_timing_report(self, file_name: str, lines: List[str]) -> Tuple[str, str]:
+        """
+        Parses data arrival time from the tail of timing report.
+
+        Returns:
+            Tuple[str, str]: The delay value, empty if the report has no paths, and empty unit.
+        """
+        total_line = lines[-6].strip()
+        no_paths_line = lines[-3].strip()
+        segments = re.split("\s+", total_line)
+
+        if no_paths_line == "No paths.":
+            return "", ""
 
-                if segments[0] != "Total":
-                    raise ValueError(f'[{file_name}] expecting "Total" in the beginning of the line: "{total_line}"')
-                if len(segments) != 9:
-                    raise ValueError(f"[{file_name}] expected 9 segments; got: {len(segments)}")
-                if any([not segments[i].endswith("W") for i in range(2, len(segments), 2)]):
-                    raise ValueError(f'[{file_name}] unexpected format of the power line: "{total_line}"')
+        if " ".join(segments[:3]) != "data arrival time":
+            raise ValueError(f'[{file_name}] expecting "data arrival time" in the beginning of the line: "{total_line}"')
+        if len(segments) != 4:
+            raise ValueError(f"[{file_name}] expected 4 segments; got: {len(segments)}")
+        return segments[-1], ""
 
+    def _parse_area_report(self, file_name: str, lines: List[str]) -> Tuple[str, str]:
+        """
+        Parses total cell area from the tail of area report.
+
+        Returns:
+            Tuple[str, str]: The area value and empty unit.
+        """
+        total_line = lines[-3].strip()
+        segments = re.split("\s+", total_line)
+
+        if " ".join(segments[:3]) != "Total cell area:":
+            raise ValueError(f'[{file_name}] expecting "Total cell area:" in the beginning of the line: "{total_line}"')
+        if len(segments) != 4:
+            raise ValueError(f"[{file_name}] expected 4 segments; got: {len(segments)}")
+        return segments[-1], ""
+
+    def _parse_report(self, record: Dict[str, str]) -> Dict[str, str]:
+        """
+        Parses a report described by the record and fills in its value.
+
+        Args:
+            record (Dict[str, str]): Record with report kind, file and its stat.
+
+        Returns:
+            Dict[str, str]: The completed record.
+        """
+        file_name = Path(record["file"]).name
+        parsers = {"power": self._parse_power_report, "timing": self._parse_timing_report, "area": self._parse_area_report}
+        value, unit = parsers[record["kind"]](file_name, read_tail(record["file"], DataExtractor.tail_lines))
+        return {**record, "value": value, "unit": unit}
+
+    def _get_reports(self) -> List[Dict[str, str]]:
+        """
+        Parses all reports in the input directory. Reports whose size and modification
+        time did not change since the last call are taken from the cache, the others
+        are parsed in parallel.
+
+        Returns:
+            List[Dict[str, str]]: Parsed records in the order of report files.
+        """
+        cache = self._load_cache()
+        records = []
+        pending = []
+        for kind, files in [("power", self._get_power_files()), ("timing", self._get_timing_files()), ("area", self._get_area_files())]:
+            for file in files:
+                file = str(Path(file).absolute())
+                stat = os.stat(file)
                 file_name = Path(file).name
-                name_stop = file_name.rfind("_")
-                power_values.append(Decimal(segments[-2]))
-                power_units.append(segments[-1])
-                index.append(file_name[:name_stop])
+                record = {"kind": kind, "file": file, "size": str(stat.st_size), "mtime_ns": str(stat.st_mtime_ns), "name": file_name[:file_name.rfind("_")]}
+                cached = cache.get((kind, file))
+                if cached is not None and cached["size"] == record["size"] and cached["mtime_ns"] == record["mtime_ns"]:
+                    records.append(cached)
+                else:
+                    pending.append(len(records))
+                    records.append(record)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for i, record in zip(pending, executor.map(self._parse_report, [records[i] for i in pending])):
+                    records[i] = record
+
+        if pending or len(records) != len(cache):
+            self._save_cache(records)
+        return records
+
+    def _extract_powers(self, records: List[Dict[str, str]]) -> pd.DataFrame:
+        """
+        Extracts power data from parsed power reports.
 
+        Returns:
+            pd.DataFrame: A DataFrame containing power values and units.
+        """        
+        records = [record for record in records if record["kind"] == "power"]
+        power_values = [Decimal(record["value"]) for record in records]
+        power_units = [record["unit"] for record in records]
+        index = [record["name"] for record in records]
         df = pd.DataFrame({"power": power_values, "power_unit": power_units}, index=index)
         return df
 
-    def _extract_delays(self) -> pd.DataFrame:
+    def _extract_delays(self, records: List[Dict[str, str]]) -> pd.DataFrame:
         """
-        Extracts delay data from timing files.
+        Extracts delay data from parsed timing reports.
 
         Returns:
             pd.DataFrame: A DataFrame containing delay values.
         """        
-        values = []
-        index = []
-        for file in self._get_timing_files():
-            with open(file, "r") as f:
-                file_name = Path(file).name
-                name_stop = file_name.rfind("_")
-                lines = f.readlines()
-                total_line = lines[-6].strip()
-                no_paths_line = lines[-3].strip()
-                segments = re.split("\s+", total_line)
-
-                if no_paths_line == "No paths.":
-                    values.append(0)
-                    index.append(file_name[:name_stop])
-                    continue
-
-                if " ".join(segments[:3]) != "data arrival time":
-                    raise ValueError(f'[{file_name}] expecting "data arrival time" in the beginning of the line: "{total_line}"')
-                if len(segments) != 4:
-                    raise ValueError(f"[{file_name}] expected 4 segments; got: {len(segments)}")
-
-                values.append(Decimal(segments[-1]))
-                index.append(file_name[:name_stop])
-
+        records = [record for record in records if record["kind"] == "timing"]
+        values = [Decimal(record["value"]) if record["value"] else 0 for record in records]
+        index = [record["name"] for record in records]
         return pd.DataFrame(values, index=index, columns=["delay"])
     
-    def _extract_areas(self) -> pd.DataFrame:
+    def _extract_areas(self, records: List[Dict[str, str]]) -> pd.DataFrame:
         """
-        Extracts area data from area files.
+        Extracts area data from parsed area reports.
 
         Returns:
             pd.DataFrame: A DataFrame containing area values.
         """        
-        values = []
-        index = []
-        for file in self._get_area_files():
-            with open(file, "r") as f:
-                file_name = Path(file).name
-                total_line = f.readlines()[-3].strip()
-                segments = re.split("\s+", total_line)
-
-                if " ".join(segments[:3]) != "Total cell area:":
-                    raise ValueError(f'[{file_name}] expecting "Total cell area:" in the beginning of the line: "{total_line}"')
-                if len(segments) != 4:
-                    raise ValueError(f"[{file_name}] expected 4 segments; got: {len(segments)}")
-
-                name_stop = file_name.rfind("_")
-                values.append(segments[-1])
-                index.append(file_name[:name_stop])
-
+        records = [record for record in records if record["kind"] == "area"]
+        values = [record["value"] for record in records]
+        index = [record["name"] for record in records]
         return pd.DataFrame(values, index=index, columns=["area"], dtype="float")
 
     def extract(self):
@@ -230,9 +351,10 @@ class DataExtractor(object):
             pd.DataFrame: A DataFrame containing combined power, delay, and area data.
         """        
         getcontext().prec = 32
-        powers = self._extract_powers()
-        delays = self._extract_delays()
-        areas = self._extract_areas()
+        records = self._get_reports()
+        powers = self._extract_powers(records)
+        delays = self._extract_delays(records)
+        areas = self._extract_areas(records)
         df = powers.join(delays).join(areas)
 
         if (df["power_unit"] != "mW").any():
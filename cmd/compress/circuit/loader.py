@@ -13,33 +13,121 @@
 # loader.py: Prepare gate parameters data for CGP and archive them in CSV format.
 
 import os
+import shutil
+import tempfile
+import pandas as pd
 from circuit.extract import DataExtractor
 from decimal import *
-from typing import Optional, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 from pathlib import Path
 from circuit.quantizer import DataframeQuantizier
+from commands.blob_store import get_write_store
 from commands.datastore import Datastore
+from tracing import traced
 
+_gate_parameters: Dict[Tuple[str, Optional[Tuple[int, ...]], int], Tuple[pd.DataFrame, pd.Series, pd.Series]] = {}
+# extracted values are decimals and 64 bit quantized values do not fit int64
+_cached_converters = {"power": Decimal, "delay": Decimal, "energy": Decimal, "quantized_energy": int, "quantized_delay": int}
+
+def _link_file(src: Path, dst: Path):
+    """
+    Hard-links the file to the destination, or copies it when linking is not possible.
+
+    Args:
+        src (Path): The source file.
+        dst (Path): The destination file, replaced if it exists.
+    """
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    dst.parent.mkdir(exist_ok=True, parents=True)
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _save_cache(extractor: DataExtractor, df: pd.DataFrame, csv_file: Path, txt_file: Path):
+    """
+    Saves the gate parameters to temporary files which atomically replace the cache files. Files already
+    linked to experiments keep their content and a killed job never leaves a truncated cache file.
+
+    Args:
+        extractor (DataExtractor): The extractor saving the files.
+        df (pd.DataFrame): The quantized gate parameters.
+        csv_file (Path): The cached CSV file.
+        txt_file (Path): The cached text file.
+    """
+    csv_file.parent.mkdir(exist_ok=True, parents=True)
+    temporary_files = []
+    try:
+        for file in [csv_file, txt_file]:
+            fd, temporary_file = tempfile.mkstemp(dir=file.parent, prefix=file.name + ".", suffix=".tmp")
+            os.close(fd)
+            temporary_files.append(temporary_file)
+        extractor.save(df, *temporary_files)
+        for temporary_file, file in zip(temporary_files, [csv_file, txt_file]):
+            os.chmod(temporary_file, 0o644)
+            os.replace(temporary_file, file)
+    finally:
+        for temporary_file in temporary_files:
+            if os.path.exists(temporary_file):
+                os.unlink(temporary_file)
+
+@traced("gate_parameters.get")
 def get_gate_parameters(csv_file: Union[Path, str], txt_file: Union[Path, str], grid_size: Tuple[int, int] = None, quant_bits=64, data_dir: Optional[Union[Path, str]] = None):
     """
     Extracts gate parameters, quantizes the data, and saves it to CSV and text files.
+    Results are memoised by the digest of the synthesis reports, grid size and quantization bits;
+    the files are generated once into the cache directory and hard-linked to the destination.
+    Other processes load the cached CSV file instead of extracting the reports again. The text file
+    passed to the CGP binary is written as a reference when writing through the blob store is enabled.
 
     Args:
         csv_file (Union[Path, str]): Path to the CSV file where the data will be saved.
         txt_file (Union[Path, str]): Path to the text file where the data will be saved.
         grid_size (Tuple[int, int], optional): Grid size for the quantizer. Defaults to None.
         quant_bits (int, optional): Number of quantization bits. Defaults to 64.
-        data_dir (Optional[Union[Path, str]], optional): Directory containing the input data files. Defaults to None.
+        data_dir (Optional[Union[Path, str]], optional): Directory containing the input data files. Defaults to gate_parameters_dir environment variable or the verilog datastore directory.
 
     Returns:
         Tuple[pd.DataFrame, pd.Series, pd.Series]: The DataFrame with extracted data, energy series, and delay series.
     """    
     txt_file = Path(txt_file)
     csv_file = Path(csv_file)
-    data_dir = os.environ.get("gate_parameters_dir", Datastore().derive("verilog"))
+    data_dir = data_dir or os.environ.get("gate_parameters_dir", Datastore().derive("verilog"))
     extractor = DataExtractor(data_dir)
-    df = DataframeQuantizier(data=extractor.extract(), grid_size=grid_size)
-    energy_series = df.quantize(columns={"quantized_energy": "energy"}, inline=True)
-    delay_series = df.quantize(columns={"quantized_delay": "delay"}, axis=1, inline=True)
-    extractor.save(df, csv_file, txt_file)
-    return df, energy_series, delay_series
+    grid_size = tuple(grid_size) if grid_size is not None else None
+    digest = extractor.get_report_digest()
+    key = (digest, grid_size, quant_bits)
+    grid_name = "x".join(map(str, grid_size)) if grid_size is not None else "none"
+    cache_dir = Path(data_dir) / "gate_parameters" / f"{digest[:16]}.{grid_name}.{quant_bits}"
+    cached_csv_file = cache_dir / "gate_parameters.csv"
+    cached_txt_file = cache_dir / "gate_parameters.txt"
+
+    if key not in _gate_parameters:
+        cached = cached_csv_file.exists() and cached_txt_file.exists()
+        data = None
+        if cached:
+            try:
+                data = pd.read_csv(cached_csv_file, index_col=0, converters=_cached_converters, float_precision="round_trip")
+                print(f"loading gate parameters from {cache_dir}")
+            except (ValueError, ArithmeticError) as e:
+                print(f"warn: cannot load cached gate parameters {cached_csv_file}: {str(e)}")
+                cached = False
+        # quantization of the cached values yields the same quantizers and values as of the extracted ones
+        df = DataframeQuantizier(data=data if data is not None else extractor.extract(), grid_size=grid_size)
+        energy_series = df.quantize(columns={"quantized_energy": "energy"}, inline=True)
+        delay_series = df.quantize(columns={"quantized_delay": "delay"}, axis=1, inline=True)
+        if not cached:
+            _save_cache(extractor, df, cached_csv_file, cached_txt_file)
+        _gate_parameters[key] = df, energy_series, delay_series
+    else:
+        print(f"reusing gate parameters from {cache_dir}")
+
+    _link_file(cached_csv_file, csv_file)
+    blob_store = get_write_store()
+    if blob_store is not None:
+        blob_store.write_reference(txt_file, blob_store.put(cached_txt_file))
+    else:
+        _link_file(cached_txt_file, txt_file)
+    return _gate_parameters[key]
@@ -13,6 +13,7 @@
 # quantizer.py: Extended Pandas DataFrames by quantization functions.
 
 from decimal import Decimal
+import numpy as np
 import pandas as pd
 import math
 from typing import Any, Dict, Tuple, Optional, Union, Iterable
@@ -87,6 +88,43 @@ class Quantizier(object):
         result = int((Decimal(value) - self.min_value) / (self.max_value - self.min_value) * Decimal(self._quant_max))
         return result
     
+    def _quantize_values(self, values: Iterable[Union[Decimal, float]]) -> list:
+        # the same Decimal operations as quantize with constants evaluated once
+        min_value = self.min_value
+        value_range = self.max_value - self.min_value
+        quant_max = Decimal(self._quant_max)
+        return [int((Decimal(value) - min_value) / value_range * quant_max) for value in values]
+
+    def _dequantize_values(self, values: Iterable[int]) -> list:
+        min_value = self.min_value
+        value_range = self.max_value - self.min_value
+        quant_max = self._quant_max
+        return [(Decimal(value) / quant_max) * value_range + min_value for value in values]
+
+    def quantize_array(self, values: Iterable[Union[Decimal, float]]) -> np.ndarray:
+        """
+        Quantizes values in bulk. The result is identical to calling quantize on each value.
+
+        Args:
+            values (Iterable[Union[Decimal, float]]): The values to be quantized.
+
+        Returns:
+            np.ndarray: Object array of the quantized values.
+        """
+        return np.array(self._quantize_values(values), dtype=object)
+
+    def dequantize_array(self, values: Iterable[int]) -> np.ndarray:
+        """
+        Dequantizes values in bulk. The result is identical to calling dequantize on each value.
+
+        Args:
+            values (Iterable[int]): The values to be dequantized.
+
+        Returns:
+            np.ndarray: Object array of the dequantized values.
+        """
+        return np.array(self._dequantize_values(values), dtype=object)
+
     def dequantize(self, value: Union[Decimal, float]) -> float:
         """
         Dequantizes a value.
@@ -133,7 +171,7 @@ class QuantiziedSeries(Quantizier):
             Union[pd.Series, Decimal]: The quantized series or value.
         """        
         if value is None:
-            self.data = self.data.apply(self.quantize)
+            self.data = pd.Series(self._quantize_values(self.data), index=self.data.index, name=self.data.name)
             return self
         else:
             return super().quantize(value)
@@ -150,7 +188,7 @@ class QuantiziedSeries(Quantizier):
             Union[pd.Series, float]: The dequantized series or value.
         """        
         if value is None:
-            return self.data.apply(self.dequantize, inline=inline)
+            return pd.Series(self._dequantize_values(self.data), index=self.data.index, name=self.data.name)
         else:
             return super().dequantize(value)        
     
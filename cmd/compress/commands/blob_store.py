@@ -0,0 +1,396 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# blob_store.py: Content-addressed compressed store of datastore files replaced by .blobref references.
+
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import stat
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+reference_suffix = ".blobref"
+default_patterns = ["train.data", "gate_parameters.txt", "weights.*.txt"]
+
+def get_reference_file(path: Union[Path, str]) -> Path:
+    """
+    Gets path of the reference which replaces the file.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        Path: Path to the reference.
+    """
+    path = Path(path)
+    return path.with_name(path.name + reference_suffix)
+
+def read_reference(path: Union[Path, str]) -> Optional[dict]:
+    """
+    Reads the reference which replaces the file.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        Optional[dict]: The reference with sha256, size and codec of the blob or None if the file is not referenced.
+    """
+    reference_file = get_reference_file(path)
+    if not reference_file.exists():
+        return None
+    with open(reference_file, "r") as f:
+        return json.load(f)
+
+def get_file_digest(path: Union[Path, str]) -> str:
+    """
+    Gets SHA-256 digest of the file content without restoring files replaced by references.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    if not Path(path).exists():
+        reference = read_reference(path)
+        if reference is not None:
+            return reference["sha256"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BlobStore(object):
+    """
+    Store of file contents keyed by their SHA-256 digest. Identical files are stored once and
+    compressed by zstd when available, otherwise by gzip. Files are materialised as copies of a
+    decompressed copy of the blob, or optionally as hard links to it.
+
+    Attributes:
+        root (Path): Root directory of the store.
+        codec (str): Codec of newly stored blobs, either "zst" or "gz".
+        level (int): Compression level.
+    """
+    def __init__(self, root: Optional[Union[Path, str]] = None, codec: Optional[str] = None, level: Optional[int] = None) -> None:
+        """
+        Opens the store.
+
+        Args:
+            root (Optional[Union[Path, str]], optional): Root directory of the store. Defaults to the blob_store
+                environment variable or the blobs directory of the datastore.
+            codec (Optional[str], optional): Codec of new blobs. Defaults to zstd if installed, otherwise gzip.
+            level (Optional[int], optional): Compression level. Defaults to the codec default.
+
+        Raises:
+            ValueError: If the codec is unknown or not installed.
+        """
+        if root is None:
+            from commands.datastore import Datastore
+            root = os.environ.get("blob_store") or Datastore().derive("blobs")
+        self.root = Path(root)
+        self.codec = codec or ("zst" if zstandard is not None else "gz")
+        if self.codec not in ["zst", "gz"] or (self.codec == "zst" and zstandard is None):
+            raise ValueError(f"unsupported blob codec {self.codec}")
+        self.level = level if level is not None else (3 if self.codec == "zst" else 6)
+
+    def get_blob_path(self, digest: str, codec: str) -> Path:
+        """
+        Gets path of the compressed blob.
+
+        Args:
+            digest (str): SHA-256 digest of the content.
+            codec (str): Codec of the blob.
+
+        Returns:
+            Path: The blob path.
+        """
+        return self.root / "objects" / digest[:2] / f"{digest}.{codec}"
+
+    def get_raw_path(self, digest: str) -> Path:
+        """
+        Gets path of the decompressed copy of the blob which materialised files link to.
+
+        Args:
+            digest (str): SHA-256 digest of the content.
+
+        Returns:
+            Path: The decompressed blob path.
+        """
+        return self.root / "raw" / digest[:2] / digest
+
+    def _find_blob(self, digest: str) -> Optional[Path]:
+        return next((path for path in [self.get_blob_path(digest, codec) for codec in ["zst", "gz"]] if path.exists()), None)
+
+    def put(self, file: Union[Path, str]) -> dict:
+        """
+        Stores content of the file unless the same content is already stored.
+
+        Args:
+            file (Union[Path, str]): The file.
+
+        Returns:
+            dict: Reference of the blob.
+        """
+        digest = get_file_digest(file)
+        size = os.path.getsize(file)
+        blob = self._find_blob(digest)
+        if blob is None:
+            blob = self.get_blob_path(digest, self.codec)
+            blob.parent.mkdir(exist_ok=True, parents=True)
+            temporary_file = blob.with_name(blob.name + ".tmp")
+            with open(file, "rb") as source, open(temporary_file, "wb") as destination:
+                if self.codec == "zst":
+                    zstandard.ZstdCompressor(level=self.level).copy_stream(source, destination)
+                else:
+                    with gzip.GzipFile(fileobj=destination, mode="wb", compresslevel=self.level, mtime=0) as compressed:
+                        shutil.copyfileobj(source, compressed, 1 << 20)
+            os.replace(temporary_file, blob)
+        return {"sha256": digest, "size": size, "codec": blob.suffix[1:]}
+
+    def open(self, reference: dict) -> BinaryIO:
+        """
+        Opens the blob for streamed binary reading.
+
+        Args:
+            reference (dict): Reference of the blob.
+
+        Returns:
+            BinaryIO: The decompressed content.
+
+        Raises:
+            FileNotFoundError: If the blob is missing.
+        """
+        raw = self.get_raw_path(reference["sha256"])
+        if raw.exists():
+            return open(raw, "rb")
+        blob = self.get_blob_path(reference["sha256"], reference["codec"])
+        if reference["codec"] == "zst":
+            if zstandard is None:
+                raise ValueError(f"zstandard is required to read {blob}")
+            return zstandard.ZstdDecompressor().stream_reader(open(blob, "rb"), closefd=True)
+        return gzip.open(blob, "rb")
+
+    def write_reference(self, path: Union[Path, str], reference: dict):
+        """
+        Replaces the file by the reference of a stored blob. A file left at the path is removed,
+        so the reference is not shadowed by an outdated copy.
+
+        Args:
+            path (Union[Path, str]): Path to the file.
+            reference (dict): Reference of the blob returned by put.
+        """
+        reference_file = get_reference_file(path)
+        reference_file.parent.mkdir(exist_ok=True, parents=True)
+        temporary_file = reference_file.with_name(reference_file.name + ".tmp")
+        with open(temporary_file, "w") as f:
+            json.dump(reference, f)
+        os.replace(temporary_file, reference_file)
+        if Path(path).exists():
+            os.remove(path)
+
+    def add_reference(self, file: Union[Path, str]) -> dict:
+        """
+        Stores the file and replaces it by its reference.
+
+        Args:
+            file (Union[Path, str]): The file.
+
+        Returns:
+            dict: Reference of the blob.
+        """
+        reference = self.put(file)
+        self.write_reference(file, reference)
+        return reference
+
+    def materialize(self, path: Union[Path, str], link: bool = False, reference: Optional[dict] = None) -> Path:
+        """
+        Restores the referenced file. Hard links share the read-only decompressed blob with every other
+        materialised file of the same content, so they may only be used for files which are never written to.
+
+        Args:
+            path (Union[Path, str]): Path to the referenced file.
+            link (bool, optional): Whether to hard link the file instead of copying it. Defaults to False.
+            reference (Optional[dict], optional): Reference of the file, such as one read from an archive. Defaults to the reference next to the file.
+
+        Returns:
+            Path: The restored file.
+
+        Raises:
+            FileNotFoundError: If the file is not referenced.
+        """
+        path = Path(path)
+        if path.exists():
+            return path
+        reference = reference or read_reference(path)
+        if reference is None:
+            raise FileNotFoundError(path)
+
+        raw = self.get_raw_path(reference["sha256"])
+        if not raw.exists():
+            raw.parent.mkdir(exist_ok=True, parents=True)
+            temporary_file = raw.with_name(raw.name + f".{os.getpid()}.tmp")
+            with self.open(reference) as source, open(temporary_file, "wb") as destination:
+                shutil.copyfileobj(source, destination, 1 << 20)
+            os.chmod(temporary_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(temporary_file, raw)
+
+        # references read from archives restore files of directories which are not extracted
+        path.parent.mkdir(exist_ok=True, parents=True)
+        if link:
+            try:
+                os.link(raw, path)
+                return path
+            except OSError:
+                pass
+        shutil.copyfile(raw, path)
+        return path
+
+    def collect_garbage(self, roots: Optional[Iterable[Union[Path, str]]] = None, dry_run: bool = False, force: bool = False) -> int:
+        """
+        Removes blobs which are not referenced by any reference under the roots, including references stored
+        in zip archives. Migrated files are removed, so the blob is their only copy and the roots must cover
+        the whole datastore. Temporary files of blobs being stored or materialised are skipped.
+
+        Args:
+            roots (Optional[Iterable[Union[Path, str]]], optional): Directories searched for references. Defaults to the datastore.
+            dry_run (bool, optional): Whether to only report the unreferenced blobs. Defaults to False.
+            force (bool, optional): Whether to collect even if the roots do not cover the datastore. Defaults to False.
+
+        Returns:
+            int: Number of removed blobs.
+
+        Raises:
+            ValueError: If no roots are given and the datastore is not set, or the roots do not cover the datastore.
+        """
+        datastore = os.environ.get("datastore")
+        roots = list(roots or [])
+        if not roots:
+            if datastore is None:
+                raise ValueError("roots must be given when the datastore environment variable is not set")
+            roots = [datastore]
+        roots = [Path(root).resolve() for root in roots]
+        if not force and (datastore is None or not any(Path(datastore).resolve().is_relative_to(root) for root in roots)):
+            raise ValueError(f"roots do not cover the datastore {datastore}, blobs referenced only outside of them would be lost; use force to collect anyway")
+
+        referenced: Set[str] = set()
+        for root in roots:
+            for reference_file in Path(root).glob(f"**/*{reference_suffix}"):
+                with open(reference_file, "r") as f:
+                    referenced.add(json.load(f)["sha256"])
+            # archived experiments keep the references of their files
+            for archive in Path(root).glob("**/*.zip"):
+                with zipfile.ZipFile(archive) as f:
+                    for name in f.namelist():
+                        if name.endswith(reference_suffix):
+                            referenced.add(json.loads(f.read(name))["sha256"])
+
+        removed = 0
+        for directory in ["objects", "raw"]:
+            for blob in (self.root / directory).glob("*/*"):
+                if blob.name.endswith(".tmp"):
+                    continue
+                digest = blob.name.split(".")[0]
+                if digest not in referenced:
+                    print(f"removing unreferenced blob {blob}")
+                    if not dry_run:
+                        blob.chmod(stat.S_IWUSR | stat.S_IRUSR)
+                        blob.unlink()
+                    removed += 1
+        return removed
+
+    def migrate(self, root: Union[Path, str], patterns: List[str] = default_patterns, dry_run: bool = False) -> Dict[str, int]:
+        """
+        Replaces files under the root whose names match the patterns by references.
+
+        Args:
+            root (Union[Path, str]): Directory to migrate.
+            patterns (List[str], optional): File name patterns. Defaults to train data, gate parameters and weight files.
+            dry_run (bool, optional): Whether to only report the files. Defaults to False.
+
+        Returns:
+            Dict[str, int]: Number of migrated files, their total size and number of distinct contents.
+        """
+        files, size, digests = 0, 0, set()
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = Path(directory) / name
+                if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns) or path.is_relative_to(self.root):
+                    continue
+                files += 1
+                size += path.stat().st_size
+                if not dry_run:
+                    digests.add(self.add_reference(path)["sha256"])
+        print(f"migrated {files} files of {size} bytes into {len(digests)} blobs")
+        return {"files": files, "size": size, "blobs": len(digests)}
+
+def get_write_store() -> Optional[BlobStore]:
+    """
+    Gets the blob store which datastore files are written to. Writing through the store is enabled
+    by setting the blob_store environment variable to its root directory.
+
+    Returns:
+        Optional[BlobStore]: The store or None if files are written as plain files.
+    """
+    return BlobStore() if os.environ.get("blob_store") else None
+
+def store_file(path: Union[Path, str]) -> Path:
+    """
+    Replaces the written file by its reference if writing through the blob store is enabled.
+
+    Args:
+        path (Union[Path, str]): Path to the written file.
+
+    Returns:
+        Path: Path to the reference, or to the file if the blob store is not enabled.
+    """
+    blob_store = get_write_store()
+    if blob_store is None:
+        return Path(path)
+    blob_store.add_reference(path)
+    return get_reference_file(path)
+
+def migrate_datastore(root: str, patterns: Optional[List[str]] = None, store: Optional[str] = None, codec: Optional[str] = None, dry_run: bool = False, **kwargs):
+    """
+    Migrates an existing datastore tree to the blob store.
+
+    Args:
+        root (str): Directory to migrate.
+        patterns (Optional[List[str]], optional): File name patterns. Defaults to train data, gate parameters and weight files.
+        store (Optional[str], optional): Root directory of the blob store. Defaults to the blobs directory of the datastore.
+        codec (Optional[str], optional): Codec of new blobs. Defaults to zstd if installed, otherwise gzip.
+        dry_run (bool, optional): Whether to only report the files. Defaults to False.
+    """
+    BlobStore(store, codec=codec).migrate(root, patterns=patterns or default_patterns, dry_run=dry_run)
+
+def collect_datastore_garbage(roots: Optional[List[str]] = None, store: Optional[str] = None, dry_run: bool = False, force: bool = False, **kwargs):
+    """
+    Removes blobs which are not referenced under the roots.
+
+    Args:
+        roots (Optional[List[str]], optional): Directories searched for references. Defaults to the datastore.
+        store (Optional[str], optional): Root directory of the blob store. Defaults to the blobs directory of the datastore.
+        dry_run (bool, optional): Whether to only report the unreferenced blobs. Defaults to False.
+        force (bool, optional): Whether to collect even if the roots do not cover the datastore. Defaults to False.
+    """
+    removed = BlobStore(store).collect_garbage(roots, dry_run=dry_run, force=force)
+    print(f"removed {removed} unreferenced blobs")
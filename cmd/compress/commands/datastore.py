@@ -13,7 +13,279 @@
 # datastore.py: Data managment class for various experiment data.
 
 from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, TextIO, Tuple, Union
+import io
+import json
 import os
+import threading
+import zipfile
+from commands.blob_store import BlobStore, get_reference_file, read_reference, reference_suffix
+
+class ArchiveCatalog(object):
+    """
+    Catalog of files stored in a zip archive, built once from its central directory.
+    Members are opened for random access without extracting the archive.
+
+    Attributes:
+        archive (Path): Path to the archive.
+        members (Dict[str, zipfile.ZipInfo]): File members keyed by their name.
+        directories (Dict[str, List[str]]): Names of direct children keyed by directory, the root directory is "".
+        root (str): Directory holding the archived files, either the root or a directory named after the archive.
+    """
+    @staticmethod
+    def _add_suffixes(suffixes: Dict[str, Optional[str]], name: str):
+        # suffixes shared by more names are ambiguous and match nothing
+        parts = name.split("/")
+        for depth in range(1, len(parts)):
+            suffix = "/".join(parts[depth:])
+            suffixes[suffix] = name if suffixes.get(suffix, name) == name else None
+
+    def __init__(self, archive: Union[Path, str]) -> None:
+        """
+        Reads the central directory of the archive.
+
+        Args:
+            archive (Union[Path, str]): Path to the archive.
+        """
+        self.archive = Path(archive)
+        self._zip_file = zipfile.ZipFile(self.archive)
+        self.members: Dict[str, zipfile.ZipInfo] = {}
+        self.directories: Dict[str, List[str]] = {"": []}
+        for info in self._zip_file.infolist():
+            name = info.filename.rstrip("/")
+            if not info.is_dir():
+                self.members[name] = info
+            parts = name.split("/")
+            for depth in range(len(parts)):
+                parent, child = "/".join(parts[:depth]), parts[depth]
+                children = self.directories.setdefault(parent, [])
+                if child not in children:
+                    children.append(child)
+        # archives of a directory usually store it as their only top-level entry
+        self.root = self.archive.stem if self.directories[""] == [self.archive.stem] and self.archive.stem in self.directories else ""
+        self._member_suffixes: Dict[str, Optional[str]] = {}
+        self._directory_suffixes: Dict[str, Optional[str]] = {}
+        for name in self.members:
+            ArchiveCatalog._add_suffixes(self._member_suffixes, name)
+        for name in self.directories:
+            ArchiveCatalog._add_suffixes(self._directory_suffixes, name)
+
+    def _get_name(self, relative_path: str) -> str:
+        return "/".join([part for part in [self.root, relative_path] if part])
+
+    def find(self, relative_path: str) -> Optional[str]:
+        """
+        Finds member of the relative path. Archives may store the files directly or under
+        a directory named after the archive, so members are matched by the path suffix as well
+        unless more members share the suffix.
+
+        Args:
+            relative_path (str): Path relative to the archived directory in POSIX format. Empty path
+                selects the only member of single file archives.
+
+        Returns:
+            Optional[str]: The member name or None if the archive does not contain the file.
+        """
+        if relative_path == "":
+            return next(iter(self.members)) if len(self.members) == 1 else None
+        if self._get_name(relative_path) in self.members:
+            return self._get_name(relative_path)
+        return self._member_suffixes.get(relative_path)
+
+    def find_directory(self, relative_path: str) -> Optional[str]:
+        """
+        Finds directory of the relative path, matched in the same way as files.
+
+        Args:
+            relative_path (str): Path relative to the archived directory in POSIX format.
+
+        Returns:
+            Optional[str]: The directory name or None if the archive does not contain the directory.
+        """
+        if self._get_name(relative_path) in self.directories:
+            return self._get_name(relative_path)
+        return self._directory_suffixes.get(relative_path) if relative_path else None
+
+    def open(self, member: str) -> BinaryIO:
+        """
+        Opens the member for binary reading. The returned file supports seeking.
+
+        Args:
+            member (str): The member name.
+
+        Returns:
+            BinaryIO: The opened member.
+        """
+        return self._zip_file.open(self.members[member])
+
+    def extract(self, member: str, destination: Union[Path, str]) -> Path:
+        """
+        Extracts a single member to the destination file.
+
+        Args:
+            member (str): The member name.
+            destination (Union[Path, str]): Path of the extracted file.
+
+        Returns:
+            Path: The extracted file.
+        """
+        destination = Path(destination)
+        destination.parent.mkdir(exist_ok=True, parents=True)
+        temporary_file = destination.with_name(destination.name + ".tmp")
+        with self.open(member) as source, open(temporary_file, "wb") as f:
+            while chunk := source.read(1 << 20):
+                f.write(chunk)
+        os.replace(temporary_file, destination)
+        return destination
+
+_catalogs: Dict[Tuple[str, int, int], ArchiveCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+def get_archive_catalog(archive: Union[Path, str]) -> ArchiveCatalog:
+    """
+    Gets the catalog of the archive, which is cached while the archive does not change.
+
+    Args:
+        archive (Union[Path, str]): Path to the archive.
+
+    Returns:
+        ArchiveCatalog: The catalog.
+    """
+    stat = os.stat(archive)
+    key = (str(Path(archive).absolute()), stat.st_size, stat.st_mtime_ns)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = ArchiveCatalog(archive)
+        return _catalogs[key]
+
+def _find_archives(path: Path):
+    # the file itself or any of its parent directories may be stored as a sibling zip archive
+    for depth, ancestor in enumerate([path] + list(path.parents)):
+        archive = ancestor.with_name(ancestor.name + ".zip") if ancestor.name else None
+        if archive is not None and archive.is_file():
+            yield get_archive_catalog(archive), "/".join(path.parts[len(path.parts) - depth:])
+
+def find_archive_member(path: Union[Path, str]) -> Optional[Tuple[ArchiveCatalog, str]]:
+    """
+    Finds the archived copy of a file which does not exist on the file system.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        Optional[Tuple[ArchiveCatalog, str]]: The catalog and member name or None if the file is not archived.
+    """
+    for catalog, relative_path in _find_archives(Path(path)):
+        member = catalog.find(relative_path)
+        if member is not None:
+            return catalog, member
+    return None
+
+def _read_reference(path: Union[Path, str]) -> Optional[dict]:
+    # references are archived together with the rest of the experiment
+    reference = read_reference(path)
+    if reference is None:
+        found = find_archive_member(get_reference_file(path))
+        if found is not None:
+            catalog, member = found
+            with catalog.open(member) as f:
+                reference = json.load(f)
+    return reference
+
+def exists(path: Union[Path, str]) -> bool:
+    """
+    Checks whether the file exists on the file system, in the blob store or in an archive.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        bool: True if the file can be opened.
+    """
+    return Path(path).exists() or _read_reference(path) is not None or find_archive_member(path) is not None
+
+def open_file(path: Union[Path, str], mode: str = "r") -> Union[TextIO, BinaryIO]:
+    """
+    Opens the file from the file system or, when it does not exist, streams it from the blob store or an archive.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+        mode (str, optional): Reading mode, either "r" or "rb". Defaults to "r".
+
+    Returns:
+        Union[TextIO, BinaryIO]: The opened file.
+
+    Raises:
+        FileNotFoundError: If the file neither exists nor is archived.
+        ValueError: If the mode is not a reading mode.
+    """
+    if Path(path).exists():
+        return open(path, mode)
+    if mode not in ["r", "rb"]:
+        raise ValueError(f"archived file {path} can only be read, got mode {mode}")
+    reference = _read_reference(path)
+    if reference is not None:
+        f = BlobStore().open(reference)
+        return f if mode == "rb" else io.TextIOWrapper(f)
+    found = find_archive_member(path)
+    if found is None:
+        raise FileNotFoundError(path)
+    catalog, member = found
+    f = catalog.open(member)
+    return f if mode == "rb" else io.TextIOWrapper(f)
+
+def list_dir(path: Union[Path, str]) -> List[str]:
+    """
+    Lists the directory merging files on the file system with files of archived copies of the directory.
+    Files replaced by blob store references are listed under their original names.
+
+    Args:
+        path (Union[Path, str]): Path to the directory.
+
+    Returns:
+        List[str]: Names of the directory entries.
+
+    Raises:
+        FileNotFoundError: If the directory neither exists nor is archived.
+    """
+    path = Path(path)
+    strip_suffix = lambda name: name[:-len(reference_suffix)] if name.endswith(reference_suffix) else name
+    names = [strip_suffix(name) for name in os.listdir(path)] if path.is_dir() else []
+    found = path.is_dir()
+    for catalog, relative_path in _find_archives(path):
+        directory = catalog.find_directory(relative_path)
+        if directory is not None:
+            names += [strip_suffix(name) for name in catalog.directories[directory] if strip_suffix(name) not in names]
+            found = True
+    if not found:
+        raise FileNotFoundError(path)
+    return names
+
+def materialize(path: Union[Path, str]) -> Path:
+    """
+    Restores the file referenced in the blob store or extracts the archived file to its path, which is needed
+    by external programs such as the CGP binary.
+
+    Args:
+        path (Union[Path, str]): Path to the file.
+
+    Returns:
+        Path: The existing file.
+
+    Raises:
+        FileNotFoundError: If the file neither exists, is referenced nor is archived.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    reference = _read_reference(path)
+    if reference is not None:
+        return BlobStore().materialize(path, reference=reference)
+    found = find_archive_member(path)
+    if found is None:
+        raise FileNotFoundError(path)
+    catalog, member = found
+    return catalog.extract(member, path)
 
 class Datastore(object):
     """
@@ -91,3 +363,37 @@ class Datastore(object):
             Path: The path to the data directory.
         """        
         return self.derive_from_experiment(experiment)
+    def open(self, path: Union[Path, str], mode: str = "r") -> Union[TextIO, BinaryIO]:
+        """
+        Opens a file of the datastore, streaming it from an archive when it is not extracted.
+
+        Args:
+            path (Union[Path, str]): Path relative to the datastore or an absolute path.
+            mode (str, optional): Reading mode, either "r" or "rb". Defaults to "r".
+
+        Returns:
+            Union[TextIO, BinaryIO]: The opened file.
+        """
+        return open_file(self.path / path, mode)
+    def exists(self, path: Union[Path, str]) -> bool:
+        """
+        Checks whether a file of the datastore exists on the file system or in an archive.
+
+        Args:
+            path (Union[Path, str]): Path relative to the datastore or an absolute path.
+
+        Returns:
+            bool: True if the file can be opened.
+        """
+        return exists(self.path / path)
+    def list_dir(self, path: Union[Path, str]) -> List[str]:
+        """
+        Lists a directory of the datastore including its archived files.
+
+        Args:
+            path (Union[Path, str]): Path relative to the datastore or an absolute path.
+
+        Returns:
+            List[str]: Names of the directory entries.
+        """
+        return list_dir(self.path / path)
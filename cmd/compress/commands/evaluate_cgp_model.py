@@ -13,9 +13,12 @@
 # evaluate_cgp_model.py: Evaluate trained CGP chromosomes on local machine or using PBS. Primarily used
 # for determining model accuracy, losse and Top-5.
 
+import json
 import os
+import time
 from string import Template
 import pandas as pd
+from typing import Optional
 import seaborn as sns
 import commands.datastore as store
 import experiments.manager as experiments
@@ -26,6 +29,15 @@ from commands.factory.experiment import create_all_experiment, create_experiment
 from tqdm import tqdm
 from functools import partial
 from cgp.cgp_adapter import CGP
+from cgp.chromosome_dedup import ChromosomeDedupIndex
+from cgp.pareto import get_fronts
+from commands.shard_planner import load_manifest
+from commands.metrics_log import append_metrics_log, get_remaining_run_ids, read_metrics_log
+from cgp.cgp_statistics import STATISTICS_COLUMNS, sample_statistics
+from commands.statistics_store import StatisticsStore, load_statistics, open_statistics_store
+from models.reference_logits import ReferenceLogits
+from models.adapters.lenet_variant_evaluator import LeNetVariantEvaluator
+from tracing import estimate_memory, load_memory_profile, set_context
 
 def evaluate_cgp_model(args):
     """
@@ -82,6 +94,10 @@ def evaluate_model_metrics_pbs(
                         num_workers=14,
                         stats_format="statistics.{run}.csv.zip",
                         experiment_wildcard="*256_31",
+                        manifest=None,
+                        manifest_dir=None,
+                        memory_profile=None,
+                        memory_margin=1.25,
                         **kwargs
                         ):
     """
@@ -108,13 +124,39 @@ def evaluate_model_metrics_pbs(
         num_workers (int): The number of workers.
         stats_format (str): The format for statistics files.
         experiment_wildcard (str): The wildcard pattern for experiment selection.
+        manifest (Optional[str]): Path to plan.json created by model-metrics-plan. If set, one job is created
+            per shard and the job reads shard_{i}.txt manifest instead of modulo groups.
+        manifest_dir (Optional[str]): Directory holding the shard_{i}.txt manifests on remote. Defaults to
+            the directory of the plan, whose manifests must then exist.
+        memory_profile (Optional[str]): Path to the memory profile recorded by model-metrics with --trace-memory. If set,
+            memory of each job is estimated from peaks of its experiments and mem is used only for unprofiled jobs.
+        memory_margin (float): Multiplier of the profiled peak memory.
         **kwargs: Additional keyword arguments.
     """    
-    modulo_groups = [modulo_group] if modulo_group is not None else range(int(modulo))
+    profile = load_memory_profile(memory_profile) if memory_profile is not None else None
+    shard_items = {}
+    if manifest is not None:
+        with open(manifest) as f:
+            plan = json.load(f)
+        shard_count = plan["shards"]
+        for item, value in plan["items"].items():
+            shard_items.setdefault(value["shard"], []).append(item)
+        modulo = None
+        modulo_groups = [modulo_group] if modulo_group is not None else range(shard_count)
+        if manifest_dir is None:
+            manifest_dir = Path(manifest).parent.as_posix()
+            missing = [group for group in modulo_groups if not (Path(manifest_dir) / f"shard_{group}.txt").exists()]
+            if missing:
+                raise FileNotFoundError(f"shard manifests {missing} are missing in {manifest_dir}, set manifest_dir to their remote directory")
+    else:
+        modulo_groups = [modulo_group] if modulo_group is not None else range(int(modulo))
     for modulo_group in modulo_groups:
-        job_name = f"{experiment}_{model_name}_{modulo_group}_{modulo}"
+        job_name = f"{experiment}_{model_name}_{modulo_group}_{modulo}" if manifest is None else f"{experiment}_{model_name}_shard_{modulo_group}"
+        # modulo groups are resolved on the remote machine, so they are sized by the largest profiled experiment
+        job_mem = estimate_memory(profile, shard_items.get(modulo_group, []) if manifest is not None else None, margin=memory_margin, default=mem) if profile is not None else mem
+        print(f"{job_name}: mem={job_mem}")
         template_data = {
-            "machine": f"select=1:ncpus={cpu}:ompthreads={cpu}:mem={mem}:scratch_ssd={scratch_capacity}",
+            "machine": f"select=1:ncpus={cpu}:ompthreads={cpu}:mem={job_mem}:scratch_ssd={scratch_capacity}",
             "model_name": model_name,
             "model_path": model_path,
             "time_limit": time_limit,
@@ -138,8 +180,9 @@ def evaluate_model_metrics_pbs(
             "error_t": "uint64_t",
             "cflags": " ".join(["-D_DISABLE_ROW_COL_STATS", "-D_DEPTH_DISABLED"]),
             "dataset":  dataset,
-            "modulo":  modulo,
+            "modulo":  modulo if modulo is not None else "",
             "modulo_group":  modulo_group,
+            "manifest": f"{manifest_dir}/shard_{modulo_group}.txt" if manifest is not None else "",
         }
 
         pbs_file = f"{job_name}.pbs.sh"
@@ -163,7 +206,7 @@ def evaluate_model_metrics_pbs(
                     pbs_f.write(line)
         print("saved pbs file to: " + str(pbs_file))    
 
-columns_names = ["run", "generation", "timestamp", "error", "quantized_energy", "energy", "area", "quantized_delay", "delay", "depth", "gate_count", "chromosome"]
+columns_names = STATISTICS_COLUMNS
 
 def sample(top: int, f: str):
     """
@@ -176,42 +219,41 @@ def sample(top: int, f: str):
     Returns:
         pd.DataFrame: The sampled DataFrame.
     """    
-    df = pd.read_csv(f)
-    if "error" in df.columns.values:
-        return pd.concat([df[:-1].sample(n=top-1), df.tail(n=1)])
-    else:
-        df = pd.read_csv(f, names=columns_names)
-        return pd.concat([df[:-1].sample(n=top-1), df.tail(n=1)])
+    return sample_statistics(f, top, keep_last=True)
 
-def pick_top(top: int, f: str):
+def pick_top(top: int, f: str, store: Optional[StatisticsStore] = None):
     """
     Picks the top entries from a CSV file.
 
     Args:
         top (int): The number of top entries to pick.
         f (str): The path to the CSV file.
+        store (Optional[StatisticsStore], optional): The statistics store used if the file was converted. Defaults to None.
 
     Returns:
         pd.DataFrame: The DataFrame containing the top entries.
     """    
-    prev_chunk = pd.DataFrame()
-    last_chunk = pd.DataFrame()
-    
-    chunk = next(pd.read_csv(f, chunksize=2*top), None)
-    names = None
-    
-    if chunk is None:
+    df = load_statistics(f, rows=top, store=store)
+    if df.empty:
         raise ValueError(f"dataset is empty for {f}")
-    
-    if "error" not in chunk.columns.values:
-        names = columns_names
-    
-    for chunk in pd.read_csv(f, chunksize=2*top, names=names):
-        prev_chunk = last_chunk
-        last_chunk = chunk
-    
-    df = pd.concat([prev_chunk, last_chunk])
-    return df[-top:]
+    return df
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parses duration given in seconds or in HH:MM:SS format.
+
+    Args:
+        value (Optional[str]): The duration.
+
+    Returns:
+        Optional[float]: Number of seconds, or None if no duration is given.
+    """
+    if value is None:
+        return None
+    seconds = 0.0
+    for segment in str(value).split(":"):
+        seconds = seconds * 60 + float(segment)
+    return seconds
 
 def evaluate_model_metrics(args):
     """
@@ -220,15 +262,28 @@ def evaluate_model_metrics(args):
     Args:
         args: The arguments for creating and configuring the experiments.
     """    
-    experiment_list = args.experiment
+    experiment_list = load_manifest(args.shard_manifest) if args.shard_manifest else args.experiment
     only_weights = args.only_weights
     experiment = create_experiment(args, prepare=False)
     data_store = store.Datastore()
     data_store.init_experiment_path(experiment)
-    df_factory = pd.read_csv if args.top is None else partial(pick_top, args.top)
-    original_top = args.top
+    statistics_store = open_statistics_store()
+    df_factory = partial(load_statistics, store=statistics_store) if args.top is None else partial(pick_top, args.top, store=statistics_store)
+    fidelity = args.fidelity
+    variants_per_pass = args.variants_per_pass
+    dedup_index = ChromosomeDedupIndex()
+    pareto_first = args.pareto_first
+    budget_count = args.budget_count
+    budget_time = _parse_duration(args.budget_time)
+    deadline = time.monotonic() + budget_time if budget_time is not None else None
     kwargs = vars(args)
     del kwargs["top"]
+    del kwargs["fidelity"]
+    del kwargs["variants_per_pass"]
+    del kwargs["pareto_first"]
+    del kwargs["budget_count"]
+    del kwargs["budget_time"]
+    del kwargs["shard_manifest"]
 
     if not isinstance(experiment, experiments.MultiExperiment):
         experiment_list = [experiment]
@@ -239,10 +294,21 @@ def evaluate_model_metrics(args):
             if kwargs.get("rename", False):
                 print(f"skipping {x.get_name(depth=1)} because it was renamed")
                 continue
+            # peak memory is attributed to the experiment and used to size PBS jobs
+            set_context(experiment=x.get_name(depth=1))
+            # archived experiments are not extracted, only inputs of the CGP binary are
+            x.materialize_inputs()
             for run in (args.runs or x.get_number_of_train_statistic_file(fmt=args.statistics_file_format)):
+                if deadline is not None and time.monotonic() >= deadline:
+                    print(f"time budget exhausted, skipping {x.get_name(depth=1)} run {run}")
+                    continue
                 destination = data_store.derive_from_experiment(experiment) / "model_metrics" / (f"{args.dataset or 'default'}.{args.split or 'test'}." + (x.get_name(depth=1) + f".{run}.csv"))
+                context_digest = dedup_index.get_context_digest(x.train_weights, x.gate_parameters_file)
                 if destination.exists():
                     print(f"skipping {x.get_name(depth=1)} run {run}")
+                    if not only_weights:
+                        existing = pd.read_csv(destination).dropna(subset="chromosome")
+                        dedup_index.load(dedup_index.get_keys(context_digest, existing["chromosome"]), existing)
                     continue
                 print(f"evaluating {x.get_name(depth=1)} run {run}")
                 file = x.get_train_statistics(runs=run, fmt=args.statistics_file_format)[0]
@@ -260,8 +326,16 @@ def evaluate_model_metrics(args):
                 df["Top-1"] = None
                 df["Top-5"] = None
                 df["Loss"] = None        
+
+                # chromosomes already evaluated in other runs or experiments are not evaluated again
+                keys = dedup_index.get_keys(context_digest, df["chromosome"])
+                pending = df.loc[dedup_index.get_pending(keys) | only_weights, :].copy()
+                if pareto_first:
+                    # the best fronts are inferred and evaluated first so truncated jobs still yield useful fronts
+                    df["Front"] = get_fronts(df)
+                    pending = pending.loc[df.loc[pending.index, "Front"].sort_values(kind="stable").index, :]
+                print(f"evaluating {len(pending.index)} of {len(df.index)} chromosomes")
                 
-                top = original_top + 1 if original_top else len(df.index)
                 chromosomes_file = data_store.derive_from_experiment(x) / f"chromosomes.{run}.txt"
                 stats_file = data_store.derive_from_experiment(x) / "evaluate_statistics" /  f"statistics.{run}.csv"
                 weights_file = data_store.derive_from_experiment(x) / "all_weights" / (f"weights.{run}." + "{run}.txt")
@@ -272,58 +346,82 @@ def evaluate_model_metrics(args):
                 weights_file.parent.mkdir(exist_ok=True, parents=True)
                 gate_statistics.parent.mkdir(exist_ok=True, parents=True)
                 
-                with open(chromosomes_file, "w") as f:
-                    for _, row in df.iterrows():
-                        f.write(row["chromosome"] + "\n")
+                log_file = destination.with_name(destination.name + ".log")
+                chromosomes = "".join([chromosome + "\n" for chromosome in pending["chromosome"]])
+                resume = log_file.exists() and stats_file.exists() and chromosomes_file.exists() and chromosomes_file.read_text() == chromosomes
+                if resume:
+                    print(f"resuming {x.get_name(depth=1)} run {run} from {log_file}")
+                else:
+                    log_file.unlink(missing_ok=True)
+                    with open(chromosomes_file, "w") as f:
+                        f.write(chromosomes)
                 
-                x.evaluate_chromosomes(chromosomes_file, stats_file, weights_file, gate_statistics)        
+                    if not pending.empty:
+                        x.evaluate_chromosomes(chromosomes_file, stats_file, weights_file, gate_statistics)        
                 
                 if only_weights:
                     continue
-                
-                def run_identifier_iterator():
-                    for i in range(1, top, 1):
-                        current_path = Path(str(weights_file).format(run=i))
-                        
-                        if not current_path.exists():
-                            break
-                        
-                        yield i                   
-                
-                def weight_iterator():
-                    for i in run_identifier_iterator():
-                        current_path = Path(str(weights_file).format(run=i))
-                        yield x.get_weights(current_path)
-                
-                cached_top_k, cached_loss = None, None
-                top_1 = []; top_5 = []; losses = []; runs_id = [];
+
+                reference_logits = ReferenceLogits.load_or_create(x._model_adapter, **kwargs) if fidelity else None
                 fitness_values = ["error", "quantized_energy", "energy", "area", "quantized_delay", "delay", "depth", "gate_count", "chromosome"]
-                with tqdm(zip(weight_iterator(), df.iterrows(), pd.read_csv(stats_file).iterrows(), run_identifier_iterator()), unit="Record", total=len(df.index), leave=True) as records:
-                    for (weights, plans), (index, row), (eval_index, eval_row), run_id in records:
-                        df.loc[index, fitness_values] = eval_row[fitness_values]
-                        runs_id.append(run_id)
-                        print("start error:", row["error"], "new error:", eval_row["error"])  
-                        if False and eval_row["error"] == 0:
-                            if cached_top_k is None:
-                                cached_top_k, cached_loss = x.get_reference_model_metrics(cache=False, batch_size=None, top=[1, 5])
-                            top_1.append(cached_top_k[1])
-                            top_5.append(cached_top_k[5])
-                            losses.append(cached_loss)
-                        else:          
-                            print("error:", eval_row["error"])   
-                            if False and eval_row["error"] == 0:
-                                top_1.append(cached_top_k[1])
-                                top_5.append(cached_top_k[5])
-                                losses.append(cached_loss)
+
+                # weights and evaluation statistics are produced in the order of the chromosomes file
+                pending["Run ID"] = range(1, len(pending.index) + 1)
+                eval_df = pd.read_csv(stats_file) if not pending.empty else pd.DataFrame(columns=fitness_values)
+                eval_df.index = range(1, len(eval_df.index) + 1)
+                available = pending["Run ID"].map(lambda run_id: Path(str(weights_file).format(run=run_id)).exists())
+                pending = pending.loc[available & pending["Run ID"].isin(eval_df.index), :]
+                pending = pending.drop(columns=[column for column in fitness_values if column in pending.columns]).join(eval_df[fitness_values], on="Run ID")
+
+                remaining = get_remaining_run_ids(pending, read_metrics_log(log_file))
+                budget_exhausted = False
+                if budget_count is not None and len(remaining) > budget_count:
+                    # the count budget limits one invocation, the next one resumes from the log like after the time budget
+                    print(f"count budget exhausted, {x.get_name(depth=1)} run {run} will be resumed from Run ID {remaining[budget_count]}")
+                    remaining = remaining[:budget_count]
+                    budget_exhausted = True
+                variant_evaluator = LeNetVariantEvaluator(x._model_adapter) if variants_per_pass and LeNetVariantEvaluator.supports(x._model_adapter) else None
+                step = variants_per_pass if variant_evaluator is not None else 1
+                with open(log_file, "a") as log, tqdm(total=len(remaining), unit="Record", leave=True) as pbar:
+                    for start in range(0, len(remaining), step):
+                        batch = remaining[start:start+step]
+                        if deadline is not None and time.monotonic() >= deadline:
+                            print(f"time budget exhausted, {x.get_name(depth=1)} run {run} will be resumed from Run ID {batch[0]}")
+                            budget_exhausted = True
+                            break
+                        if variant_evaluator is not None:
+                            # every pass is logged, so a job stopped by the time budget keeps the computed results
+                            variant_evaluator.clear()
+                            for run_id in batch:
+                                variant_evaluator.add_variant(*x.get_weights(Path(str(weights_file).format(run=run_id))))
+                            results = variant_evaluator.evaluate(top=[1, 5], variants_per_pass=variants_per_pass, reference_logits=reference_logits, **kwargs)
+                            for run_id, result in zip(batch, results):
+                                append_metrics_log(log, run_id, *result)
+                        else:
+                            run_id = batch[0]
+                            weights, plans = x.get_weights(Path(str(weights_file).format(run=run_id)))
+                            if reference_logits is not None:
+                                top_k, loss, fidelity_metrics = x._model_adapter.inject_weights(weights, plans).evaluate(top=[1, 5], reference_logits=reference_logits, **kwargs)
+                                append_metrics_log(log, run_id, top_k, loss, fidelity_metrics)
                             else:
-                                model = x._model_adapter.inject_weights(weights, plans)
-                                top_k, loss = model.evaluate(top=[1, 5], **kwargs)
-                                top_1.append(top_k[1])
-                                top_5.append(top_k[5])
-                                losses.append(loss)
-                df["Top-1"] = top_1
-                df["Top-5"] = top_5
-                df["Loss"] = losses
-                df["Run ID"] = runs_id
-                destination.parent.mkdir(exist_ok=True, parents=True)                                                                                             
-                df.to_csv(destination, index=False)
\ No newline at end of file
+                                top_k, loss = x._model_adapter.inject_weights(weights, plans).evaluate(top=[1, 5], **kwargs)
+                                append_metrics_log(log, run_id, top_k, loss)
+                        pbar.update(len(batch))
+
+                metric_columns = ["Top-1", "Top-5", "Loss"] + (["Agreement", "KL Divergence", "Flips"] if reference_logits is not None else [])
+                pending = pending.drop(columns=["Top-1", "Top-5", "Loss"]).join(read_metrics_log(log_file)[metric_columns], on="Run ID", how="inner")
+                pending["Source"] = f"{x.get_name(depth=1)}/{run}"
+                result_columns = fitness_values + ["Top-1", "Top-5", "Loss", "Run ID", "Source"] + metric_columns[3:]
+                dedup_index.add(keys[pending.index], pending, result_columns)
+                df = dedup_index.fan_out(df, keys, result_columns)
+
+                # compaction of the log into the final results, partial results keep the log for resume
+                destination.parent.mkdir(exist_ok=True, parents=True)
+                output_file = destination.with_name(destination.stem + ".partial.csv") if budget_exhausted else destination
+                temporary_destination = output_file.with_name(output_file.name + ".tmp")
+                df.to_csv(temporary_destination, index=False)
+                os.replace(temporary_destination, output_file)
+                if not budget_exhausted:
+                    destination.with_name(destination.stem + ".partial.csv").unlink(missing_ok=True)
+                    log_file.unlink(missing_ok=True)
+    dedup_index.report()
\ No newline at end of file
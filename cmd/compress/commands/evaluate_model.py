@@ -16,6 +16,7 @@ from commands.datastore import Datastore
 from models.adapters.model_adapter import ModelAdapter
 from models.adapters.base import BaseAdapter
 from models.adapters.model_adapter_factory import create_adapter
+from models.reference_logits import ReferenceLogits
 from typing import Optional
 
 def get_model_adapter(model_name: str, model_path: Optional[str] = None) -> ModelAdapter:
@@ -32,7 +33,7 @@ def get_model_adapter(model_name: str, model_path: Optional[str] = None) -> Mode
     return BaseAdapter.load_base_model(model_name, model_path)
 
 
-def evaluate_base_model(model_name: str, model_path: str, archive=False, **kwargs):
+def evaluate_base_model(model_name: str, model_path: str, archive=False, store_reference_logits=False, **kwargs):
     """
     Evaluates a base model and optionally archives its state dictionary.
 
@@ -40,6 +41,7 @@ def evaluate_base_model(model_name: str, model_path: str, archive=False, **kwarg
         model_name (str): The name of the model to evaluate.
         model_path (str): The path to the model's state dictionary.
         archive (bool, optional): If True, saves the model's state dictionary to the datastore. Defaults to False.
+        store_reference_logits (bool, optional): If True, stores the model logits as reference for fidelity metrics. Defaults to False.
         **kwargs: Additional keyword arguments for the model's evaluate method.
 
     Returns:
@@ -59,7 +61,10 @@ def evaluate_base_model(model_name: str, model_path: str, archive=False, **kwarg
         save_path.parent.mkdir(exist_ok=True, parents=True)
         print(f"saved model to {save_path}")
         model.save(save_path)
-        
+
+    if store_reference_logits:
+        ReferenceLogits.create(model, **kwargs)
+
     acc, loss = model.evaluate(max_batches=None, **kwargs)
     print(acc, loss)
     return acc, loss
@@ -12,11 +12,17 @@
 # limitations under the License.
 # evaluate_model_sensitivity.py: Unused in thesis. These functions are related to quantization sensitivity.
 
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+import torch
+import torch.nn as nn
+import pandas as pd
 from commands.datastore import Datastore
+from models.adapters.model_adapter import ModelAdapter
 from models.adapters.model_adapter_factory import create_adapter
-from models.selector import FilterSelector, FilterSelectorCombinations, FilterSelectorCombination
+from models.adapters.lenet_variant_evaluator import LeNetVariantEvaluator
 from models.quantization import conv2d_outter, conv2d_core
-import pandas as pd
 
 selector_functions = {
     "inner": lambda filter_i, channel_i: conv2d_core([filter_i, channel_i], 5, 3),
@@ -24,7 +30,123 @@ selector_functions = {
     "all": lambda *_: [(slice(None), slice(None), slice(None), slice(None))]
 }
 
-def model_sensitivity(model_name=None, model_path=None, error_type = [], **kwargs):
+sensitivity_offsets = range(-128, 127, 1)
+
+def get_region_mask(weights: torch.Tensor, error_type: str) -> torch.Tensor:
+    """
+    Builds mask of the weights affected by the error type. The selector is applied to all filters
+    and channels at once instead of iterating over them.
+
+    Args:
+        weights (torch.Tensor): Weights of the convolution layer.
+        error_type (str): Key of the selector_functions.
+
+    Returns:
+        torch.Tensor: Boolean mask of the same shape as the weights.
+    """
+    mask = torch.zeros(weights.shape, dtype=torch.bool)
+    for selector in selector_functions[error_type](slice(None), slice(None)):
+        mask[selector] = True
+    return mask
+
+def shift_weights(weights: torch.Tensor, mask: torch.Tensor, offset: int) -> torch.Tensor:
+    """
+    Adds the offset to the integer representation of the masked quantized weights. Results are
+    saturated to the range of the integer representation and quantization parameters are kept.
+
+    Args:
+        weights (torch.Tensor): Quantized weights of the convolution layer.
+        mask (torch.Tensor): Mask of the weights to be shifted.
+        offset (int): The error offset.
+
+    Returns:
+        torch.Tensor: The shifted quantized weights.
+    """
+    integers = weights.int_repr()
+    limits = torch.iinfo(integers.dtype)
+    shifted = torch.where(mask, (integers.int() + offset).clamp(limits.min, limits.max), integers.int()).to(integers.dtype)
+    if weights.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+        return torch._make_per_channel_quantized_tensor(shifted, weights.q_per_channel_scales(), weights.q_per_channel_zero_points(), weights.q_per_channel_axis())
+    return torch._make_per_tensor_quantized_tensor(shifted, weights.q_scale(), weights.q_zero_point())
+
+def _get_layer_names(adapter: ModelAdapter) -> List[Tuple[str, nn.Module]]:
+    layers = list(adapter.get_convolution_layers())
+    return [(name, module) for name, module in adapter.model.named_modules() if any(module is layer for layer in layers)]
+
+def _read_checkpoint(checkpoint: Path) -> pd.DataFrame:
+    if not checkpoint.exists():
+        return pd.DataFrame()
+    try:
+        return pd.read_csv(checkpoint)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+def _append_checkpoint(checkpoint: Path, rows: List[list], columns: List[str]):
+    header = not checkpoint.exists() or checkpoint.stat().st_size == 0
+    with open(checkpoint, "a", newline="") as f:
+        pd.DataFrame(rows, columns=columns).to_csv(f, index=False, header=header)
+        f.flush()
+
+def _to_row(offset: int, result: tuple) -> Tuple[list, List[str]]:
+    top_k, loss = result[0], result[1]
+    top_k = top_k if isinstance(top_k, dict) else {1: top_k}
+    return [offset] + list(top_k.values()) + [loss], ["error"] + [f"top-{k}" for k in top_k.keys()] + ["loss"]
+
+def sweep_sensitivity(adapter: ModelAdapter, error_type: str, checkpoint: Path, offsets: Iterable[int] = sensitivity_offsets, variants_per_pass: int = 16, **kwargs) -> pd.DataFrame:
+    """
+    Evaluates the model with every offset added to the region of all convolution layers selected by the error type.
+    The original weights are read once, every offset is applied as a single masked tensor operation
+    and LeNet-5 models evaluate variants_per_pass offsets in one forward pass. Every evaluated pass
+    is appended to the checkpoint, so an interrupted sweep continues with the missing offsets.
+
+    Args:
+        adapter (ModelAdapter): Adapter of the quantized model, its weights are restored afterwards.
+        error_type (str): Key of the selector_functions.
+        checkpoint (Path): CSV file with partial results.
+        offsets (Iterable[int], optional): Error offsets to evaluate. Defaults to -128 to 126.
+        variants_per_pass (int, optional): Number of offsets evaluated in a single pass, 0 disables batching. Defaults to 16.
+        **kwargs: Additional keyword arguments for the evaluation.
+
+    Returns:
+        pd.DataFrame: Metrics of every offset sorted by the offset.
+    """
+    layers = _get_layer_names(adapter)
+    original_weights = dict([(name, adapter.get_weights(module).clone()) for name, module in layers])
+    masks = dict([(name, get_region_mask(weights, error_type)) for name, weights in original_weights.items()])
+    finished = _read_checkpoint(checkpoint)
+    finished_offsets = set(finished["error"].tolist()) if "error" in finished.columns else set()
+    remaining = [offset for offset in offsets if offset not in finished_offsets]
+    if finished_offsets:
+        print(f"resuming {error_type} sweep, {len(remaining)} offsets remaining")
+
+    def get_variant(offset: int) -> Dict[str, torch.Tensor]:
+        return dict([(name, shift_weights(weights, masks[name], offset)) for name, weights in original_weights.items()])
+
+    variant_evaluator = LeNetVariantEvaluator(adapter) if variants_per_pass and LeNetVariantEvaluator.supports(adapter) else None
+    try:
+        with torch.inference_mode():
+            if variant_evaluator is not None:
+                for start in range(0, len(remaining), variants_per_pass):
+                    chunk = remaining[start:start+variants_per_pass]
+                    variant_evaluator.clear()
+                    for offset in chunk:
+                        variant_evaluator.add_weights(get_variant(offset))
+                    results = variant_evaluator.evaluate(variants_per_pass=variants_per_pass, **kwargs)
+                    rows = [_to_row(offset, result) for offset, result in zip(chunk, results)]
+                    _append_checkpoint(checkpoint, [row for row, _ in rows], rows[0][1])
+            else:
+                for offset in remaining:
+                    variant = get_variant(offset)
+                    for name, module in layers:
+                        adapter.set_weights(module, variant[name])
+                    row, columns = _to_row(offset, adapter.evaluate(**kwargs))
+                    _append_checkpoint(checkpoint, [row], columns)
+    finally:
+        for name, module in layers:
+            adapter.set_weights(module, original_weights[name])
+    return _read_checkpoint(checkpoint).drop_duplicates(subset="error", keep="last").sort_values("error").reset_index(drop=True)
+
+def model_sensitivity(model_name=None, model_path=None, error_type = [], variants_per_pass: int = 16, **kwargs):
     """
     Evaluates the sensitivity of a model to various types of quantization errors.
 
@@ -32,47 +154,30 @@ def model_sensitivity(model_name=None, model_path=None, error_type = [], **kwarg
         model_name (str, optional): The name of the model.
         model_path (str, optional): The path to the model's state dictionary.
         error_type (list): A list of error types to test.
+        variants_per_pass (int, optional): Number of offsets evaluated in a single pass of LeNet-5 models. Defaults to 16.
         **kwargs: Additional keyword arguments for the evaluation.
 
-    Raises:
-        FileExistsError: If the destination file already exists.
-
     Notes:
-        This function creates a DataFrame containing the model's performance metrics for each error type
-        and saves it as a CSV file. The error types are defined in the `selector_functions` dictionary.
-    """    
+        This function creates a DataFrame containing the model's performance metrics for each error offset
+        and saves it as model.{error type}.256.csv. The error types are defined in the `selector_functions` dictionary.
+        Error types whose results exist are skipped, partially evaluated ones are resumed from their .partial.csv file.
+    """
     data_store = Datastore().derive(model_name)
-    state_dict_path = data_store / "state_dict.pth"
     data_store.mkdir(exist_ok=True, parents=True)
-    data = []
     adapter = create_adapter(model_name, model_path)
-    
-    if not state_dict_path.exists():
-        adapter.save(str(state_dict_path))
+
     for t in error_type:
-        selector_function = selector_functions[t]
-        dest = data_store / "model.{t}.256.csv"
-        
+        if t not in selector_functions:
+            raise ValueError(f"unknown error type {t}, expected one of {', '.join(selector_functions.keys())}")
+        dest = data_store / f"model.{t}.256.csv"
         if dest.exists():
-            raise FileExistsError(dest)
-        
-        for e in range(-128, 127, 1):
-            adapter = adapter.load(str(state_dict_path))
-            for layer in adapter.get_convolution_layers():
-                weights = adapter.get_train_weights(layer)
-                
-                for filter_i, filter_weights in enumerate(weights):
-                    for channel_i, channel_filters in enumerate(filter_weights):
-                        for selector in selector_function(filter_i, channel_i):
-                            weights[*selector] = weights[*selector] + e
-                
-                combinations = FilterSelectorCombinations()
-                combination = FilterSelectorCombination()
-                combination.add(FilterSelector(layer, [], [(slice(None), slice(None), slice(None), slice(None))]))
-                combinations.add(combination)
-                adapter.inject_weights([weights.flatten()], combinations, inline=True)
-            top_k, avg_loss = adapter.evaluate(**kwargs)
-            data.append([e] + list(top_k.values()) + [avg_loss])
-        
-        df = pd.DataFrame(data=data, columns=["error", "top-1", "top-5", "loss"])
-        df.to_csv(dest, index=False)
+            print(f"skipping {t}, {dest} already exists")
+            continue
+
+        checkpoint = dest.with_name(dest.stem + ".partial.csv")
+        df = sweep_sensitivity(adapter, t, checkpoint, variants_per_pass=variants_per_pass, **kwargs)
+        temporary_destination = dest.with_name(dest.name + ".tmp")
+        df.to_csv(temporary_destination, index=False)
+        os.replace(temporary_destination, dest)
+        if checkpoint.exists():
+            os.remove(checkpoint)
@@ -14,19 +14,11 @@
 
 import argparse
 import os
-from commands.debug_model import debug_model
+import sys
 import experiments.manager as experiments
-from commands.optimize_prepare_model import optimize_prepare_model
-from commands.fix_train_stats import fix_train_statistics
-from commands.optimize_model import optimize_model
-from commands.evaluate_cgp_model import evaluate_cgp_model, evaluate_model_metrics, evaluate_model_metrics_pbs
-from commands.train_model import train_model
-from commands.evaluate_model import evaluate_base_model
-from commands.evaluate_model_sensitivity import model_sensitivity
-from commands.quantize_model import quantize_model
 from cgp.cgp_configuration import CGPConfiguration
 from commands.datastore import Datastore
-from typing import List
+from typing import List, Optional
 
 
 experiment_commands = ["train", "train-pbs", "evaluate", "fix-train-stats", "model-metrics"]
@@ -65,6 +57,7 @@ def _register_model_commands(subparsers: argparse._SubParsersAction):
     evaluate_parser.add_argument("--num-proc", type=int, default=None, help="Proccesor count for dataset")
     evaluate_parser.add_argument("--dataset", help="Dataset to use", type=str)
     evaluate_parser.add_argument("--split", help="Split to use", type=str)
+    evaluate_parser.add_argument("--store-reference-logits", action="store_true", help="Store logits of the model as reference for fidelity metrics")
 
     # model:evaluate
     sensitivity_parser = subparsers.add_parser("model:sensitivity", help="Evaluate a model sensitivity")
@@ -77,6 +70,7 @@ def _register_model_commands(subparsers: argparse._SubParsersAction):
     sensitivity_parser.add_argument("--show-top-k", type=int, default=2, help="Number of top-k accuracies to display")
     sensitivity_parser.add_argument("--num-workers", type=int, default=None, help="Worker count for data loader")
     sensitivity_parser.add_argument("--num-proc", type=int, default=None, help="Proccesor count for dataset")
+    sensitivity_parser.add_argument("--variants-per-pass", type=int, default=16, help="Evaluate up to this many error offsets of LeNet-5 in a single forward pass, 0 disables batching")
 
     # model:quantize
     quantize_parser = subparsers.add_parser("model:quantize", help="Quantize a model")
@@ -110,14 +104,61 @@ def _register_model_commands(subparsers: argparse._SubParsersAction):
     parser.add_argument("--num-workers", type=int, default=14, help="Number of workers")
     parser.add_argument("--stats-format", type=str, default="statistics.{run}.csv.zip", help="Statistics format")
     parser.add_argument("--experiment-wildcard", type=str, default="*256_31", help="Experiment wildcard")
+    parser.add_argument("--manifest", type=str, default=None, help="Path to plan.json created by model-metrics-plan; one job is created per shard instead of modulo groups")
+    parser.add_argument("--manifest-dir", type=str, default=None, help="Remote directory holding the shard manifests; defaults to the directory of --manifest")
+    parser.add_argument("--memory-profile", type=str, default=None, help="Memory profile recorded by model-metrics with --trace-memory; memory of each job is estimated from its experiments")
+    parser.add_argument("--memory-margin", type=float, default=1.25, help="Multiplier of the profiled peak memory")
 
-def _register_experiment_commands(subparsers: argparse._SubParsersAction, experiment_names: List[str]):
+    # model-metrics-plan
+    plan_parser = subparsers.add_parser("model-metrics-plan", help="Plan cost-balanced shards of model evaluation")
+    plan_parser.add_argument("data_dir", help="Directory with experiment archives or directories")
+    plan_parser.add_argument("manifest_dir", help="Directory where shard manifests are saved; an existing plan is reused")
+    plan_parser.add_argument("--shards", type=int, required=True, help="Number of shards")
+    plan_parser.add_argument("--top", type=int, default=None, help="Number of evaluated rows per run")
+    plan_parser.add_argument("--stats-format", type=str, default="statistics.{run}.csv.zip", help="Statistics format")
+    plan_parser.add_argument("--results-dir", type=str, default=None, help="Directory with finished model metrics to be excluded")
+    plan_parser.add_argument("--evaluation-cost", type=float, default=1.0, help="Relative cost of a model evaluation")
+    plan_parser.add_argument("--inference-cost", type=float, default=1e-6, help="Relative cost of inferring one output for one dataset sample")
+
+    # statistics:convert
+    convert_parser = subparsers.add_parser("statistics:convert", help="Convert CGP train statistics to the Parquet statistics store")
+    convert_parser.add_argument("experiments_root", help="Directory containing the experiments")
+    convert_parser.add_argument("--store", type=str, default=None, help="Root directory of the statistics store")
+    convert_parser.add_argument("-s", "--statistics-format", type=str, default="statistics.{run}.csv", help="Format of the statistics file names")
+    convert_parser.add_argument("-f", "--force", action="store_true", help="Convert already converted files again")
+
+    # statistics:throughput
+    throughput_parser = subparsers.add_parser("statistics:throughput", help="Report generations and evaluations per second, time to the first feasible and the best solution of CGP runs")
+    throughput_parser.add_argument("experiments_root", help="Directory containing the experiments, e.g. of a multi experiment")
+    throughput_parser.add_argument("-s", "--statistics-format", type=str, default="statistics.{run}.csv", help="Format of the statistics file names")
+    throughput_parser.add_argument("-o", "--output", type=str, default=None, help="CSV file with metrics of each run")
+    throughput_parser.add_argument("--curves", type=str, default=None, help="CSV file with convergence curves of each run")
+    throughput_parser.add_argument("--chunk-size", type=int, default=100000, help="Number of statistics rows read at once")
+
+    # datastore:migrate
+    migrate_parser = subparsers.add_parser("datastore:migrate", help="Replace datastore files by references to the content-addressed blob store")
+    migrate_parser.add_argument("root", help="Directory to migrate")
+    migrate_parser.add_argument("--patterns", nargs="+", default=None, help="File name patterns, defaults to train data, gate parameters and weight files")
+    migrate_parser.add_argument("--store", type=str, default=None, help="Root directory of the blob store")
+    migrate_parser.add_argument("--codec", type=str, default=None, choices=["zst", "gz"], help="Codec of new blobs, zst if zstandard is installed")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="Only report the files")
+
+    # datastore:gc
+    gc_parser = subparsers.add_parser("datastore:gc", help="Remove blobs not referenced under the roots")
+    gc_parser.add_argument("roots", nargs="*", help="Directories searched for blob references, defaults to the datastore")
+    gc_parser.add_argument("--force", action="store_true", help="Collect even if the roots do not cover the datastore, blobs referenced only elsewhere are lost")
+    gc_parser.add_argument("--store", type=str, default=None, help="Root directory of the blob store")
+    gc_parser.add_argument("--dry-run", action="store_true", help="Only report the unreferenced blobs")
+
+def _register_experiment_commands(subparsers: argparse._SubParsersAction, experiment_names: List[str], requested_command: Optional[str] = None):
     """
     Registers experiment-related commands to the argument parser.
 
     Args:
         subparsers (argparse._SubParsersAction): The subparsers action object to register commands to.
         experiment_names (List[str]): A list of experiment names to register.
+        requested_command (Optional[str], optional): The only experiment command whose arguments are registered,
+            other commands are registered without arguments so that they are listed in the help. Defaults to None.
     """    
     help_train = "Train a new CGP model to infer mising convolution weights from CNN model. Weights are trained as they are defined by {experiment_name}."
     help_evaluate = "Evaluate CGP model perfomance such as MSE, Energy, Area, Delay, Depth, Gate count and CNN accuracy and loss. Weights are trained as they are defined by {experiment_name}."
@@ -125,6 +166,10 @@ def _register_experiment_commands(subparsers: argparse._SubParsersAction, experi
 
     for command, help in zip(experiment_commands, [help_train, help_metacentrum, help_evaluate, "", ""]):
         for experiment_name in experiment_names:
+            if requested_command != f"{experiment_name}:{command}":
+                # listed in the help, the arguments are registered only for the requested command
+                subparsers.add_parser(f"{experiment_name}:{command}", help=help.format(experiment_name=experiment_name))
+                continue
             experiment_parser = subparsers.add_parser(f"{experiment_name}:{command}", help=help.format(experiment_name=experiment_name))
             experiment_parser.add_argument("--cgp", help="Path to the CGP binary", type=str, default=os.environ.get("cgp", None), required=("cgp" not in os.environ and required_cgp[command]))
             experiment_parser.add_argument("--experiment", help="Specific sub-experiments", type=str, nargs="+", default=[])
@@ -137,6 +182,14 @@ def _register_experiment_commands(subparsers: argparse._SubParsersAction, experi
             experiment_group = experiment_parser.add_argument_group("Experiment")
             if command in ["train", "train-pbs"]:
                 experiment_group.add_argument("--experiment-env", help="Create a new isolated environment", nargs="?", default="experiment_results")
+                experiment_group.add_argument("--warm-start", action="store_true", help="Start the evolution from the best chromosome of a finished sibling experiment with the same train data")
+            if command == "train":
+                experiment_group.add_argument("--workers", type=int, default=1, help="Train runs by this many concurrent CGP processes")
+                experiment_group.add_argument("--threads", type=int, default=None, help="OpenMP threads of each CGP process, defaults to an equal share of the CPUs")
+                experiment_group.add_argument("--islands", type=int, default=None, help="Evolve this many islands, stored as runs, which exchange their best chromosomes after every epoch")
+                experiment_group.add_argument("--epoch", type=int, default=1000, help="Number of generations between migrations of islands")
+                experiment_group.add_argument("--topology", type=str, default="ring", choices=["ring", "full"], help="Migration topology of islands")
+                experiment_group.add_argument("--target-error", type=float, default=None, help="Stop the island evolution once an island reaches this error")
 
             if command == "model-metrics":
                 experiment_group.add_argument("--runs", help="Specific runs to evaluate", nargs="+", default=None)
@@ -150,6 +203,12 @@ def _register_experiment_commands(subparsers: argparse._SubParsersAction, experi
                 experiment_group.add_argument("--num-workers", type=int, default=None, help="Worker count for data loader")
                 experiment_group.add_argument("--num-proc", type=int, default=None, help="Proccesor count for dataset")
                 experiment_group.add_argument("-l", "--include-loss", action="store_true", help="Whether to include loss in evaluation")
+                experiment_group.add_argument("--fidelity", action="store_true", help="Compute agreement, KL divergence and per-class flips against the baseline model logits")
+                experiment_group.add_argument("--variants-per-pass", type=int, default=None, help="Evaluate up to this many LeNet-5 variants in a single forward pass using grouped convolutions")
+                experiment_group.add_argument("--shard-manifest", type=str, default=None, help="Evaluate only experiments listed in the shard manifest created by model-metrics-plan")
+                experiment_group.add_argument("--pareto-first", action="store_true", help="Evaluate chromosomes front by front, starting with the non-dominated set over error, energy, delay and gate count")
+                experiment_group.add_argument("--budget-count", type=int, default=None, help="Evaluate at most this many chromosomes per run in one invocation; partial results are saved and resumed later")
+                experiment_group.add_argument("--budget-time", type=str, default=None, help="Stop evaluation after this time, in seconds or HH:MM:SS; partial results are saved and resumed later")
                 
                 if experiment_name == "mobilenet":
                     experiment_group.add_argument("--rename", action="store_true", help="Whether to only rename old experiment format")
@@ -165,15 +224,41 @@ def _register_experiment_commands(subparsers: argparse._SubParsersAction, experi
 
             experiment_parser.set_defaults(factory=experiments.get_experiment_factory(experiment_name), experiment_name=experiment_name)
 
-def register_commands(parser: argparse._SubParsersAction):
+global_value_options = ["--trace", "--trace-memory"]
+
+def get_requested_command(argv: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Finds the command name in the command line arguments without parsing them.
+
+    Args:
+        argv (Optional[List[str]], optional): The command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        Optional[str]: The command name or None if no command is given.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    skip = False
+    for arg in argv:
+        if not skip and not arg.startswith("-"):
+            return arg
+        # values of global options precede the command
+        skip = arg in global_value_options
+    return None
+
+def register_commands(parser: argparse._SubParsersAction, argv: Optional[List[str]] = None):
     """
-    Registers all commands to the argument parser.
+    Registers all commands to the argument parser. Arguments of experiment commands are registered only
+    for the requested command, which keeps the help and simple commands fast.
 
     Args:
         parser (argparse._SubParsersAction): The argument parser to register commands to.
+        argv (Optional[List[str]], optional): The command line arguments to be parsed. Defaults to sys.argv[1:].
     """    
+    parser.add_argument("--trace", type=str, default=None, help="Record tracing spans, print per-stage summary and save Chrome trace JSON to the file; the cgp_trace environment variable does the same")
+    parser.add_argument("--trace-memory", type=str, default=None, help="Record peak memory of stages, experiments and CGP processes and save the memory profile to the file; the cgp_memory_profile environment variable does the same")
+    parser.add_argument("--trace-tensors", action="store_true", default=False, help="Record the largest tensor allocations of stages by the torch profiler; the cgp_memory_tensors=1 environment variable does the same")
     subparsers = parser.add_subparsers(dest="command")
-    _register_experiment_commands(subparsers, experiments.experiments_classes.keys())
+    _register_experiment_commands(subparsers, experiments.get_experiment_names(), requested_command=get_requested_command(argv))
     _register_model_commands(subparsers)
 
 def dispatch(args):
@@ -189,37 +274,68 @@ def dispatch(args):
     Raises:
         ValueError: If the command is invalid or unknown.
     """    
+    if getattr(args, "trace", None) is not None:
+        import tracing
+        tracing.enable(args.trace)
+    if getattr(args, "trace_memory", None) is not None or getattr(args, "trace_tensors", False):
+        import tracing
+        tracing.enable_memory(args.trace_memory, tensors=args.trace_tensors)
     try:
         colon = args.command.index(":")
         experiment_name, command = args.command[:colon], args.command[colon+1:]
         print(experiment_name, command)
-        if experiment_name == "model":
+        if experiment_name in ["model", "statistics", "datastore"]:
             raise ValueError(f"invalid experiment name {experiment_name}")
         if command == "train":
+            from commands.optimize_model import optimize_model
             return lambda: optimize_model(args)
         if command == "train-pbs":
+            from commands.optimize_prepare_model import optimize_prepare_model
             return lambda: optimize_prepare_model(args)
         if command == "evaluate":
+            from commands.evaluate_cgp_model import evaluate_cgp_model
             return lambda: evaluate_cgp_model(args)
         if command == "fix-train-stats":
+            from commands.fix_train_stats import fix_train_statistics
             return lambda: fix_train_statistics(args)
         if command == "model-metrics":
+            from commands.evaluate_cgp_model import evaluate_model_metrics
             return lambda: evaluate_model_metrics(args)
         else:
             raise ValueError(f"unknown commmand {args.command}")
     except ValueError as e:
         if args.command == "model:train":
+            from commands.train_model import train_model
             return lambda: train_model(args.model_name, args.model_path, args.base)
         elif args.command == "model:evaluate":
+            from commands.evaluate_model import evaluate_base_model
             return lambda: evaluate_base_model(**vars(args))
         elif args.command == "model:sensitivity":
+            from commands.evaluate_model_sensitivity import model_sensitivity
             return lambda: model_sensitivity(**vars(args))
         elif args.command == "model:quantize":
+            from commands.quantize_model import quantize_model
             return lambda: quantize_model(args.model_name, args.model_path, args.new_path)
         elif args.command == "model:debug":
+            from commands.debug_model import debug_model
             return lambda: debug_model(args.model_name, args.model_path)
         elif args.command == "model-metrics-pbs":
+            from commands.evaluate_cgp_model import evaluate_model_metrics_pbs
             return lambda: evaluate_model_metrics_pbs(**vars(args))
+        elif args.command == "model-metrics-plan":
+            from commands.shard_planner import plan_model_metrics
+            return lambda: plan_model_metrics(**vars(args))
+        elif args.command == "statistics:convert":
+            from commands.statistics_store import convert_statistics
+            return lambda: convert_statistics(**vars(args))
+        elif args.command == "statistics:throughput":
+            from commands.throughput_report import report_throughput
+            return lambda: report_throughput(**vars(args))
+        elif args.command == "datastore:migrate":
+            from commands.blob_store import migrate_datastore
+            return lambda: migrate_datastore(**vars(args))
+        elif args.command == "datastore:gc":
+            from commands.blob_store import collect_datastore_garbage
+            return lambda: collect_datastore_garbage(**vars(args))
         else:
             print("Invalid command. Use --help for usage information.")
-            print(e)
\ No newline at end of file
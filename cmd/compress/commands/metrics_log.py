@@ -0,0 +1,78 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# metrics_log.py: Append-only log of model metrics used to resume interrupted evaluation of chromosomes.
+
+import json
+import os
+from pathlib import Path
+from typing import List
+import pandas as pd
+
+metrics_log_columns = ["Run ID", "Top-1", "Top-5", "Loss", "Agreement", "KL Divergence", "Flips"]
+
+def append_metrics_log(log, run_id: int, top_k: dict, loss: float, fidelity_metrics: dict = None):
+    """
+    Appends metrics of an evaluated chromosome to the log and flushes it.
+
+    Args:
+        log: The opened log file.
+        run_id (int): Run ID of the chromosome.
+        top_k (dict): Top-k accuracies.
+        loss (float): The loss.
+        fidelity_metrics (dict, optional): Fidelity metrics. Defaults to None.
+    """
+    record = {"Run ID": run_id, "Top-1": float(top_k[1]), "Top-5": float(top_k[5]), "Loss": float(loss)}
+    if fidelity_metrics is not None:
+        record["Agreement"] = fidelity_metrics["agreement"]
+        record["KL Divergence"] = fidelity_metrics["kl_divergence"]
+        record["Flips"] = " ".join(map(str, fidelity_metrics["flips"]))
+    log.write(json.dumps(record) + "\n")
+    log.flush()
+
+def read_metrics_log(log_file: Path) -> pd.DataFrame:
+    """
+    Reads metrics log indexed by Run ID. An incomplete last line left by a killed job is ignored
+    and truncated so new records can be appended. A Run ID logged more than once keeps its last record.
+
+    Args:
+        log_file (Path): The log file.
+
+    Returns:
+        pd.DataFrame: Logged metrics.
+    """
+    records = []
+    if log_file.exists():
+        complete_size = 0
+        with open(log_file, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                records.append(json.loads(line))
+                complete_size += len(line)
+        if complete_size != log_file.stat().st_size:
+            os.truncate(log_file, complete_size)
+    df = pd.DataFrame(records, columns=metrics_log_columns).drop_duplicates(subset="Run ID", keep="last")
+    return df.set_index("Run ID")
+
+def get_remaining_run_ids(pending: pd.DataFrame, completed: pd.DataFrame) -> List[int]:
+    """
+    Gets Run IDs of pending chromosomes which are not logged yet, in the order of the pending chromosomes.
+
+    Args:
+        pending (pd.DataFrame): Chromosomes to evaluate with the Run ID column.
+        completed (pd.DataFrame): Metrics log returned by read_metrics_log.
+
+    Returns:
+        List[int]: Run IDs to evaluate.
+    """
+    return pending.loc[~pending["Run ID"].isin(completed.index), "Run ID"].tolist()
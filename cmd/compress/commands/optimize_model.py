@@ -14,6 +14,8 @@
 
 from commands.factory.experiment import create_all_experiment
 from experiments.experiment import MissingChromosomeError
+from experiments.island_model import IslandModel
+from tracing import set_context
 
 def optimize_model(args):
     """
@@ -23,16 +25,18 @@ def optimize_model(args):
         args: Parsed command-line arguments containing the necessary parameters for the optimization process.
 
     Workflow:
-        1. Creates all experiments based on the provided arguments.
+        1. Creates all experiments based on the provided arguments, seeded from a finished sibling experiment if --warm-start is set.
         2. Checks if the experiment has already completed the desired number of runs.
         3. If the experiment has not completed, it resumes training from the last run if applicable.
         4. Handles cases where the chromosome file is missing and continues training.
-        5. Trains the experiment using the CGP algorithm.
+        5. Trains the experiment using the CGP algorithm, runs are trained by concurrent processes if --workers is set
+           or evolved as islands exchanging their best chromosomes if --islands is set.
     """    
     for experiment in create_all_experiment(args):
         # experiment.config.set_start_run(args.start_run)
         # experiment.config.set_start_generation(args.start_generation)
-        experiment = experiment.get_isolated_train_env(args.experiment_env)
+        experiment = experiment.get_isolated_train_env(args.experiment_env, warm_start=args.warm_start)
+        set_context(experiment=experiment.get_name())
         last_run = experiment.get_number_of_experiment_results()
         
         if last_run == experiment.config.get_number_of_runs():
@@ -45,4 +49,10 @@ def optimize_model(args):
         except MissingChromosomeError:
             pass
             
-        experiment.train_cgp()
+        if args.islands:
+            IslandModel(experiment, args.islands, args.epoch, topology=args.topology, threads=args.threads, target_error=args.target_error).run()
+        # a run resumed from a generation is trained by a single process
+        elif args.workers > 1 and not (experiment.config.has_start_generation() and experiment.config.get_start_generation() != 0):
+            experiment.train_cgp_fanout(args.workers, threads=args.threads)
+        else:
+            experiment.train_cgp()
@@ -13,6 +13,7 @@
 # optimize_prepare_model.py: Prepare required PBS scripts for CGP circuit training.
 
 from commands.factory.experiment import create_all_experiment
+from tracing import load_memory_profile
 
 def optimize_prepare_model(args):
     """
@@ -24,16 +25,17 @@ def optimize_prepare_model(args):
     Workflow:
         1. Creates all experiments based on the provided arguments.
         2. Configures the start run and start generation if not already set.
-        3. Sets up an isolated training environment with relative paths.
+        3. Sets up an isolated training environment with relative paths, seeded from a finished sibling experiment if --warm-start is set.
         4. Ensures that either the population_max or cpu argument is provided and sets them accordingly.
         5. Sets up the PBS job for training with the specified parameters.
     """    
+    memory_profile = load_memory_profile(args.memory_profile) if args.memory_profile is not None else None
     for experiment in create_all_experiment(args):
         if not experiment.config.has_start_run():
             experiment.config.set_start_run(args.start_run)
         if not experiment.config.has_start_generation():
             experiment.config.set_start_generation(args.start_generation)
-        experiment = experiment.get_isolated_train_env(args.experiment_env, relative_paths=True)
+        experiment = experiment.get_isolated_train_env(args.experiment_env, relative_paths=True, warm_start=args.warm_start)
         cpu = args.cpu
         if not experiment.config.has_population_max() and cpu is None:
             raise ValueError("population_max or cpu argument is needed in order to create pbs job")
@@ -52,5 +54,8 @@ def optimize_prepare_model(args):
             cgp_folder=args.cgp_folder,
             cpu=cpu,
             mem=args.mem,
-            scratch_capacity=args.scratch_capacity)
+            scratch_capacity=args.scratch_capacity,
+            blob_store_folder=args.blob_store_folder,
+            memory_profile=memory_profile,
+            memory_margin=args.memory_margin)
                                        
\ No newline at end of file
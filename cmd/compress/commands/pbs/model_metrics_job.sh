@@ -31,6 +31,7 @@ export CXXFLAGS_EXTRA="$cflags"
 export DATASET=$dataset
 export MODULO=$modulo
 export MODULO_GROUP=$modulo_group
+export MANIFEST=$manifest
 # PYTHON TEMPLATE END
 
 # test if scratch directory is set
@@ -57,20 +58,20 @@ mamba activate $SCRATCHDIR/masters || { echo >&2 "Could not activate python env"
 rm -rf $SCRATCHDIR/compress_py/data_store/$EXPERIMENT || { echo >&2 "Could not delete $SCRATCHDIR/compress_py/data_store/$EXPERIMENT"; exit 1; }
 mkdir -p $SCRATCHDIR/compress_py/data_store/$EXPERIMENT || { echo >&2 "Could not mkdir $SCRATCHDIR/compress_py/data_store/$EXPERIMENT"; exit 1; }
 
-if [ ! -z "$MODULO" ]; then
-# Copy relevant experiments and extract them
+if [ ! -z "$MANIFEST" ]; then
+# Copy experiments listed in the shard manifest, archives are read without extraction
+for file in $(cat "$MANIFEST" | tr '\n' ' '); do
+    cp $DATA_DIR/$file $SCRATCHDIR/compress_py/data_store/$EXPERIMENT || { echo >&2 "Could not copy $file from $DATA_DIR/"; exit 4; }
+done
+cp $MANIFEST $SCRATCHDIR/shard_manifest.txt || { echo >&2 "Could not copy $MANIFEST"; exit 4; }
+SHARD_ARGUMENTS="--shard-manifest $SCRATCHDIR/shard_manifest.txt"
+elif [ ! -z "$MODULO" ]; then
+# Copy relevant experiments, archives are read without extraction
 for file in $(ls -A "$DATA_DIR" | awk "NR % $MODULO == $MODULO_GROUP" | tr '\n' ' '); do
     cp $DATA_DIR/$file $SCRATCHDIR/compress_py/data_store/$EXPERIMENT || { echo >&2 "Could not copy $file from $DATA_DIR/"; exit 4; }
-    cd $SCRATCHDIR/compress_py/data_store/$EXPERIMENT && unzip $file || { echo >&2 "Could not unzip $file at $SCRATCHDIR/compress_py/data_store/$EXPERIMENT"; exit 4; }
-    rm $file
 done
 else
     cp $DATA_DIR/*.zip $SCRATCHDIR/compress_py/data_store/$EXPERIMENT || { echo >&2 "Could not copy *.zip from $DATA_DIR/"; exit 4; }
-    cd $SCRATCHDIR/compress_py/data_store/$EXPERIMENT
-    for file in *.zip; do
-        unzip $file
-        rm $file
-    done
 fi
 
 # Copy python worksapce and delete any remaining experiments
@@ -83,7 +84,7 @@ cp -r $RESULT_DIR/model_metrics $SCRATCHDIR/compress_py/data_store/$EXPERIMENT |
 cd $SCRATCHDIR/$SCRATCH_CWD || { echo >&2 "Error while moving to the experiment dir $SCRATCHDIR/compress_py!"; exit 3; }
 echo -e "pbs_server=$SERVER\npbs_username=$USERNAME\ndatastore=$SCRATCHDIR/compress_py/data_store\ncgp=$SCRATCHDIR/$CGP_CPP_PROJECT/$CGP_BINARY_SRC\nhuggingface=$HF_TOKEN\nTQDM_DISABLE=1\n" > .env || { echo >&2 "Could not create .env file"; exit 3; }
 
-python ./compress.py $EXPERIMENT:model-metrics $MODEL_NAME $MODEL_PATH --experiment $EXPERIMENT_WILDCARD  -s $STATS_FORMAT --top 1 --num-workers $NUM_WORKERS --num-proc $NUM_PROC --batch-size $BATCH_SIZE --include-loss 2>> stderr.log 1>> stdout.log || { echo >&2 "Calculation ended up erroneously (with a code $?) !!"; exit 3; }
+python ./compress.py $EXPERIMENT:model-metrics $MODEL_NAME $MODEL_PATH --experiment $EXPERIMENT_WILDCARD $SHARD_ARGUMENTS -s $STATS_FORMAT --top 1 --num-workers $NUM_WORKERS --num-proc $NUM_PROC --batch-size $BATCH_SIZE --include-loss 2>> stderr.log 1>> stdout.log || { echo >&2 "Calculation ended up erroneously (with a code $?) !!"; exit 3; }
 # python ./compress.py $EXPERIMENT:model-metrics $MODEL_NAME $MODEL_PATH --experiment $EXPERIMENT_WILDCARD  -s $STATS_FORMAT --top 1 --num-workers 14 --num-proc 1 --batch-size 2048 --include-loss 2>> stderr.log 1>> stdout.log || { echo >&2 "Calculation ended up erroneously (with a code $?) !!"; exit 3; }
 # move the output to user's DATADIR or exit in case of failure
 cp -r $SCRATCHDIR/compress_py/data_store/$EXPERIMENT/* $RESULT_DIR/GROUP_$MODULO_GROUP || { echo >&2 "Result file(s) copying failed (with a code $?) !!"; exit 4; }
@@ -0,0 +1,205 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# shard_planner.py: Cost-balanced sharding of model metrics evaluation into stable job manifests.
+
+import json
+import os
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Union
+from parse import parse
+
+def _parse_config(lines: Iterable[str]) -> Dict[str, str]:
+    attributes = {}
+    for line in lines:
+        line = line.strip()
+        if line != "" and ":" in line:
+            colon_index = line.index(":")
+            attributes[line[:colon_index].strip()] = line[colon_index+1:].strip()
+    return attributes
+
+def _get_run(file_name: str, stats_format: str) -> Optional[int]:
+    for fmt in [stats_format, stats_format[:-len(".zip")] if stats_format.endswith(".zip") else stats_format + ".zip"]:
+        result = parse(fmt, file_name)
+        if result is not None:
+            return int(result["run"])
+    return None
+
+def get_item_info(item: Union[Path, str], stats_format: str = "statistics.{run}.csv.zip") -> dict:
+    """
+    Reads information needed for cost estimation of an experiment stored as a directory or zip archive.
+
+    Args:
+        item (Union[Path, str]): The experiment directory or archive.
+        stats_format (str, optional): Format of the statistics file names. Defaults to "statistics.{run}.csv.zip".
+
+    Returns:
+        dict: Experiment name, its train configuration and uncompressed sizes of statistics files keyed by run.
+    """
+    item = Path(item)
+    config = {}
+    statistics = {}
+    if item.suffix == ".zip":
+        with zipfile.ZipFile(item) as archive:
+            for info in archive.infolist():
+                name = Path(info.filename)
+                if name.name == "train_cgp.config" and not config:
+                    config = _parse_config(archive.read(info).decode().splitlines())
+                elif name.parent.name == "fitness" and _get_run(name.name, stats_format) is not None:
+                    statistics[_get_run(name.name, stats_format)] = info.file_size
+    else:
+        config_files = list(item.glob("**/train_cgp.config"))
+        if config_files:
+            with open(config_files[0]) as f:
+                config = _parse_config(f)
+        for file in item.glob("**/train_statistics/fitness/*"):
+            run = _get_run(file.name, stats_format)
+            if run is not None:
+                statistics[run] = file.stat().st_size
+    return {"name": item.stem if item.suffix == ".zip" else item.name, "config": config, "statistics": statistics}
+
+def estimate_cost(info: dict, top: Optional[int] = None, evaluation_cost: float = 1.0, inference_cost: float = 1e-6) -> float:
+    """
+    Estimates cost of evaluating all runs of an experiment. Every evaluated row costs one model
+    evaluation plus weight inference proportional to the layer output size and the dataset size.
+    Row counts are estimated from statistics file sizes and the chromosome length.
+
+    Args:
+        info (dict): Experiment information returned by get_item_info.
+        top (Optional[int], optional): Number of rows evaluated per run, all rows if None. Defaults to None.
+        evaluation_cost (float, optional): Relative cost of a model evaluation. Defaults to 1.0.
+        inference_cost (float, optional): Relative cost of inferring one output value for one dataset sample. Defaults to 1e-6.
+
+    Returns:
+        float: The estimated cost.
+    """
+    config = info["config"]
+    output_count = int(config.get("output_count", 1))
+    dataset_size = int(config.get("dataset_size", 1))
+    gate_count = int(config.get("row_count", 1)) * int(config.get("col_count", 1))
+    row_size = 16 * gate_count + 8 * output_count + 128
+    cost = 0.0
+    for size in info["statistics"].values():
+        rows = max(1, size // row_size)
+        rows = min(rows, top) if top is not None else rows
+        cost += rows * (evaluation_cost + inference_cost * output_count * dataset_size)
+    return cost
+
+def plan_shards(costs: Dict[str, float], shard_count: int, previous_plan: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    """
+    Assigns items to shards by longest processing time first. Items assigned by the previous plan
+    keep their shard, so finished work of unchanged shards stays valid across replans.
+
+    Args:
+        costs (Dict[str, float]): Estimated cost of each item.
+        shard_count (int): Number of shards.
+        previous_plan (Optional[Dict[str, int]], optional): Previous assignment of items to shards. Defaults to None.
+
+    Returns:
+        Dict[str, int]: Shard index of each item.
+    """
+    plan = {}
+    loads = [0.0] * shard_count
+    for item, shard in (previous_plan or {}).items():
+        if item in costs and shard < shard_count:
+            plan[item] = shard
+            loads[shard] += costs[item]
+
+    for item in sorted([item for item in costs if item not in plan], key=lambda item: (-costs[item], item)):
+        shard = min(range(shard_count), key=lambda i: (loads[i], i))
+        plan[item] = shard
+        loads[shard] += costs[item]
+    return plan
+
+def get_finished_items(infos: Dict[str, dict], results_dir: Optional[Union[Path, str]]) -> Set[str]:
+    """
+    Finds items whose model metrics of all runs already exist.
+
+    Args:
+        infos (Dict[str, dict]): Experiment information keyed by item.
+        results_dir (Optional[Union[Path, str]]): Directory with model metrics CSV files.
+
+    Returns:
+        Set[str]: The finished items.
+    """
+    if results_dir is None or not Path(results_dir).exists():
+        return set()
+    results = os.listdir(results_dir)
+    finished = set()
+    for item, info in infos.items():
+        expected = [f".{info['name']}.{run}.csv" for run in info["statistics"]]
+        if expected and all(any(result.endswith(suffix) for result in results) for suffix in expected):
+            finished.add(item)
+    return finished
+
+def save_manifests(manifest_dir: Union[Path, str], plan: Dict[str, int], costs: Dict[str, float], shard_count: int):
+    """
+    Saves plan.json and one shard_{i}.txt manifest per shard listing its items.
+
+    Args:
+        manifest_dir (Union[Path, str]): Destination directory.
+        plan (Dict[str, int]): Shard index of each item.
+        costs (Dict[str, float]): Estimated cost of each item.
+        shard_count (int): Number of shards.
+    """
+    manifest_dir = Path(manifest_dir)
+    manifest_dir.mkdir(exist_ok=True, parents=True)
+    with open(manifest_dir / "plan.json", "w") as f:
+        json.dump({"shards": shard_count, "items": dict([(item, {"shard": shard, "cost": costs[item]}) for item, shard in sorted(plan.items())])}, f, indent=4)
+    for shard in range(shard_count):
+        items = sorted([item for item, item_shard in plan.items() if item_shard == shard])
+        with open(manifest_dir / f"shard_{shard}.txt", "w", newline="\n") as f:
+            f.writelines([item + "\n" for item in items])
+        print(f"shard {shard}: {len(items)} items, cost {sum([costs[item] for item in items]):.2f}")
+
+def load_manifest(manifest: Union[Path, str]) -> List[str]:
+    """
+    Loads experiment names listed in a shard manifest.
+
+    Args:
+        manifest (Union[Path, str]): Path to the shard_{i}.txt manifest.
+
+    Returns:
+        List[str]: The experiment names.
+    """
+    with open(manifest) as f:
+        return [Path(line.strip()).stem if line.strip().endswith(".zip") else line.strip() for line in f if line.strip()]
+
+def plan_model_metrics(data_dir: str, manifest_dir: str, shards: int, top: Optional[int] = None, stats_format: str = "statistics.{run}.csv.zip",
+                       results_dir: Optional[str] = None, evaluation_cost: float = 1.0, inference_cost: float = 1e-6, **kwargs):
+    """
+    Plans balanced shards of model metrics evaluation over experiments in the data directory.
+
+    Args:
+        data_dir (str): Directory with experiment archives or directories.
+        manifest_dir (str): Directory where manifests are saved; an existing plan.json is reused.
+        shards (int): Number of shards.
+        top (Optional[int], optional): Number of rows evaluated per run, all rows if None. Defaults to None.
+        stats_format (str, optional): Format of the statistics file names. Defaults to "statistics.{run}.csv.zip".
+        results_dir (Optional[str], optional): Directory with finished model metrics which are excluded. Defaults to None.
+        evaluation_cost (float, optional): Relative cost of a model evaluation. Defaults to 1.0.
+        inference_cost (float, optional): Relative cost of inferring one output value for one dataset sample. Defaults to 1e-6.
+    """
+    items = sorted([item for item in os.listdir(data_dir) if item.endswith(".zip") or (Path(data_dir) / item).is_dir()])
+    infos = dict([(item, get_item_info(Path(data_dir) / item, stats_format=stats_format)) for item in items])
+    finished = get_finished_items(infos, results_dir)
+    costs = dict([(item, estimate_cost(info, top=top, evaluation_cost=evaluation_cost, inference_cost=inference_cost)) for item, info in infos.items() if item not in finished])
+
+    plan_file = Path(manifest_dir) / "plan.json"
+    previous_plan = None
+    if plan_file.exists():
+        with open(plan_file) as f:
+            previous_plan = dict([(item, value["shard"]) for item, value in json.load(f)["items"].items()])
+
+    print(f"planning {len(costs)} items, {len(finished)} items are finished")
+    save_manifests(manifest_dir, plan_shards(costs, shards, previous_plan=previous_plan), costs, shards)
@@ -0,0 +1,312 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# statistics_store.py: Columnar Parquet store of CGP train statistics partitioned by experiment and run.
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+import pandas as pd
+from parse import parse
+from cgp.cgp_statistics import read_statistics, read_statistics_tail, resolve_statistics_file
+from commands.datastore import Datastore
+
+fitness_dtypes = {
+    "run": "int32",
+    "generation": "int64",
+    "error": "float64",
+    "energy": "float64",
+    "area": "float64",
+    "delay": "float64",
+    "depth": "float64",
+    "gate_count": "float64"
+}
+
+class StatisticsStore(object):
+    """
+    Store of CGP train statistics converted to Parquet. Every (experiment, run) partition consists
+    of fitness.parquet with typed numeric columns and chromosomes.parquet with dictionary-encoded
+    chromosomes, which is loaded only on demand. Converted partitions are listed in catalog.json
+    together with their source files, so readers of the CSV files can use the partitions instead.
+
+    Attributes:
+        root (Path): Root directory of the store.
+        catalog_file (Path): Path to the catalog of converted partitions.
+        catalog (Dict[str, dict]): Catalog entries keyed by "{experiment}/{run}".
+    """
+    def __init__(self, root: Optional[Union[Path, str]] = None) -> None:
+        """
+        Opens the store.
+
+        Args:
+            root (Optional[Union[Path, str]], optional): Root directory of the store. Defaults to the statistics datastore directory.
+        """
+        self.root = Path(root) if root is not None else Datastore().derive("statistics")
+        self.catalog_file = self.root / "catalog.json"
+        self.catalog = self._load_catalog()
+        self._sources = dict([(os.path.abspath(entry["source"]), entry) for entry in self.catalog.values()])
+
+    def _load_catalog(self) -> Dict[str, dict]:
+        if not self.catalog_file.exists():
+            return {}
+        with open(self.catalog_file, "r") as f:
+            return json.load(f)
+
+    def _save_catalog(self):
+        self.root.mkdir(exist_ok=True, parents=True)
+        temporary_file = self.catalog_file.with_name(self.catalog_file.name + ".tmp")
+        with open(temporary_file, "w") as f:
+            json.dump(self.catalog, f, indent=4, sort_keys=True)
+        os.replace(temporary_file, self.catalog_file)
+
+    def get_partition(self, experiment: str, run: int) -> Path:
+        """
+        Gets directory of the partition.
+
+        Args:
+            experiment (str): The experiment name.
+            run (int): The run number.
+
+        Returns:
+            Path: The partition directory.
+        """
+        return self.root / f"experiment={experiment}" / f"run={run}"
+
+    def is_converted(self, experiment: str, run: int, source: Union[Path, str]) -> bool:
+        """
+        Checks whether the partition was converted from the current version of the source file.
+
+        Args:
+            experiment (str): The experiment name.
+            run (int): The run number.
+            source (Union[Path, str]): The statistics CSV file.
+
+        Returns:
+            bool: True if the partition is up to date.
+        """
+        entry = self.catalog.get(f"{experiment}/{run}")
+        # entries without columns were converted before readers used the store
+        if entry is None or "columns" not in entry:
+            return False
+        stat = os.stat(resolve_statistics_file(source))
+        return entry["source_size"] == stat.st_size and entry["source_mtime_ns"] == stat.st_mtime_ns
+
+    def convert(self, experiment: str, run: int, source: Union[Path, str], save_catalog: bool = True) -> Path:
+        """
+        Converts statistics CSV file into the partition.
+
+        Args:
+            experiment (str): The experiment name.
+            run (int): The run number.
+            source (Union[Path, str]): The statistics CSV file, optionally zipped.
+            save_catalog (bool, optional): Whether to save the catalog immediately. Defaults to True.
+
+        Returns:
+            Path: The partition directory.
+        """
+        source = resolve_statistics_file(source)
+        stat = os.stat(source)
+        df = read_statistics(source)
+        columns = df.columns.tolist()
+        chromosomes = df.pop("chromosome").astype("category") if "chromosome" in df.columns else None
+        for column in df.columns:
+            if column in fitness_dtypes:
+                df[column] = df[column].astype(fitness_dtypes[column])
+            elif column != "timestamp":
+                # quantized values may not fit into int64
+                df[column] = pd.to_numeric(df[column])
+
+        partition = self.get_partition(experiment, run)
+        partition.mkdir(exist_ok=True, parents=True)
+        df.to_parquet(partition / "fitness.parquet", index=False)
+        if chromosomes is not None:
+            chromosomes.to_frame().to_parquet(partition / "chromosomes.parquet", index=False)
+
+        entry = self.catalog[f"{experiment}/{run}"] = {
+            "experiment": experiment,
+            "run": run,
+            "source": os.path.abspath(source),
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "rows": len(df.index),
+            "columns": columns,
+            "fitness": str((partition / "fitness.parquet").relative_to(self.root).as_posix()),
+            "chromosomes": str((partition / "chromosomes.parquet").relative_to(self.root).as_posix()) if chromosomes is not None else None
+        }
+        self._sources[entry["source"]] = entry
+        if save_catalog:
+            self._save_catalog()
+        return partition
+
+    def find(self, source: Union[Path, str]) -> Optional[dict]:
+        """
+        Finds catalog entry converted from the current version of the statistics file.
+
+        Args:
+            source (Union[Path, str]): The statistics CSV file, optionally zipped.
+
+        Returns:
+            Optional[dict]: The catalog entry or None if the file is not converted or has changed since.
+        """
+        try:
+            source = resolve_statistics_file(source)
+            stat = os.stat(source)
+        except OSError:
+            # files read from experiment archives are never converted
+            return None
+        entry = self._sources.get(os.path.abspath(source))
+        if entry is None or "columns" not in entry or entry["source_size"] != stat.st_size or entry["source_mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def read(self, source: Union[Path, str], usecols: Optional[List[str]] = None, rows: Optional[int] = None) -> Optional[pd.DataFrame]:
+        """
+        Reads statistics converted from the file in the column order of the file.
+
+        Args:
+            source (Union[Path, str]): The statistics CSV file, optionally zipped.
+            usecols (Optional[List[str]], optional): Columns to read. Defaults to all columns.
+            rows (Optional[int], optional): Number of last rows to read. Defaults to all rows.
+
+        Returns:
+            Optional[pd.DataFrame]: The statistics or None if the file is not converted.
+        """
+        entry = self.find(source)
+        if entry is None:
+            return None
+        columns = usecols or entry["columns"]
+        df = pd.read_parquet(self.root / entry["fitness"], columns=[column for column in columns if column != "chromosome"])
+        if "chromosome" in columns and entry["chromosomes"] is not None:
+            df["chromosome"] = pd.read_parquet(self.root / entry["chromosomes"])["chromosome"].astype(object).values
+        df = df[[column for column in columns if column in df.columns]]
+        return df.tail(rows).reset_index(drop=True) if rows is not None else df
+
+    def convert_all(self, experiments_root: Union[Path, str], fmt: str = "statistics.{run}.csv", force: bool = False) -> int:
+        """
+        Converts train statistics of all experiments found under the root directory.
+        Experiments are named by their path relative to the root.
+
+        Args:
+            experiments_root (Union[Path, str]): Directory containing the experiments.
+            fmt (str, optional): Format of the statistics file names. Defaults to "statistics.{run}.csv".
+            force (bool, optional): Whether to convert already converted files again. Defaults to False.
+
+        Returns:
+            int: Number of converted files.
+        """
+        experiments_root = Path(experiments_root)
+        converted = 0
+        for fitness_dir in sorted(experiments_root.glob("**/train_statistics/fitness")):
+            experiment = fitness_dir.parent.parent.relative_to(experiments_root).as_posix()
+            for file in sorted(os.listdir(fitness_dir)):
+                result = parse(fmt, file[:-len(".zip")] if file.endswith(".zip") else file)
+                if result is None:
+                    continue
+                run = int(result["run"])
+                if not force and self.is_converted(experiment, run, fitness_dir / file):
+                    continue
+                print(f"converting {experiment} run {run}")
+                self.convert(experiment, run, fitness_dir / file, save_catalog=False)
+                converted += 1
+        self._save_catalog()
+        return converted
+
+    def get_entries(self, experiments: Optional[Iterable[str]] = None, runs: Optional[Iterable[int]] = None) -> List[dict]:
+        """
+        Gets catalog entries of the selected partitions.
+
+        Args:
+            experiments (Optional[Iterable[str]], optional): Experiment names. Defaults to all experiments.
+            runs (Optional[Iterable[int]], optional): Run numbers. Defaults to all runs.
+
+        Returns:
+            List[dict]: The catalog entries.
+        """
+        experiments = set(experiments) if experiments is not None else None
+        runs = set(map(int, runs)) if runs is not None else None
+        return [entry for _, entry in sorted(self.catalog.items())
+                if (experiments is None or entry["experiment"] in experiments) and (runs is None or entry["run"] in runs)]
+
+    def load(self, experiments: Optional[Iterable[str]] = None, runs: Optional[Iterable[int]] = None, columns: Optional[List[str]] = None, chromosomes: bool = False) -> pd.DataFrame:
+        """
+        Loads statistics of the selected partitions into a single DataFrame with "experiment" and "run_id" columns.
+
+        Args:
+            experiments (Optional[Iterable[str]], optional): Experiment names. Defaults to all experiments.
+            runs (Optional[Iterable[int]], optional): Run numbers. Defaults to all runs.
+            columns (Optional[List[str]], optional): Fitness columns to load. Defaults to all columns.
+            chromosomes (bool, optional): Whether to load chromosomes as well. Defaults to False.
+
+        Returns:
+            pd.DataFrame: The statistics.
+        """
+        frames = []
+        for entry in self.get_entries(experiments, runs):
+            df = pd.read_parquet(self.root / entry["fitness"], columns=columns)
+            if chromosomes and entry["chromosomes"] is not None:
+                df["chromosome"] = pd.read_parquet(self.root / entry["chromosomes"])["chromosome"].values
+            df["experiment"] = entry["experiment"]
+            df["run_id"] = entry["run"]
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=(columns or []) + ["experiment", "run_id"])
+        df = pd.concat(frames, ignore_index=True)
+        df["experiment"] = df["experiment"].astype("category")
+        return df
+
+def open_statistics_store(root: Optional[Union[Path, str]] = None) -> Optional[StatisticsStore]:
+    """
+    Opens the statistics store if it has a catalog.
+
+    Args:
+        root (Optional[Union[Path, str]], optional): Root directory of the store. Defaults to the statistics datastore directory.
+
+    Returns:
+        Optional[StatisticsStore]: The store or None if nothing was converted or the datastore is not set.
+    """
+    if root is None and os.environ.get("datastore") is None:
+        return None
+    statistics_store = StatisticsStore(root)
+    return statistics_store if statistics_store.catalog else None
+
+def load_statistics(file: Union[Path, str], usecols: Optional[List[str]] = None, rows: Optional[int] = None, store: Optional[StatisticsStore] = None) -> pd.DataFrame:
+    """
+    Reads statistics from the store if the file was converted, otherwise parses the CSV file.
+
+    Args:
+        file (Union[Path, str]): Path to the statistics file.
+        usecols (Optional[List[str]], optional): Columns to read. Defaults to all columns.
+        rows (Optional[int], optional): Number of last rows to read. Defaults to all rows.
+        store (Optional[StatisticsStore], optional): The statistics store. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The statistics.
+    """
+    df = store.read(file, usecols=usecols, rows=rows) if store is not None else None
+    if df is not None:
+        return df
+    return read_statistics(file, usecols=usecols) if rows is None else read_statistics_tail(file, rows, usecols=usecols)
+
+def convert_statistics(experiments_root: str, store: Optional[str] = None, statistics_format: str = "statistics.{run}.csv", force: bool = False, **kwargs):
+    """
+    Converts train statistics found under the directory to the Parquet statistics store.
+
+    Args:
+        experiments_root (str): Directory containing the experiments.
+        store (Optional[str], optional): Root directory of the store. Defaults to the statistics datastore directory.
+        statistics_format (str, optional): Format of the statistics file names. Defaults to "statistics.{run}.csv".
+        force (bool, optional): Whether to convert already converted files again. Defaults to False.
+    """
+    statistics_store = StatisticsStore(store)
+    converted = statistics_store.convert_all(experiments_root, fmt=statistics_format, force=force)
+    print(f"converted {converted} statistics files, catalog has {len(statistics_store.catalog)} entries")
@@ -0,0 +1,32 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# test_metrics_log.py: Resume of model metrics evaluation from a partial log.
+
+import pandas as pd
+from commands.metrics_log import append_metrics_log, get_remaining_run_ids, read_metrics_log
+
+def test_only_missing_run_ids_are_evaluated(tmp_path):
+    log_file = tmp_path / "metrics.csv.log"
+    with open(log_file, "w") as log:
+        append_metrics_log(log, 1, {1: 0.5, 5: 0.9}, 1.0)
+        append_metrics_log(log, 2, {1: 0.4, 5: 0.8}, 2.0)
+        append_metrics_log(log, 2, {1: 0.6, 5: 0.7}, 3.0)
+        # a killed job leaves an incomplete record
+        log.write('{"Run ID": 3, "Top-1"')
+
+    completed = read_metrics_log(log_file)
+    pending = pd.DataFrame({"Run ID": [1, 2, 3, 4]})
+    assert get_remaining_run_ids(pending, completed) == [3, 4]
+    assert completed.index.tolist() == [1, 2]
+    assert completed.loc[2, "Loss"] == 3.0
+    assert log_file.read_text().endswith("\n")
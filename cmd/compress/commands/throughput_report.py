@@ -0,0 +1,282 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# throughput_report.py: Cost of CGP runs computed by streaming their train statistics.
+
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+from parse import parse
+from cgp.cgp_configuration import CGPConfiguration
+from cgp.cgp_statistics import iterate_statistics
+
+throughput_columns = ["run", "generation", "timestamp", "error", "quantized_energy"]
+
+def _to_float(value) -> float:
+    return float(value) if value is not None else np.nan
+
+class RunThroughput(object):
+    """
+    Streaming accumulator of throughput metrics of a single CGP run.
+
+    The binary logs a row whenever the best solution improves. Timestamps are seconds since the start of
+    the current evolution phase and restart when the energy phase begins, so the elapsed time is accumulated
+    over phases. Rows logged between phases measure time since the process started, which makes the elapsed
+    time approximate when one process trained several runs.
+
+    Attributes:
+        mse_threshold (float): Error threshold of feasible solutions.
+        population_max (float): Number of evaluated candidates per generation.
+        curve (List[pd.DataFrame]): Convergence curve chunks holding rows where the best solution changed.
+    """
+    def __init__(self, mse_threshold: Optional[float], population_max: Optional[float]) -> None:
+        """
+        Initializes the accumulator.
+
+        Args:
+            mse_threshold (Optional[float]): Error threshold of feasible solutions.
+            population_max (Optional[float]): Number of evaluated candidates per generation.
+        """
+        self.mse_threshold = _to_float(mse_threshold)
+        self.population_max = _to_float(population_max)
+        self.curve: List[pd.DataFrame] = []
+        self._offset = 0.0
+        self._previous_timestamp = None
+        self._previous_fitness = None
+        self._first_generation = None
+        self._last_generation = None
+        self._elapsed = 0.0
+        self._first_feasible = None
+        self._best = None
+
+    def update(self, chunk: pd.DataFrame):
+        """
+        Accumulates a chunk of statistics rows.
+
+        Args:
+            chunk (pd.DataFrame): Rows with generation, timestamp, error and quantized_energy columns.
+        """
+        chunk = chunk.apply(pd.to_numeric, errors="coerce").dropna(subset=["generation", "timestamp", "error"])
+        if chunk.empty:
+            return
+        timestamps = chunk["timestamp"].to_numpy(dtype=float)
+        previous = np.concatenate([[self._previous_timestamp if self._previous_timestamp is not None else timestamps[0]], timestamps[:-1]])
+        # a timestamp lower than its predecessor starts a new phase measured from zero
+        increments = np.where(timestamps < previous, previous, 0.0)
+        elapsed = self._offset + np.cumsum(increments) + timestamps
+        self._offset += increments.sum()
+        self._previous_timestamp = timestamps[-1]
+
+        generations = chunk["generation"].to_numpy()
+        self._first_generation = generations.min() if self._first_generation is None else min(self._first_generation, generations.min())
+        self._last_generation = generations.max() if self._last_generation is None else max(self._last_generation, generations.max())
+        self._elapsed = max(self._elapsed, elapsed.max())
+
+        errors = chunk["error"].to_numpy(dtype=float)
+        energies = chunk["quantized_energy"].to_numpy(dtype=float)
+        if self._first_feasible is None and not np.isnan(self.mse_threshold):
+            feasible = np.flatnonzero(errors <= self.mse_threshold)
+            if feasible.size:
+                self._first_feasible = (elapsed[feasible[0]], generations[feasible[0]])
+
+        previous_errors = np.concatenate([[self._previous_fitness[0] if self._previous_fitness is not None else np.nan], errors[:-1]])
+        previous_energies = np.concatenate([[self._previous_fitness[1] if self._previous_fitness is not None else np.nan], energies[:-1]])
+        changed = (errors != previous_errors) | ((energies != previous_energies) & ~(np.isnan(energies) & np.isnan(previous_energies)))
+        changed_indices = np.flatnonzero(changed)
+        if changed_indices.size:
+            last_change = changed_indices[-1]
+            self._best = (elapsed[last_change], generations[last_change])
+            self.curve.append(pd.DataFrame({"generation": generations[changed], "time": elapsed[changed], "error": errors[changed], "quantized_energy": energies[changed]}))
+        self._previous_fitness = (errors[-1], energies[-1])
+
+    def update_progress(self, generation: float, timestamp: float):
+        """
+        Extends the run by progress logged in the learning rate file, if the binary writes one.
+
+        Args:
+            generation (float): The last logged generation.
+            timestamp (float): Seconds since the run started.
+        """
+        self._last_generation = generation if self._last_generation is None else max(self._last_generation, generation)
+        self._elapsed = max(self._elapsed, timestamp)
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        Computes the throughput metrics.
+
+        Returns:
+            Dict[str, float]: Generations, time in seconds, generations and evaluations per second, time and generation
+                of the first feasible solution, time and generation when the final best solution was reached and its fitness.
+        """
+        if self._first_generation is None:
+            return {}
+        generations = self._last_generation - self._first_generation + 1
+        generations_per_second = generations / self._elapsed if self._elapsed > 0 else np.nan
+        first_feasible_time, first_feasible_generation = self._first_feasible or (np.nan, np.nan)
+        best_time, best_generation = self._best or (np.nan, np.nan)
+        return {
+            "generations": generations,
+            "time": self._elapsed,
+            "generations_per_second": generations_per_second,
+            "evaluations_per_second": generations_per_second * self.population_max,
+            "time_to_first_feasible": first_feasible_time,
+            "generation_to_first_feasible": first_feasible_generation,
+            "time_to_best": best_time,
+            "generation_to_best": best_generation,
+            "error": self._previous_fitness[0],
+            "quantized_energy": self._previous_fitness[1]
+        }
+
+    def get_curve(self) -> pd.DataFrame:
+        """
+        Gets the convergence curve.
+
+        Returns:
+            pd.DataFrame: Generation, time, error and quantized energy of every change of the best solution.
+        """
+        return pd.concat(self.curve, ignore_index=True) if self.curve else pd.DataFrame(columns=["generation", "time", "error", "quantized_energy"])
+
+def _read_learning_rate(run_throughput: RunThroughput, file: Path, chunk_size: int):
+    with open(file, "r") as f:
+        header = f.readline().strip().split(",")
+    if "generation" not in header or "timestamp" not in header:
+        print(f"warn: {file} has no generation and timestamp columns")
+        return
+    for chunk in pd.read_csv(file, usecols=["generation", "timestamp"], chunksize=chunk_size):
+        chunk = chunk.apply(pd.to_numeric, errors="coerce").dropna()
+        if not chunk.empty:
+            run_throughput.update_progress(chunk["generation"].max(), chunk["timestamp"].max())
+
+def measure_experiment(experiment_dir: Union[Path, str], fmt: str = "statistics.{run}.csv", chunk_size: int = 100000) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Measures throughput of all runs of the experiment. Chromosomes are not parsed.
+
+    Args:
+        experiment_dir (Union[Path, str]): Directory of the experiment with train_statistics.
+        fmt (str, optional): Format of the statistics file names. Defaults to "statistics.{run}.csv".
+        chunk_size (int, optional): Number of rows per streamed chunk. Defaults to 100000.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: Metrics of each run and convergence curves of all runs.
+    """
+    experiment_dir = Path(experiment_dir)
+    config_file = experiment_dir / "train_cgp.config"
+    config = CGPConfiguration(config_file) if config_file.exists() else None
+    mse_threshold = config.get_mse_threshold() if config is not None else None
+    population_max = config.get_population_max() if config is not None else None
+
+    rows, curves = [], []
+    fitness_dir = experiment_dir / "train_statistics" / "fitness"
+    learning_dir = experiment_dir / "train_statistics" / "learning"
+    for file in sorted(os.listdir(fitness_dir)):
+        result = parse(fmt, file[:-len(".zip")] if file.endswith(".zip") else file)
+        if result is None:
+            continue
+        run = int(result["run"])
+        run_throughput = RunThroughput(mse_threshold, population_max)
+        for chunk in iterate_statistics(fitness_dir / file, usecols=throughput_columns, chunk_size=chunk_size):
+            run_throughput.update(chunk.drop(columns="run"))
+        learning_rate_file = learning_dir / f"learning_rate.{run}.csv"
+        if learning_rate_file.exists():
+            _read_learning_rate(run_throughput, learning_rate_file, chunk_size)
+        metrics = run_throughput.get_metrics()
+        if not metrics:
+            print(f"warn: {fitness_dir / file} has no train statistics")
+            continue
+        rows.append({"run": run, **metrics})
+        curve = run_throughput.get_curve()
+        curve.insert(0, "run", run)
+        curves.append(curve)
+
+    runs = pd.DataFrame(rows)
+    runs.insert(0, "rows", _to_float(config.get_row_count()) if config is not None else np.nan)
+    runs.insert(1, "cols", _to_float(config.get_col_count()) if config is not None else np.nan)
+    runs.insert(2, "population_max", _to_float(population_max))
+    return runs, pd.concat(curves, ignore_index=True) if curves else pd.DataFrame()
+
+def aggregate_throughput(runs: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregates run metrics by experiment.
+
+    Args:
+        runs (pd.DataFrame): Metrics of runs with the experiment column.
+
+    Returns:
+        pd.DataFrame: Number of runs and feasible runs, mean generations, time and throughput, median times to
+            the first feasible and the best solution and the best final fitness of each experiment.
+    """
+    grouped = runs.groupby("experiment", sort=True)
+    return pd.DataFrame({
+        "rows": grouped["rows"].first(),
+        "cols": grouped["cols"].first(),
+        "population_max": grouped["population_max"].first(),
+        "runs": grouped["run"].count(),
+        "feasible_runs": grouped["time_to_first_feasible"].count(),
+        "generations": grouped["generations"].mean(),
+        "time": grouped["time"].mean(),
+        "generations_per_second": grouped["generations_per_second"].mean(),
+        "evaluations_per_second": grouped["evaluations_per_second"].mean(),
+        "time_to_first_feasible": grouped["time_to_first_feasible"].median(),
+        "time_to_best": grouped["time_to_best"].median(),
+        "error": grouped["error"].min(),
+        "quantized_energy": grouped["quantized_energy"].min()
+    }).reset_index()
+
+def report_throughput(experiments_root: str, statistics_format: str = "statistics.{run}.csv", output: Optional[str] = None, curves: Optional[str] = None, chunk_size: int = 100000, **kwargs) -> pd.DataFrame:
+    """
+    Reports throughput of all experiments found under the directory, e.g. the sub-experiments of a MultiExperiment.
+    Experiments are named by their path relative to the root.
+
+    Args:
+        experiments_root (str): Directory containing the experiments.
+        statistics_format (str, optional): Format of the statistics file names. Defaults to "statistics.{run}.csv".
+        output (Optional[str], optional): Path to the CSV file with metrics of each run. Defaults to None.
+        curves (Optional[str], optional): Path to the CSV file with convergence curves. Defaults to None.
+        chunk_size (int, optional): Number of rows per streamed chunk. Defaults to 100000.
+
+    Returns:
+        pd.DataFrame: Metrics aggregated by experiment.
+
+    Raises:
+        FileNotFoundError: If no train statistics are found.
+    """
+    experiments_root = Path(experiments_root)
+    run_frames, curve_frames = [], []
+    for fitness_dir in sorted(experiments_root.glob("**/train_statistics/fitness")):
+        experiment_dir = fitness_dir.parent.parent
+        experiment = experiment_dir.relative_to(experiments_root).as_posix()
+        print(f"measuring {experiment}")
+        runs, curve = measure_experiment(experiment_dir, fmt=statistics_format, chunk_size=chunk_size)
+        if runs.empty:
+            continue
+        runs.insert(0, "experiment", experiment)
+        curve.insert(0, "experiment", experiment)
+        run_frames.append(runs)
+        curve_frames.append(curve)
+
+    if not run_frames:
+        raise FileNotFoundError(f"no train statistics found under {experiments_root}")
+    runs = pd.concat(run_frames, ignore_index=True)
+    summary = aggregate_throughput(runs)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", None):
+        print(summary.to_string(index=False))
+    if output is not None:
+        Path(output).parent.mkdir(exist_ok=True, parents=True)
+        runs.to_csv(output, index=False)
+        print(f"run metrics saved to {output}")
+    if curves is not None:
+        Path(curves).parent.mkdir(exist_ok=True, parents=True)
+        pd.concat(curve_frames, ignore_index=True).to_csv(curves, index=False)
+        print(f"convergence curves saved to {curves}")
+    return summary
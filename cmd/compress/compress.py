@@ -1,6 +1,5 @@
 import argparse
 import commands.manager as manager
-from commands.evaluate_cgp_model import evaluate_model
 from dotenv import load_dotenv
 
 load_dotenv()
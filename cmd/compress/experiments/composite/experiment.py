@@ -195,7 +195,8 @@ class MultiExperiment(Experiment, ABC):
         Yields:
             Generator[Experiment, None, None]: The registered experiments.
         """        
-        for experiment_name in os.listdir(self.base_folder):
+        # archived experiments are read from their zip archives without extraction
+        for experiment_name in dict.fromkeys([name[:-len(".zip")] if name.endswith(".zip") else name for name in os.listdir(self.base_folder)]):
             try:
                 config = CGPConfiguration(self.base_folder / experiment_name / Experiment.train_cgp_name)
                 new_experiment = self.create_experiment_from_name(config)
@@ -217,8 +218,9 @@ class MultiExperiment(Experiment, ABC):
         Yields:
             Union[Experiment, str]: The matching experiments or their names.
         """        
-        for experiment_name in glob(str(self.base_folder / str_glob)):
-            path = Path(experiment_name)
+        # archived experiments are read from their zip archives without extraction
+        paths = [Path(path) for path in glob(str(self.base_folder / str_glob))] + [Path(path).with_suffix("") for path in glob(str(self.base_folder / (str_glob + ".zip")))]
+        for path in dict.fromkeys([path for path in paths if path.suffix != ".zip"]):
             experiment_name = path.name
             print(experiment_name)
             try:
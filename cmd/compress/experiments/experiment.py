@@ -14,6 +14,7 @@
 # The utility is also capable of generating PBS jobs.
 
 import csv
+import json
 import os
 import shutil
 import math
@@ -21,14 +22,20 @@ from string import Template
 from pathlib import Path
 from typing import Union, Self, Optional, List, Iterable
 import torch
+import pandas as pd
 from parse import parse
-from cgp.cgp_adapter import CGP
+from cgp.cgp_adapter import CGP, CGPProcessError
 from cgp.cgp_configuration import CGPConfiguration
+from cgp.chromosome_layout import ChromosomeLayout
 from models.quantization import tensor_iterator
 from models.adapters.model_adapter import ModelAdapter
 from models.adapters.base import BaseAdapter
 from models.selector import FilterSelectorCombinations
 from circuit.loader import get_gate_parameters
+from commands.blob_store import get_file_digest, get_reference_file, store_file
+from commands.datastore import exists, list_dir, materialize, open_file
+from commands.statistics_store import StatisticsStore, load_statistics, open_statistics_store
+from tracing import estimate_memory, traced, unwatch_process, watch_process
 
 class MissingChromosomeError(ValueError):
     """
@@ -182,6 +189,7 @@ class Experiment(object):
         self.eval_stdout = root / "eval_stdout.txt"
         self.eval_stderr = root / "eval_stderr.txt"
         self.learning_rate_file = root / "train_statistics" / "learning" / "learning_rate.{run}.csv"
+        self.warm_start_file = root / "warm_start.json"
         self.temporary_base_folder = root if root != self.base_folder else None
 
     def clean_train(self):
@@ -191,7 +199,7 @@ class Experiment(object):
         shutil.rmtree(self.train_statistics.parent)
         shutil.rmtree(self.result_configs.parent)
         shutil.rmtree(self.result_weights.parent)
-        os.unlink(self.train_weights)
+        os.unlink(self.train_weights if self.train_weights.exists() else get_reference_file(self.train_weights))
         os.unlink(self.train_stdout)
         os.unlink(self.train_stderr)
     
@@ -293,7 +301,65 @@ class Experiment(object):
             experiment.config.set_start_generation(start_generation)
         return experiment
 
-    def get_train_env(self, config: CGPConfiguration = None, clean=False, relative_paths: bool = False, reuse_weight_file=False) -> Self:
+    def get_warm_start_seed(self, config: CGPConfiguration = None, tail_rows: int = 64) -> Optional[dict]:
+        """
+        Find the best chromosome of finished sibling experiments which can seed the evolution. Siblings are experiments
+        in the same folder with identical train data, such as other error thresholds or grid sizes of the same filter.
+        Solutions feasible under the MSE threshold of the configuration are preferred by energy, the others by error.
+        Chromosomes of a different grid size or look back parameter are re-laid out to the grid of the configuration.
+
+        Args:
+            config (CGPConfiguration, optional): Configuration to seed. Defaults to the experiment configuration.
+            tail_rows (int, optional): Number of last statistics rows searched for a logged chromosome. Defaults to 64.
+
+        Returns:
+            Optional[dict]: The seed with the source experiment, run, metrics and chromosome, or None if no sibling fits.
+        """
+        config = config or self.config
+        root = self.train_config.parent
+        if not exists(self.train_weights):
+            return None
+        # train data replaced by blob store references are compared by their digests
+        train_weights_digest = get_file_digest(self.train_weights)
+        mse_threshold = float(config.get_mse_threshold()) if config.has_mse_threshold() else None
+        candidates = []
+        statistics_store = open_statistics_store()
+        for sibling in sorted(root.parent.iterdir()):
+            sibling_weights = sibling / self.train_weights.name
+            if sibling == root or not exists(sibling_weights) or get_file_digest(sibling_weights) != train_weights_digest:
+                continue
+            for statistics_file in sorted((sibling / self.train_statistics.relative_to(root).parent).glob("statistics.*")):
+                tail = load_statistics(statistics_file, usecols=["run", "error", "quantized_energy", "chromosome"], rows=tail_rows, store=statistics_store)
+                tail = tail[tail["chromosome"].map(lambda chromosome: isinstance(chromosome, str) and chromosome != "")]
+                if not tail.empty:
+                    best = tail.iloc[-1]
+                    candidates.append({"experiment": sibling.name, "run": int(best["run"]), "error": float(best["error"]), "quantized_energy": float(best["quantized_energy"]), "chromosome": best["chromosome"]})
+
+        for candidate in candidates:
+            candidate["feasible"] = mse_threshold is not None and candidate["error"] <= mse_threshold
+        rows, cols = int(config.get_row_count()), int(config.get_col_count())
+        look_back = int(config.get_look_back_parameter()) if config.has_look_back_parameter() else cols
+        function_output_arity = int(config.get_function_output_arity()) if config.has_function_output_arity() else 1
+        for candidate in sorted(candidates, key=lambda x: (0, x["quantized_energy"], x["error"]) if x["feasible"] else (1, x["error"], x["quantized_energy"])):
+            try:
+                chromosome = ChromosomeLayout.parse(candidate["chromosome"])
+            except ValueError as e:
+                print(f"warn: skipping chromosome of {candidate['experiment']} run {candidate['run']}: {str(e)}")
+                continue
+            if not chromosome.is_compatible(config):
+                continue
+            source_grid = (chromosome.header["row_count"], chromosome.header["col_count"], chromosome.header["look_back_parameter"])
+            candidate["source_grid"] = list(source_grid)
+            candidate["relayout"] = source_grid != (rows, cols, look_back)
+            if candidate["relayout"]:
+                chromosome = chromosome.relayout(rows, cols, look_back, function_output_arity=function_output_arity)
+                if chromosome is None:
+                    continue
+                candidate["chromosome"] = chromosome.to_string()
+            return candidate
+        return None
+
+    def get_train_env(self, config: CGPConfiguration = None, clean=False, relative_paths: bool = False, reuse_weight_file=False, warm_start: bool = False) -> Self:
         """
         Get the training environment for the experiment.
 
@@ -302,6 +368,8 @@ class Experiment(object):
             clean (bool, optional): Flag to indicate if the training environment should be cleaned. Defaults to False.
             relative_paths (bool, optional): Flag to indicate if the paths should be relative. Defaults to False.
             reuse_weight_file (bool, optional): Flag to indicate if the weight file should be reused. Defaults to False.
+            warm_start (bool, optional): Flag to indicate if the evolution should start from the best chromosome of a finished
+                sibling experiment, see get_warm_start_seed. The seed is recorded in the warm start file. Defaults to False.
 
         Returns:
             Experiment: A training environment for the experiment.
@@ -323,6 +391,7 @@ class Experiment(object):
             else:
                 experiment._prepare_cgp(config)
                 experiment._cgp.create_train_file(experiment.train_weights)
+                store_file(experiment.train_weights)
             config.set_input_file(self._handle_path(experiment.train_weights, relative_paths))
         if not config.has_cgp_statistics_file():
             config.set_cgp_statistics_file(self._handle_path(experiment.train_statistics, relative_paths))
@@ -355,9 +424,16 @@ class Experiment(object):
                 raise TypeError("allowed-mse-error must be either int or float: " + str(type(allowed_mse_error)))
         if not config.has_start_run() and self._start_run:
             config.set_start_run(self._start_run)
+        if warm_start and not config.has_starting_solution():
+            seed = experiment.get_warm_start_seed(config)
+            if seed is not None:
+                print(f"warm start of {experiment.get_name()} from {seed['experiment']} run {seed['run']}, error: {seed['error']}, quantized energy: {seed['quantized_energy']}")
+                config.set_starting_solution(seed["chromosome"])
+                with open(experiment.warm_start_file, "w") as f:
+                    json.dump(seed, f, indent=4)
         return experiment
 
-    def get_isolated_train_env(self, experiment_path: str, clean=False, relative_paths: bool = False) -> Self:
+    def get_isolated_train_env(self, experiment_path: str, clean=False, relative_paths: bool = False, warm_start: bool = False) -> Self:
         """
         Get an isolated training environment for the experiment.
 
@@ -365,6 +441,7 @@ class Experiment(object):
             experiment_path (str): Path to the isolated training environment.
             clean (bool, optional): Flag to indicate if the training environment should be cleaned. Defaults to False.
             relative_paths (bool, optional): Flag to indicate if the paths should be relative. Defaults to False.
+            warm_start (bool, optional): Flag to indicate if the evolution should be seeded from a sibling experiment. Defaults to False.
 
         Returns:
             Experiment: An isolated training environment for the experiment.
@@ -380,16 +457,15 @@ class Experiment(object):
                     raise ValueError("cannot delete base experiment folder")
                 shutil.rmtree(experiment_path)
 
-            # todo remove
-            if True or not self.gate_parameters_file.exists():
-                _, self.energy_series, self.delay_series = get_gate_parameters(
-                    self.gate_parameters_csv_file,
-                    self.gate_parameters_file,
-                    grid_size=(config.get_row_count(), config.get_col_count()))
-                
+            # gate parameters are quantized per grid size, get_gate_parameters memoises them
+            _, self.energy_series, self.delay_series = get_gate_parameters(
+                self.gate_parameters_csv_file,
+                self.gate_parameters_file,
+                grid_size=(config.get_row_count(), config.get_col_count()))
+
             config.set_gate_parameters_file(self._handle_path(self.gate_parameters_file, relative_paths))
 
-            experiment = self.get_train_env(config, relative_paths=relative_paths, reuse_weight_file=False)
+            experiment = self.get_train_env(config, relative_paths=relative_paths, reuse_weight_file=False, warm_start=warm_start)
             experiment.config.apply_extra_attributes()
             experiment.config.save()
             return experiment
@@ -464,7 +540,10 @@ class Experiment(object):
                             cgp_folder: str = "cgp_cpp_project",
                             cpu=32,
                             mem="2gb",
-                            scratch_capacity="1gb"):
+                            scratch_capacity="1gb",
+                            blob_store_folder: str = "blobs",
+                            memory_profile: Optional[dict] = None,
+                            memory_margin: float = 1.25):
         """
         Set up the PBS training job for the experiment.
 
@@ -477,7 +556,14 @@ class Experiment(object):
             cpu (int, optional): Number of CPUs for the PBS job. Defaults to 32.
             mem (str, optional): Memory for the PBS job. Defaults to "2gb".
             scratch_capacity (str, optional): Scratch capacity for the PBS job. Defaults to "1gb".
+            blob_store_folder (str, optional): Path to the blob store on remote, which restores the train data and
+                gate parameters written as references. Defaults to "blobs".
+            memory_profile (Optional[dict], optional): Memory profile recorded by train with --trace-memory. If the experiment
+                was profiled, memory is estimated from its peak instead of mem. Defaults to None.
+            memory_margin (float, optional): Multiplier of the profiled peak memory. Defaults to 1.25.
         """        
+        if memory_profile is not None:
+            mem = estimate_memory(memory_profile, [self.get_name()], margin=memory_margin, default=mem)
         unsigned_types = {
             8: "uint8_t",
             16: "uint16_t",
@@ -516,6 +602,7 @@ class Experiment(object):
             "workspace": "/storage/$server/home/$username/cgp_workspace",
             "experiments_folder": experiments_folder,
             "results_folder": results_folder,
+            "blob_store_folder": blob_store_folder,
             "cgp_cpp_project": cgp_folder,
             "cgp_binary_src": "bin/cgp",
             "cgp_binary": "cgp",
@@ -585,6 +672,7 @@ class Experiment(object):
         """        
         self._feature_maps_combinations = combinations
 
+    @traced("experiment.prepare_cgp")
     def _prepare_cgp(self, config: CGPConfiguration):
         """
         Prepare the CGP for the experiment.
@@ -618,7 +706,10 @@ class Experiment(object):
         Returns:
             int: Number of experiment results.
         """        
-        return len(os.listdir(self.result_configs.parent)) if self.result_configs.parent.exists() else 0
+        try:
+            return len(list_dir(self.result_configs.parent))
+        except FileNotFoundError:
+            return 0
 
     def get_experiment_results_run_list(self) -> List[int]:
         """
@@ -631,8 +722,9 @@ class Experiment(object):
             result = parse(self.result_configs.name + extension, x)
             return result["run"] if result else None
             
-        runs = [int(f(file)) for file in os.listdir(self.result_configs.parent) if f(file)]       
-        return runs or [int(f(file, extension=".zip")) for file in os.listdir(self.result_configs.parent) if f(file, extension=".zip")]
+        files = list_dir(self.result_configs.parent)
+        runs = [int(f(file)) for file in files if f(file)]       
+        return runs or [int(f(file, extension=".zip")) for file in files if f(file, extension=".zip")]
 
     def get_number_of_train_statistic_file(self, fmt: str = None) -> int:
         """
@@ -646,10 +738,10 @@ class Experiment(object):
         """        
         fmt = fmt or self.train_statistics.name
         def f(x):
-            result = parse(fmt, x)
+            result = parse(fmt, x[:-len(".zip")] if x.endswith(".zip") else x)
             return result["run"] if result else None        
         
-        return [int(f(file)) for file in os.listdir(self.train_statistics.parent) if f(file)]
+        return list(dict.fromkeys([int(f(file)) for file in list_dir(self.train_statistics.parent) if f(file)]))
 
     def get_infered_weights_run_list(self) -> List[int]:
         """
@@ -659,7 +751,7 @@ class Experiment(object):
             List[int]: List of inferred weights runs.
         """        
         runs = []
-        for weight_file in os.listdir(self.result_weights.parent):
+        for weight_file in list_dir(self.result_weights.parent):
             runs.append(int(parse(self.result_weights.name, weight_file)["run"]))
         return runs
 
@@ -679,7 +771,99 @@ class Experiment(object):
         if start_generation is not None:
             config.set_start_generation(start_generation)
 
+        self.materialize_inputs()
         self._cgp.train()
+        self._store_result_weights()
+
+    def train_cgp_fanout(self, workers: int, threads: Optional[int] = None, cpu: Optional[int] = None):
+        """
+        Train runs of the experiment by concurrent CGP processes. Each process trains a contiguous slice of
+        the runs with its own start_run and number_of_runs in a worker directory. Outputs are named by the run,
+        so they are moved into the experiment layout afterwards and the result is the same as of a sequential run.
+
+        Args:
+            workers (int): Number of CGP processes, at most one per run.
+            threads (Optional[int], optional): OpenMP threads of each process. Defaults to an equal share of the CPUs.
+            cpu (Optional[int], optional): Number of CPUs shared by the processes. Defaults to the CPU count.
+
+        Raises:
+            ValueError: If the evolution is resumed from a generation or the configuration has no output files.
+            CGPProcessError: If any CGP process exits with a non-zero code, outputs of finished processes are kept.
+        """
+        config = self.config
+        if config.has_start_generation() and config.get_start_generation() != 0:
+            raise ValueError("it is not allowed to set start generation when fanning out runs")
+        outputs = {
+            CGPConfiguration.COMMAND_OUTPUT_FILE: config.get_path(CGPConfiguration.COMMAND_OUTPUT_FILE),
+            CGPConfiguration.COMMAND_CGP_STATISTICS_FILE: config.get_path(CGPConfiguration.COMMAND_CGP_STATISTICS_FILE),
+            CGPConfiguration.COMMAND_TRAIN_WEIGHTS_FILE: config.get_path(CGPConfiguration.COMMAND_TRAIN_WEIGHTS_FILE),
+            CGPConfiguration.COMMAND_LEARNING_RATE_FILE: config.get_path(CGPConfiguration.COMMAND_LEARNING_RATE_FILE)
+        }
+        if outputs[CGPConfiguration.COMMAND_OUTPUT_FILE] is None or outputs[CGPConfiguration.COMMAND_CGP_STATISTICS_FILE] is None:
+            raise ValueError("output and statistics files must be set when fanning out runs, use the train environment")
+
+        start_run = int(config.get_start_run() or 0)
+        end_run = int(config.get_number_of_runs())
+        workers = max(1, min(workers, end_run - start_run))
+        bounds = [start_run + (end_run - start_run) * i // workers for i in range(workers + 1)]
+        threads = threads or max(1, (cpu or os.cpu_count()) // workers)
+
+        fanout_folder = outputs[CGPConfiguration.COMMAND_OUTPUT_FILE].parent.parent / "fanout"
+        if not config.should_resume_evolution():
+            # a sequential run truncates its logs, worker logs are appended to them
+            for file in [config.get_stdout_file(), config.get_stderr_file()]:
+                if file is not None:
+                    open(file, "w").close()
+        self.materialize_inputs()
+        processes = []
+        for worker in range(workers):
+            worker_folder = fanout_folder / f"worker_{worker}"
+            worker_config = config.clone()
+            worker_config.set_start_run(bounds[worker])
+            worker_config.set_number_of_runs(bounds[worker + 1])
+            for attribute, file in outputs.items():
+                if file is None:
+                    continue
+                worker_file = worker_folder / file.parent.name / file.name
+                worker_file.parent.mkdir(exist_ok=True, parents=True)
+                worker_config.set_attribute(attribute, worker_file)
+            worker_config.set_stdout_file(worker_folder / "train_stdout.txt")
+            worker_config.set_stderr_file(worker_folder / "train_stderr.txt")
+            print(f"worker {worker}: runs {bounds[worker] + 1} to {bounds[worker + 1]} with {threads} threads")
+            process = self._cgp.spawn(command="train", config=worker_config, env={**os.environ, "OMP_NUM_THREADS": str(threads)})
+            watch_process(process.pid)
+            processes.append((worker_folder, worker_config, process))
+
+        failed = []
+        for worker_folder, worker_config, process in processes:
+            try:
+                process.wait()
+            finally:
+                unwatch_process(process.pid)
+            print(f"{worker_folder.name} return code: {process.returncode}")
+            if process.returncode != 0:
+                failed.append(process.returncode)
+            self._merge_fanout_worker(worker_folder, worker_config, outputs)
+        shutil.rmtree(fanout_folder, ignore_errors=True)
+        self._store_result_weights()
+        if failed:
+            raise CGPProcessError(failed[0], what=f"{len(failed)} of {workers} CGP processes failed")
+
+    def _merge_fanout_worker(self, worker_folder: Path, worker_config: CGPConfiguration, outputs: dict):
+        for attribute, file in outputs.items():
+            if file is None:
+                continue
+            worker_directory = worker_config.get_path(attribute).parent
+            file.parent.mkdir(exist_ok=True, parents=True)
+            for name in os.listdir(worker_directory):
+                os.replace(worker_directory / name, file.parent / name)
+        for stream, file in [("train_stdout.txt", self.config.get_path(CGPConfiguration.COMMAND_STDOUT)), ("train_stderr.txt", self.config.get_path(CGPConfiguration.COMMAND_STDERR))]:
+            if file is None or not (worker_folder / stream).exists():
+                continue
+            with open(file, "a") as destination, open(worker_folder / stream, "r") as source:
+                destination.write(f"# {worker_folder.name}: runs {worker_config.get_start_run() + 1} to {worker_config.get_number_of_runs()}\n")
+                shutil.copyfileobj(source, destination)
+        shutil.rmtree(worker_folder)
 
     def infer_missing_weights(self):
         """
@@ -687,7 +871,26 @@ class Experiment(object):
         """        
         config = self.config.clone()
         self._prepare_cgp(config)
+        self.materialize_inputs()
         self._cgp.evaluate()
+        self._store_result_weights()
+
+    def materialize_inputs(self):
+        """
+        Restore input files of the CGP binary replaced by blob store references, or extract them from the experiment
+        archive when the experiment is not extracted. Other files, such as train statistics, are streamed directly.
+        """
+        for file in [self.train_weights, self.gate_parameters_file]:
+            if not file.exists() and exists(file):
+                materialize(file)
+
+    def _store_result_weights(self):
+        # weights written by the CGP binary are replaced by references once the binary finishes
+        if not self.result_weights.parent.is_dir():
+            return
+        for name in os.listdir(self.result_weights.parent):
+            if parse(self.result_weights.name, name) is not None:
+                store_file(self.result_weights.parent / name)
 
     def evaluate_chromosome_in_statistics(self, statistics: Union[Path, str], output_statistics: Union[Path, str], output_weights: Union[Path, str], mse_threshold=None):
         """
@@ -700,6 +903,7 @@ class Experiment(object):
             mse_threshold (optional): MSE threshold. Defaults to None.
         """        
         assert statistics != output_statistics
+        self.materialize_inputs()
         config = self.config.clone()
         config.set_input_file(self.train_weights)
         config.set_cgp_statistics_file(statistics)
@@ -722,6 +926,7 @@ class Experiment(object):
             output_weights (Union[Path, str]): Path to the output weights file.
             gate_statistics_file (Union[Path, str]): Path to the gate statistics file.
         """        
+        self.materialize_inputs()
         config = self.config.clone()
         config.set_input_file(self.train_weights)
         config.set_cgp_statistics_file(chromosomes_file)
@@ -743,6 +948,7 @@ class Experiment(object):
         Returns:
             List[str]: Weights for the chromosome.
         """        
+        self.materialize_inputs()
         config = self.config.clone()
         if weights_file == "-":
             weights_file = ".chromosome.temp"        
@@ -780,6 +986,22 @@ class Experiment(object):
         runs = runs if isinstance(runs, list) else [runs] if runs is not None else self.get_experiment_results_run_list()
         return [self.train_statistics.parent / ((fmt or self.train_statistics.name).format(run=run) + extension) for run in runs]
 
+    def read_train_statistics(self, run: int, fmt: Optional[str] = None, usecols: Optional[List[str]] = None, rows: Optional[int] = None, store: Optional[StatisticsStore] = None) -> pd.DataFrame:
+        """
+        Read the training statistics of a run, from the statistics store if the file was converted.
+
+        Args:
+            run (int): The run.
+            fmt (Optional[str], optional): Format of the files. Defaults to None.
+            usecols (Optional[List[str]], optional): Columns to read. Defaults to all columns.
+            rows (Optional[int], optional): Number of last rows to read. Defaults to all rows.
+            store (Optional[StatisticsStore], optional): The statistics store. Defaults to None.
+
+        Returns:
+            pd.DataFrame: The training statistics.
+        """
+        return load_statistics(self.get_train_statistics(runs=run, fmt=fmt)[0], usecols=usecols, rows=rows, store=store)
+
     def get_learn_rate_statistics(self, runs: Optional[Union[List[int], int]] = None) -> List[Path]:
         """
         Get the learning rate statistics files.
@@ -908,9 +1130,10 @@ class Experiment(object):
         """        
         with torch.inference_mode():
             file = Path(file) if not isinstance(file, int) else str(self.result_weights).format(run=file)
-            with open(file) as f:
+            with open_file(file) as f:
                 return self.parse_weights(f)
 
+    @traced("experiment.parse_weights")
     def parse_weights(self, weights: Union[List[str], str]):
         """
         Parse the weights for the experiment.
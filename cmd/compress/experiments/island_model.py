@@ -0,0 +1,248 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# island_model.py: Island model evolution of an experiment by concurrent CGP processes exchanging their best chromosomes.
+
+import csv
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+import pandas as pd
+from cgp.cgp_adapter import CGPProcessError
+from cgp.cgp_configuration import CGPConfiguration
+from cgp.cgp_statistics import STATISTICS_COLUMNS, read_statistics_tail
+from experiments.experiment import Experiment
+from tracing import span, unwatch_process, watch_process
+
+topologies = ["ring", "full"]
+telemetry_columns = ["epoch", "island", "run", "start_generation", "generations", "epoch_time", "time", "error", "quantized_energy", "feasible", "migrant_from"]
+
+class IslandModel(object):
+    """
+    Island model evolution orchestrated from Python. Every island is a CGP process evolving its own (1+lambda)
+    population for a fixed number of generations called an epoch. Between epochs the best chromosomes are read
+    from the island statistics and each island restarts from the best of its own and its neighbours' chromosomes
+    through the starting_solution and start_generation resume mechanism. Island k is stored as run k + 1 of the experiment.
+
+    Attributes:
+        experiment (Experiment): The train environment of the experiment.
+        islands (int): Number of islands.
+        epoch (int): Number of generations between migrations.
+        topology (str): Migration topology, either "ring" where islands receive the best chromosome of their
+            predecessor or "full" where islands receive the best chromosome of all islands.
+        threads (int): OpenMP threads of each island.
+        target_error (Optional[float]): Error which stops the evolution once an island reaches it.
+        telemetry_file (Path): CSV file with the best solution of every island after every epoch.
+    """
+    def __init__(self, experiment: Experiment, islands: int, epoch: int, topology: str = "ring", threads: Optional[int] = None, cpu: Optional[int] = None, target_error: Optional[float] = None) -> None:
+        """
+        Initializes the island model.
+
+        Args:
+            experiment (Experiment): The train environment of the experiment.
+            islands (int): Number of islands.
+            epoch (int): Number of generations between migrations.
+            topology (str, optional): Migration topology, either "ring" or "full". Defaults to "ring".
+            threads (Optional[int], optional): OpenMP threads of each island. Defaults to an equal share of the CPUs.
+            cpu (Optional[int], optional): Number of CPUs shared by the islands. Defaults to the CPU count.
+            target_error (Optional[float], optional): Error which stops the evolution. Defaults to None.
+
+        Raises:
+            ValueError: If the topology is unknown, the epoch is not positive or the configuration has no output files.
+        """
+        if topology not in topologies:
+            raise ValueError(f"unknown migration topology {topology}, expected one of {', '.join(topologies)}")
+        if epoch <= 0:
+            raise ValueError("epoch must be positive")
+        if experiment.config.get_output_file() is None or experiment.config.get_cgp_statistics_file() is None:
+            raise ValueError("output and statistics files must be set for the island model, use the train environment")
+        self.experiment = experiment
+        self.islands = islands
+        self.epoch = epoch
+        self.topology = topology
+        self.threads = threads or max(1, (cpu or os.cpu_count()) // islands)
+        self.target_error = target_error
+        self._config = experiment.config
+        self._statistics_file = self._config.get_path(CGPConfiguration.COMMAND_CGP_STATISTICS_FILE)
+        self._islands_folder = self._config.get_path(CGPConfiguration.COMMAND_OUTPUT_FILE).parent.parent / "islands"
+        self.telemetry_file = self._statistics_file.parent.parent / "islands.csv"
+        self._mse_threshold = float(self._config.get_mse_threshold()) if self._config.has_mse_threshold() else None
+
+    def get_sources(self, island: int) -> List[int]:
+        """
+        Gets islands whose best chromosomes compete for the next epoch of the island, the island itself goes first.
+
+        Args:
+            island (int): The island.
+
+        Returns:
+            List[int]: The source islands.
+        """
+        if self.topology == "ring":
+            return list(dict.fromkeys([island, (island - 1) % self.islands]))
+        return [island] + [other for other in range(self.islands) if other != island]
+
+    def _get_key(self, best: dict):
+        # feasible solutions are ranked by energy, the others by error
+        if self._mse_threshold is not None and best["error"] <= self._mse_threshold:
+            return (0, best["quantized_energy"], best["error"])
+        return (1, best["error"], best["quantized_energy"])
+
+    def _get_island_config(self, island: int, epoch: int, generations: int, starting_solution: Optional[str]) -> CGPConfiguration:
+        island_folder = self._islands_folder / f"island_{island}"
+        # result configurations and weights are appended by the binary, so outputs of the previous epoch are dropped
+        shutil.rmtree(island_folder, ignore_errors=True)
+        config = self._config.clone()
+        config.set_start_run(island)
+        config.set_number_of_runs(island + 1)
+        config.set_generation_count(generations)
+        for attribute in [CGPConfiguration.COMMAND_OUTPUT_FILE, CGPConfiguration.COMMAND_CGP_STATISTICS_FILE, CGPConfiguration.COMMAND_TRAIN_WEIGHTS_FILE]:
+            file = self._config.get_path(attribute)
+            if file is None:
+                continue
+            island_file = island_folder / file.parent.name / file.name
+            island_file.parent.mkdir(exist_ok=True, parents=True)
+            config.set_attribute(attribute, island_file)
+        config.set_stdout_file(island_folder / "train_stdout.txt")
+        config.set_stderr_file(island_folder / "train_stderr.txt")
+        if starting_solution is not None:
+            config.set_start_generation(epoch * self.epoch)
+            config.set_starting_solution(starting_solution)
+        return config
+
+    def _append_statistics(self, island: int, config: CGPConfiguration, generation_offset: int, time_offset: float, truncate: bool):
+        # epochs restart generations and timestamps, the combined statistics continue them
+        source = Path(str(config.get_path(CGPConfiguration.COMMAND_CGP_STATISTICS_FILE)).format(run=island + 1))
+        destination = Path(str(self._statistics_file).format(run=island + 1))
+        destination.parent.mkdir(exist_ok=True, parents=True)
+        with open(source, "r", newline="") as source_f, open(destination, "w" if truncate else "a", newline="") as destination_f:
+            writer = csv.writer(destination_f, lineterminator="\n")
+            if truncate:
+                writer.writerow(STATISTICS_COLUMNS)
+            for row in csv.reader(source_f):
+                if not row or row[0] == "run":
+                    continue
+                row[1] = str(int(row[1]) + generation_offset)
+                if row[2] != "":
+                    row[2] = f"{float(row[2]) + time_offset:.6f}"
+                writer.writerow(row)
+
+    def _append_logs(self, island: int, epoch: int):
+        island_folder = self._islands_folder / f"island_{island}"
+        for stream, file in [("train_stdout.txt", self._config.get_stdout_file()), ("train_stderr.txt", self._config.get_stderr_file())]:
+            if file is None or not (island_folder / stream).exists():
+                continue
+            with open(file, "a") as destination, open(island_folder / stream, "r") as source:
+                destination.write(f"# island {island}, epoch {epoch}\n")
+                shutil.copyfileobj(source, destination)
+
+    def _run_epoch(self, epoch: int, generations: int, migrants: Dict[int, Optional[str]]) -> Dict[int, dict]:
+        processes = []
+        for island in range(self.islands):
+            config = self._get_island_config(island, epoch, generations, migrants[island])
+            process = self.experiment._cgp.spawn(command="train", config=config, env={**os.environ, "OMP_NUM_THREADS": str(self.threads)})
+            watch_process(process.pid)
+            processes.append((island, config, process))
+
+        best = {}
+        failed = []
+        for island, config, process in processes:
+            try:
+                process.wait()
+            finally:
+                unwatch_process(process.pid)
+            self._append_logs(island, epoch)
+            if process.returncode != 0:
+                failed.append(process.returncode)
+                continue
+            statistics_file = str(config.get_path(CGPConfiguration.COMMAND_CGP_STATISTICS_FILE)).format(run=island + 1)
+            last = read_statistics_tail(statistics_file, 1, usecols=["generation", "error", "quantized_energy", "chromosome"]).iloc[-1]
+            chromosome = last["chromosome"] if isinstance(last["chromosome"], str) and last["chromosome"] else None
+            best[island] = {"generations": int(last["generation"]), "error": float(last["error"]), "quantized_energy": float(last["quantized_energy"]), "chromosome": chromosome, "config": config}
+        if failed:
+            raise CGPProcessError(failed[0], what=f"{len(failed)} of {self.islands} islands failed in epoch {epoch}")
+        return best
+
+    def run(self) -> pd.DataFrame:
+        """
+        Runs the island model until the generation count of the experiment is reached or an island reaches the
+        target error. Combined statistics, result configurations and weights of each island are stored as runs
+        of the experiment and the telemetry of all epochs is saved to the telemetry file.
+
+        Returns:
+            pd.DataFrame: The telemetry.
+
+        Raises:
+            CGPProcessError: If any island exits with a non-zero code.
+        """
+        generation_count = int(self._config.get_generation_count())
+        starting_solution = self._config.get_starting_solution() if self._config.has_starting_solution() else None
+        migrants = dict([(island, starting_solution) for island in range(self.islands)])
+        self.experiment.materialize_inputs()
+        for file in [self._config.get_stdout_file(), self._config.get_stderr_file()]:
+            if file is not None:
+                open(file, "w").close()
+
+        telemetry = []
+        start_time = time.perf_counter()
+        epochs = (generation_count + self.epoch - 1) // self.epoch
+        best = {}
+        for epoch in range(epochs):
+            generations = min(self.epoch, generation_count - epoch * self.epoch)
+            time_offset = time.perf_counter() - start_time
+            print(f"epoch {epoch + 1}/{epochs}: {self.islands} islands, generations {epoch * self.epoch + 1} to {epoch * self.epoch + generations}")
+            with span("island.epoch", epoch=epoch):
+                best = self._run_epoch(epoch, generations, migrants)
+            epoch_time = time.perf_counter() - start_time - time_offset
+
+            for island in range(self.islands):
+                self._append_statistics(island, best[island]["config"], epoch * self.epoch, time_offset, truncate=epoch == 0)
+                sources = [other for other in self.get_sources(island) if best[other]["chromosome"] is not None] or [island]
+                source = min(sources, key=lambda other: self._get_key(best[other]))
+                migrants[island] = best[source]["chromosome"]
+                telemetry.append({
+                    "epoch": epoch,
+                    "island": island,
+                    "run": island + 1,
+                    "start_generation": epoch * self.epoch,
+                    "generations": best[island]["generations"],
+                    "epoch_time": epoch_time,
+                    "time": time_offset + epoch_time,
+                    "error": best[island]["error"],
+                    "quantized_energy": best[island]["quantized_energy"],
+                    "feasible": self._get_key(best[island])[0] == 0,
+                    "migrant_from": source
+                })
+            pd.DataFrame(telemetry, columns=telemetry_columns).to_csv(self.telemetry_file, index=False)
+
+            reached = [island for island in range(self.islands) if self.target_error is not None and best[island]["error"] <= self.target_error]
+            if reached:
+                print(f"island {reached[0]} reached the target error {self.target_error} after {time_offset + epoch_time:.1f} seconds")
+                break
+
+        # the last epoch holds the final solution of each island
+        for island in range(self.islands):
+            config = best[island]["config"]
+            for attribute in [CGPConfiguration.COMMAND_OUTPUT_FILE, CGPConfiguration.COMMAND_TRAIN_WEIGHTS_FILE]:
+                if self._config.get_attribute(attribute) is None:
+                    continue
+                file = Path(str(self._config.get_path(attribute)).format(run=island + 1))
+                island_file = Path(str(config.get_path(attribute)).format(run=island + 1))
+                if island_file.exists():
+                    file.parent.mkdir(exist_ok=True, parents=True)
+                    os.replace(island_file, file)
+        shutil.rmtree(self._islands_folder, ignore_errors=True)
+        self.experiment._store_result_weights()
+        print(f"island telemetry saved to {self.telemetry_file}")
+        return pd.DataFrame(telemetry, columns=telemetry_columns)
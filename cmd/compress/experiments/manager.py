@@ -13,67 +13,57 @@
 # manager.py: Link experiments with their CLI argument parsers and Python classes. Finally, add common arguments for experiments and PBS arguments.
 
 import argparse
-from experiments.composite.experiment import MultiExperiment
-from experiments.all_layers.experiment import AllLayersExperiment
-from experiments.mobilenet.experiment import MobilenetExperiment
-from experiments.layer_bypass.experiment import LayerBypassExperiment
-from experiments.le_selector.experiment import LeSelectorExperiment
-from experiments.worst_case.experiment import WorstCaseExperiment
-from experiments.grid_size.experiment import GridSizeExperiment 
-from experiments.reversed_single_filter.experiment import ReversedSingleFilterExperiment
-from experiments.single_channel.experiment import SingleChannelExperiment
-from experiments.single_filter_zero_outter.experiment import SingleFilterZeroOutterExperiment
-from experiments.single_filter.experiment import SingleFilterExperiment
-
-import experiments.all_layers.cli as al
-import experiments.mobilenet.cli as mn
-import experiments.layer_bypass.cli as lb
-import experiments.le_selector.cli as le
-import experiments.worst_case.cli as wc
-import experiments.grid_size.cli as gs
-import experiments.reversed_single_filter.cli as rs
-import experiments.single_channel.cli as sc
-import experiments.single_filter_zero_outter.cli as sf
-
-import experiments.composite.cli as composite_cli
+import importlib
+from functools import partial
+from typing import Callable, List
 
+# experiments are referenced by import paths, so their classes, torch and models are imported only when an experiment is created
 experiments_classes = {
-    AllLayersExperiment.name:               AllLayersExperiment,
-    MobilenetExperiment.name:               MobilenetExperiment,
-    LayerBypassExperiment.name:             LayerBypassExperiment,
-    LeSelectorExperiment.name:              LeSelectorExperiment,
-    WorstCaseExperiment.name:               WorstCaseExperiment,
-    GridSizeExperiment.name:                GridSizeExperiment,
-    ReversedSingleFilterExperiment.name:    ReversedSingleFilterExperiment,
-    SingleChannelExperiment.name:           SingleChannelExperiment,
-    SingleFilterZeroOutterExperiment.name:  SingleFilterZeroOutterExperiment,
-    SingleFilterExperiment.name:            SingleFilterExperiment
+    "all_layers":                   "experiments.all_layers.experiment:AllLayersExperiment",
+    "mobilenet":                    "experiments.mobilenet.experiment:MobilenetExperiment",
+    "layer_bypass":                 "experiments.layer_bypass.experiment:LayerBypassExperiment",
+    "le_selector":                  "experiments.le_selector.experiment:LeSelectorExperiment",
+    "worst_case":                   "experiments.worst_case.experiment:WorstCaseExperiment",
+    "grid_size":                    "experiments.grid_size.experiment:GridSizeExperiment",
+    "reversed_single_filter":       "experiments.reversed_single_filter.experiment:ReversedSingleFilterExperiment",
+    "single_channel":               "experiments.single_channel.experiment:SingleChannelExperiment",
+    "single_filter_zero_outter":    "experiments.single_filter_zero_outter.experiment:SingleFilterZeroOutterExperiment",
+    "single_filter":                "experiments.single_filter.experiment:SingleFilterExperiment"
 }
 
 experiment_cli = {
-    AllLayersExperiment.name:               al.get_argument_parser,
-    MobilenetExperiment.name:               mn.get_argument_parser,
-    LayerBypassExperiment.name:             lb.get_argument_parser,
-    LeSelectorExperiment.name:              le.get_argument_parser,
-    WorstCaseExperiment.name:               wc.get_argument_parser,
-    GridSizeExperiment.name:                gs.get_argument_parser,
-    ReversedSingleFilterExperiment.name:    rs.get_argument_parser,
-    SingleChannelExperiment.name:           sc.get_argument_parser,
-    SingleFilterZeroOutterExperiment.name:  sf.get_argument_parser,
-    SingleFilterExperiment.name:            lambda x: x,
+    "all_layers":                   "experiments.all_layers.cli:get_argument_parser",
+    "mobilenet":                    "experiments.mobilenet.cli:get_argument_parser",
+    "layer_bypass":                 "experiments.layer_bypass.cli:get_argument_parser",
+    "le_selector":                  "experiments.le_selector.cli:get_argument_parser",
+    "worst_case":                   "experiments.worst_case.cli:get_argument_parser",
+    "grid_size":                    "experiments.grid_size.cli:get_argument_parser",
+    "reversed_single_filter":       "experiments.reversed_single_filter.cli:get_argument_parser",
+    "single_channel":               "experiments.single_channel.cli:get_argument_parser",
+    "single_filter_zero_outter":    "experiments.single_filter_zero_outter.cli:get_argument_parser",
+    "single_filter":                None
 }
 
-experiment_factories = dict([(name, clazz.with_cli_arguments) for name, clazz in experiments_classes.items()])
+def _import_object(path: str):
+    module_name, object_name = path.split(":")
+    return getattr(importlib.import_module(module_name), object_name)
+
+def _create_experiment(name: str, *args, **kwargs):
+    return get_experiment_class(name).with_cli_arguments(*args, **kwargs)
+
+def get_experiment_names() -> List[str]:
+    return list(experiments_classes.keys())
 
-def get_experiment_factory(name: str):
-    return experiment_factories.get(name)
+def get_experiment_factory(name: str) -> Callable:
+    return partial(_create_experiment, name) if name in experiments_classes else None
 
 def get_experiment_class(name: str):
-    return experiments_classes.get(name)
+    return _import_object(experiments_classes[name]) if name in experiments_classes else None
 
 def get_experiment_arguments(name: str, parser):
-    composite_cli.get_argument_parser(parser)
-    experiment_cli.get(name)(parser)
+    _import_object("experiments.composite.cli:get_argument_parser")(parser)
+    if experiment_cli.get(name) is not None:
+        _import_object(experiment_cli[name])(parser)
     return parser
 
 def get_base_argument_parser(parser: argparse.ArgumentParser):
@@ -89,6 +79,8 @@ def get_pbs_default_arguments_parser(parser: argparse.ArgumentParser):
     parser.add_argument("--results-folder", default="results", help="Results folder")
     parser.add_argument("--cpu", type=int, default=None, help="Number of CPUs")
     parser.add_argument("--mem", default="2gb", help="Memory")
+    parser.add_argument("--memory-profile", default=None, help="Memory profile recorded with --trace-memory; memory of profiled experiments is estimated from their peak")
+    parser.add_argument("--memory-margin", type=float, default=1.25, help="Multiplier of the profiled peak memory")
     parser.add_argument("--scratch-capacity", default="1gb", help="Scratch capacity")
     parser.add_argument("--multiplex", action="store_true", help="Use Multiplex Optimisation")
     return parser
@@ -96,4 +88,5 @@ def get_pbs_default_arguments_parser(parser: argparse.ArgumentParser):
 def get_train_pbs_argument_parser(parser: argparse.ArgumentParser):
     get_pbs_default_arguments_parser(parser)
     parser.add_argument("--cgp-folder", default="cgp_cpp_project", help="CGP folder")
+    parser.add_argument("--blob-store-folder", default="blobs", help="Blob store folder restoring train data and gate parameters written as references")
     return parser
@@ -23,6 +23,7 @@ from models.lenet import LeNet5
 from models.qat_quantized_lenet import QATQuantizedLeNet5
 from models.ptq_quantized_lenet import PTQQuantizedLeNet5
 from typing import Iterable, Optional, Self
+from tracing import traced
 from abc import ABC, abstractmethod
 
 class BaseAdapter(ModelAdapter, ABC):
@@ -110,6 +111,7 @@ class BaseAdapter(ModelAdapter, ABC):
         else:
             return self.get_test_data(**kwargs)
 
+    @traced("model.clone")
     def clone(self):
         """
         Clones the current adapter.
@@ -0,0 +1,334 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# lenet_variant_evaluator.py: Evaluate many LeNet-5 convolution weight variants in a single forward pass.
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.quantized as nnq
+import torch.ao.nn.intrinsic.quantized as nniq
+from models.tensor_dataset import create_loader
+from tqdm import tqdm
+from models.adapters.model_adapter import ModelAdapter
+from models.lenet import LeNet5
+from models.reference_logits import ReferenceLogits
+from models.selector import FilterSelectorCombinations
+
+class LeNetVariantEvaluator(object):
+    """
+    Evaluates K variants of a LeNet-5 model that differ only in conv1/conv2 weights.
+
+    The variant weights are stacked along the output channel dimension and computed as grouped
+    convolutions, so a single forward pass yields logits of all K variants. Quantized models use
+    the same quantized kernels as the per-model path, hence the results are expected to be identical,
+    which is checked by verify before the first evaluation.
+
+    Attributes:
+        adapter (ModelAdapter): Adapter of the baseline model.
+        layer_names (List[str]): Names of the convolution layers that may differ between variants.
+        variants (List[Dict[str, torch.Tensor]]): Weights of the convolution layers per variant.
+    """
+    layer_names = ["conv1", "conv2"]
+
+    def __init__(self, adapter: ModelAdapter) -> None:
+        """
+        Initialize the evaluator for the baseline model.
+
+        Args:
+            adapter (ModelAdapter): Adapter of the baseline LeNet-5 model.
+
+        Raises:
+            TypeError: If the model is not supported.
+        """
+        if not LeNetVariantEvaluator.supports(adapter):
+            raise TypeError(f"unsupported model {type(adapter.model).__name__} for batched variant evaluation")
+        self.adapter = adapter
+        self.variants: List[Dict[str, torch.Tensor]] = []
+        self.quantized = isinstance(adapter.model.conv1, nnq.Conv2d)
+        self.verified = False
+
+    @staticmethod
+    def supports(adapter: ModelAdapter) -> bool:
+        """
+        Check whether the adapter holds LeNet-5 model with plain or quantized convolutions.
+
+        Args:
+            adapter (ModelAdapter): The model adapter.
+
+        Returns:
+            bool: True if variants of the model can be batched.
+        """
+        model = adapter.model
+        if not isinstance(model, LeNet5):
+            return False
+        conv1, conv2 = model.conv1, model.conv2
+        return (isinstance(conv1, nnq.Conv2d) and isinstance(conv2, nnq.Conv2d)) or\
+            (type(conv1) == nn.Conv2d and type(conv2) == nn.Conv2d)
+
+    def _get_layer_name(self, selector) -> str:
+        """
+        Resolve layer name of an injection selector.
+
+        Args:
+            selector: Layer name, layer or a function returning the layer.
+
+        Returns:
+            str: The layer name.
+
+        Raises:
+            ValueError: If the selector targets layer which is not batched.
+        """
+        if isinstance(selector, str):
+            if selector in self.layer_names:
+                return selector
+        else:
+            layer = selector if isinstance(selector, nn.Module) else selector(self.adapter)
+            for name in self.layer_names:
+                if getattr(self.adapter.model, name) is layer:
+                    return name
+        raise ValueError(f"only {', '.join(self.layer_names)} can differ between batched variants, got {selector}")
+
+    def add_variant(self, weights_vector: List[torch.Tensor], injection_combinations: FilterSelectorCombinations) -> int:
+        """
+        Add a variant created by injecting weights into the baseline model.
+
+        Args:
+            weights_vector (List[torch.Tensor]): A list of weight tensors to be injected.
+            injection_combinations (FilterSelectorCombinations): The injection plan.
+
+        Returns:
+            int: Index of the added variant.
+        """
+        injected = self.adapter.get_injected_weights(weights_vector, injection_combinations)
+        variant = dict([(self._get_layer_name(selector), weights) for selector, weights in injected.items()])
+        self.variants.append(variant)
+        return len(self.variants) - 1
+
+    def add_weights(self, weights: Dict[str, torch.Tensor]) -> int:
+        """
+        Add a variant given directly by new weights of its convolution layers.
+
+        Args:
+            weights (Dict[str, torch.Tensor]): New weights keyed by layer name, missing layers keep the baseline weights.
+
+        Returns:
+            int: Index of the added variant.
+        """
+        for name in weights:
+            self._get_layer_name(name)
+        self.variants.append(dict(weights))
+        return len(self.variants) - 1
+
+    def clear(self):
+        """
+        Remove all added variants. Verification against the per-model path is kept.
+        """
+        self.variants = []
+
+    def _get_variant_weights(self, variant: Dict[str, torch.Tensor], name: str) -> torch.Tensor:
+        return variant[name] if name in variant else self.adapter.get_weights(name)
+
+    def _get_bias(self, layer: nn.Module) -> Optional[torch.Tensor]:
+        try:
+            return layer.bias()
+        except TypeError:
+            return layer.bias
+
+    def _stack_weights(self, variants: List[Dict[str, torch.Tensor]], name: str) -> torch.Tensor:
+        """
+        Stack weights of the variants along output channels.
+
+        Args:
+            variants (List[Dict[str, torch.Tensor]]): The variants.
+            name (str): Name of the layer.
+
+        Returns:
+            torch.Tensor: Weights of the grouped convolution.
+        """
+        weights = [self._get_variant_weights(variant, name) for variant in variants]
+        if not self.quantized:
+            return torch.cat(weights)
+
+        if weights[0].qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+            return torch._make_per_channel_quantized_tensor(
+                torch.cat([w.int_repr() for w in weights]),
+                torch.cat([w.q_per_channel_scales() for w in weights]),
+                torch.cat([w.q_per_channel_zero_points() for w in weights]),
+                weights[0].q_per_channel_axis())
+        scale, zero_point = weights[0].q_scale(), weights[0].q_zero_point()
+        if any(w.q_scale() != scale or w.q_zero_point() != zero_point for w in weights):
+            raise ValueError(f"variants of {name} do not share quantization parameters")
+        return torch._make_per_tensor_quantized_tensor(torch.cat([w.int_repr() for w in weights]), scale, zero_point)
+
+    def _grouped_convolution(self, x: torch.Tensor, name: str, variants: List[Dict[str, torch.Tensor]]) -> torch.Tensor:
+        """
+        Apply convolution of all variants to the stacked input.
+
+        Args:
+            x (torch.Tensor): Input of shape (N, K*C, H, W).
+            name (str): Name of the convolution layer.
+            variants (List[Dict[str, torch.Tensor]]): The variants.
+
+        Returns:
+            torch.Tensor: Output of shape (N, K*C', H', W') after ReLU.
+        """
+        layer = getattr(self.adapter.model, name)
+        groups = len(variants)
+        weights = self._stack_weights(variants, name)
+        bias = self._get_bias(layer)
+        bias = bias.repeat(groups) if bias is not None else None
+
+        if not self.quantized:
+            return torch.relu(F.conv2d(x, weights, bias, layer.stride, layer.padding, layer.dilation, groups * layer.groups))
+
+        packed_params = torch.ops.quantized.conv2d_prepack(weights, bias, list(layer.stride), list(layer.padding), list(layer.dilation), groups * layer.groups)
+        if isinstance(layer, nniq.ConvReLU2d):
+            return torch.ops.quantized.conv2d_relu(x, packed_params, layer.scale, layer.zero_point)
+        return torch.relu(torch.ops.quantized.conv2d(x, packed_params, layer.scale, layer.zero_point))
+
+    def forward(self, x: torch.Tensor, variants: Optional[List[Dict[str, torch.Tensor]]] = None) -> torch.Tensor:
+        """
+        Compute logits of the variants.
+
+        Args:
+            x (torch.Tensor): Input batch of shape (N, 1, 28, 28).
+            variants (Optional[List[Dict[str, torch.Tensor]]]): Variants to compute. Defaults to all added variants.
+
+        Returns:
+            torch.Tensor: Logits of shape (K, N, classes).
+        """
+        variants = variants if variants is not None else self.variants
+        model = self.adapter.model
+        k, n = len(variants), x.size(0)
+        x = x.repeat(1, k, 1, 1)
+        if self.quantized:
+            x = model.quant(x)
+        x = model.max_pool1(self._grouped_convolution(x, "conv1", variants))
+        x = model.max_pool2(self._grouped_convolution(x, "conv2", variants))
+        x = x.reshape(n * k, -1)
+        x = torch.relu(model.fc1(x))
+        x = torch.relu(model.fc2(x))
+        x = model.fc3(x)
+        if self.quantized:
+            x = model.dequant(x)
+        return x.reshape(n, k, -1).permute(1, 0, 2)
+
+    def verify(self, x: torch.Tensor, variants: Optional[List[Dict[str, torch.Tensor]]] = None, atol: float = 0.0) -> bool:
+        """
+        Check that batched logits match logits of the per-model path.
+
+        Args:
+            x (torch.Tensor): Input batch.
+            variants (Optional[List[Dict[str, torch.Tensor]]]): Variants to check. Defaults to all added variants.
+            atol (float, optional): Allowed absolute difference. Defaults to 0.0, requiring exact match.
+
+        Returns:
+            bool: True if every variant matches.
+        """
+        variants = variants if variants is not None else self.variants
+        original_train_mode = self.adapter.model.training
+        try:
+            self.adapter.model.eval()
+            with torch.inference_mode():
+                batched_logits = self.forward(x, variants)
+                for i, variant in enumerate(variants):
+                    model = self.adapter.clone()
+                    model.eval()
+                    for name, weights in variant.items():
+                        model.set_weights(name, weights)
+                    logits = model.model(x)
+                    if not torch.allclose(batched_logits[i], logits, rtol=0, atol=atol):
+                        print(f"variant {i} differs from per-model path by {(batched_logits[i] - logits).abs().max().item()}")
+                        return False
+            return True
+        finally:
+            self.adapter.model.train(mode=original_train_mode)
+
+    def evaluate(self,
+                 batch_size: int = None,
+                 max_batches: int = None,
+                 top: Union[List[int], int] = 1,
+                 include_loss: bool = True,
+                 num_workers: int = 1,
+                 custom_dataset=False,
+                 variants_per_pass: int = 16,
+                 reference_logits: Optional[ReferenceLogits] = None,
+                 atol: float = 0.0,
+                 **kwargs) -> List[Tuple]:
+        """
+        Evaluate all added variants on the test dataset.
+
+        Args:
+            batch_size (int, optional): The batch size for evaluation. Defaults to None.
+            max_batches (int, optional): The maximum number of batches to evaluate. Defaults to None.
+            top (Union[List[int], int], optional): The top-k accuracy to compute. Defaults to 1.
+            include_loss (bool, optional): Whether to include loss in the evaluation. Defaults to True.
+            num_workers (int, optional): The number of workers for data loading. Defaults to 1.
+            custom_dataset (bool, optional): Whether to use a custom dataset. Defaults to False.
+            variants_per_pass (int, optional): Maximum number of variants computed by a single forward pass. Defaults to 16.
+            reference_logits (Optional[ReferenceLogits], optional): Baseline logits for fidelity metrics. Defaults to None.
+            atol (float, optional): Allowed absolute difference when verifying against the per-model path. Defaults to 0.0.
+            **kwargs: Additional keyword arguments.
+
+        Returns:
+            List[Tuple]: Result of ModelAdapter.evaluate for every variant in the order they were added.
+
+        Raises:
+            ValueError: If the batched logits do not match the per-model path.
+        """
+        top = set([1] + top) if isinstance(top, Iterable) else set([1, top])
+        adapter = self.adapter
+        dataset = adapter.get_test_data(**kwargs) if not custom_dataset else adapter.get_custom_dataset(**kwargs)
+        criterion = adapter.get_criterion(**kwargs)
+        loader = create_loader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        variants_per_pass = max(1, variants_per_pass or len(self.variants))
+        results = []
+        original_train_mode = adapter.model.training
+        try:
+            adapter.model.eval()
+            for start in range(0, len(self.variants), variants_per_pass):
+                variants = self.variants[start:start+variants_per_pass]
+                running_loss = [0.0] * len(variants)
+                running_topk_correct = [dict([(k, 0) for k in top]) for _ in variants]
+                fidelity = [reference_logits.create_meter() for _ in variants] if reference_logits is not None else None
+                total_samples = 0
+                with torch.inference_mode():
+                    with tqdm(enumerate(loader), unit="batch", total=len(loader), leave=True, desc=f"Variants {start}-{start+len(variants)}") as pbar:
+                        for batch_index, (x, y) in pbar:
+                            if not self.verified:
+                                if not self.verify(x, variants, atol=atol):
+                                    raise ValueError("batched logits do not match the per-model path")
+                                self.verified = True
+                            y_hat = self.forward(x, variants)
+                            reference = reference_logits.get(total_samples, total_samples + y.size(0)) if reference_logits is not None else None
+                            for i in range(len(variants)):
+                                if include_loss and criterion is not None:
+                                    running_loss[i] += criterion(y_hat[i], y).item() * y.size(0)
+                                for k in top:
+                                    _, predicted = y_hat[i].topk(k, dim=1)
+                                    running_topk_correct[i][k] += predicted.eq(y.view(-1, 1).expand_as(predicted)).sum().item()
+                                if fidelity is not None:
+                                    fidelity[i].update(reference, y_hat[i])
+                            total_samples += y.size(0)
+
+                            if max_batches is not None and batch_index >= max_batches:
+                                break
+
+                for i in range(len(variants)):
+                    top_k = {k: v / total_samples for k, v in running_topk_correct[i].items()}
+                    result = (top_k[1], running_loss[i] / total_samples) if len(top_k) == 1 else (top_k, running_loss[i] / total_samples)
+                    results.append(result + (fidelity[i].compute(),) if fidelity is not None else result)
+            return results
+        finally:
+            adapter.model.train(mode=original_train_mode)
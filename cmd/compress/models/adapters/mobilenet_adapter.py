@@ -12,8 +12,10 @@
 # limitations under the License.
 # mobilenet_adapter.py: Provide adapter for MobileNetV2 model.
 
-from typing import Callable, Optional, Self, Union
+from typing import Callable, Dict, Optional, Self, Tuple, Union
 from functools import reduce
+from pathlib import Path
+import copy
 import operator
 import os
 
@@ -29,6 +31,38 @@ import datasets
 from torch.utils.data import Dataset
 from parse import parse
 from typing import Optional, Union
+from tracing import traced
+
+_template_models: Dict[Tuple, nn.Module] = {}
+
+def _get_template_model(model_path: Optional[str] = None) -> nn.Module:
+    """
+    Get the process-wide template of quantized MobileNetV2. The template is built and
+    its checkpoint loaded only once per checkpoint file; adapters then copy it in memory.
+
+    Args:
+        model_path (Optional[str]): Path to the state dictionary. The pretrained weights are used if None.
+
+    Returns:
+        nn.Module: The template model. It must not be modified.
+    """
+    if model_path is None:
+        key = (None,)
+    else:
+        path = Path(model_path).absolute()
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+
+    if key not in _template_models:
+        if model_path is None:
+            model = quantization_models.mobilenet_v2(weights=quantization_models.MobileNet_V2_QuantizedWeights.IMAGENET1K_QNNPACK_V1, quantize=True)
+        else:
+            # Local checkpoint overrides all weights, so the pretrained ones are not needed
+            model = quantization_models.mobilenet_v2(weights=None, quantize=True, backend="qnnpack")
+            model.load_state_dict(torch.load(model_path))
+        model.eval()
+        _template_models[key] = model
+    return _template_models[key]
 
 class MobileNetDataset(Dataset):
     """
@@ -174,14 +208,17 @@ class MobileNetV2Adapter(ModelAdapter):
         "classifier.1": 1280000
     }
     
-    def __init__(self):
+    def __init__(self, model_path: Optional[str] = None):
         """
         Initialize the MobileNetV2Adapter with a quantized MobileNetV2 model.
+
+        Args:
+            model_path (Optional[str]): Path to the state dictionary. The pretrained weights are used if None.
         """
-        super().__init__(quantization_models.mobilenet_v2(weights=quantization_models.MobileNet_V2_QuantizedWeights.IMAGENET1K_QNNPACK_V1, quantize=True))
+        super().__init__(copy.deepcopy(_get_template_model(model_path)))
         self.layers = {}
         self._set_attributes()
-        self.model_path = None
+        self.model_path = model_path
 
     def _new_instance(self):
         """
@@ -190,24 +227,21 @@ class MobileNetV2Adapter(ModelAdapter):
         Returns:
             MobileNetV2Adapter: A new instance of the adapter.
         """        
-        new_instance = MobileNetV2Adapter()
+        new_instance = MobileNetV2Adapter(self.model_path)
         new_instance.device = self.device
-        new_instance.model = quantization_models.mobilenet_v2(weights=quantization_models.MobileNet_V2_QuantizedWeights.IMAGENET1K_QNNPACK_V1, quantize=True)
+        new_instance.model.to(self.device)
         return new_instance        
 
+    @traced("model.clone")
     def clone(self):
         """
-        Clone the current adapter instance.
+        Clone the current adapter instance. The clone holds weights of the checkpoint
+        and is copied from the in-memory template.
 
         Returns:
             MobileNetV2Adapter: A cloned instance of the adapter.
         """        
-        if self.model_path is not None:
-            return self.load(inline=False)
-        else:
-            raise NotImplementedError()
-            new_adapter = self._new_instance()
-            new_adapter.model.state_dict(self.model.state_dict())
+        return self._new_instance()
 
     def set_weights(self, layer: str, weights: torch.Tensor):
         """
@@ -461,15 +495,13 @@ class MobileNetV2Adapter(ModelAdapter):
             raise ValueError("the model does not have path defined")
         
         if inline:
-            self.model = quantization_models.mobilenet_v2(weights=quantization_models.MobileNet_V2_QuantizedWeights.IMAGENET1K_QNNPACK_V1, quantize=True)
-            self.model.load_state_dict(torch.load(self.model_path))
-            self.model_path = path
+            self.model = copy.deepcopy(_get_template_model(self.model_path))
+            self.model.to(self.device)
+            self.layers = {}
+            self._set_attributes()
             return self
         else:
-            new_adapter = self._new_instance()
-            new_adapter.model.load_state_dict(torch.load(self.model_path))
-            new_adapter.model_path = self.model_path
-            return new_adapter
+            return self._new_instance()
 
     def _load_dataset(self, split: str = "validation", num_proc=1, **kwargs):
         """
@@ -545,4 +577,4 @@ class MobileNetV2Adapter(ModelAdapter):
         raise NotImplementedError()
 
 def init(model_path: Optional[str]) -> MobileNetV2Adapter:
-    return MobileNetV2Adapter()
+    return MobileNetV2Adapter(model_path)
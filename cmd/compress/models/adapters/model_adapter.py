@@ -19,13 +19,16 @@ import copy
 from abc import ABC, abstractmethod
 from torch.utils.data import DataLoader
 import random
-from typing import List, Union, Self, Iterable, Optional, Callable
+from typing import Dict, List, Union, Self, Iterable, Optional, Callable
 from functools import reduce
 from models.adapters.model_adapter_interface import ModelAdapterInterface
 from models.base_model import BaseModel
 from models.quantization import quantize_per_tensor, tensor_iterator
 from models.selector import FilterSelectorCombinations
+from models.reference_logits import ReferenceLogits
+from models.tensor_dataset import create_loader
 from tqdm import tqdm
+from tracing import count, span, traced
 
 class ModelAdapter(ModelAdapterInterface, ABC):
     """
@@ -146,6 +149,7 @@ class ModelAdapter(ModelAdapterInterface, ABC):
         """        
         self.model.train(mode=True)
 
+    @traced("model.evaluate")
     def evaluate(self,
                  batch_size: int = None,
                  max_batches: int = None,
@@ -154,6 +158,7 @@ class ModelAdapter(ModelAdapterInterface, ABC):
                  show_top_k: int = 2,
                  num_workers: int = 1,
                  custom_dataset=False,
+                 reference_logits: Optional[ReferenceLogits] = None,
                  **kwargs
                  ):
         """
@@ -167,37 +172,46 @@ class ModelAdapter(ModelAdapterInterface, ABC):
             show_top_k (int, optional): The number of top-k accuracies to display. Defaults to 2.
             num_workers (int, optional): The number of workers for data loading. Defaults to 1.
             custom_dataset (bool, optional): Whether to use a custom dataset. Defaults to False.
+            reference_logits (Optional[ReferenceLogits], optional): Baseline logits of the same dataset split. When set,
+                fidelity metrics against the baseline are computed as well. Defaults to None.
             **kwargs: Additional keyword arguments.
 
         Returns:
             Union[float, Tuple[Dict[int, float], float]]: The top-1 accuracy and loss if `top` is an int,
-                otherwise a dictionary of top-k accuracies and loss.
+                otherwise a dictionary of top-k accuracies and loss. If `reference_logits` is set, a dictionary
+                with agreement rate, KL divergence and per-class flips is returned as the third item.
         """        
         top = set([1] + top) if isinstance(top, Iterable) else set([1, top])
         original_train_mode = self.model.training
         dataset = self.get_test_data(**kwargs) if not custom_dataset else self.get_custom_dataset(**kwargs)
         criterion = self.get_criterion(**kwargs)
         print(f"dataset has {len(dataset)} samples")
+        fidelity = reference_logits.create_meter() if reference_logits is not None else None
         try:
             self.model.eval()
-            loader = DataLoader(dataset, batch_size=batch_size or len(dataset), shuffle=False, num_workers=num_workers or 0)
+            loader = create_loader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
             running_loss = 0
             total_samples = 0
             running_topk_correct = dict([(k, 0) for k in top])
             with torch.inference_mode():
                 with tqdm(enumerate(loader), unit="batch", total=len(loader), leave=True) as pbar:
                     for batch_index, (x, y) in pbar:
-                        y_hat = self.model(x)
+                        with span("model.evaluate.batch", batch=batch_index, size=y.size(0)):
+                            y_hat = self.model(x)
 
-                        if include_loss and criterion is not None:
-                            loss = criterion(y_hat, y)
-                            running_loss += loss.item() * y.size(0)
+                            if fidelity is not None:
+                                fidelity.update(reference_logits.get(total_samples, total_samples + y.size(0)), y_hat)
+
+                            if include_loss and criterion is not None:
+                                loss = criterion(y_hat, y)
+                                running_loss += loss.item() * y.size(0)
                         
-                        for k in top:
-                            _, predicted = y_hat.topk(k, dim=1)
-                            correct = predicted.eq(y.view(-1, 1).expand_as(predicted))
-                            running_topk_correct[k] += correct[:, :k].sum().item()
-                        total_samples += y.size(0)
+                            for k in top:
+                                _, predicted = y_hat.topk(k, dim=1)
+                                correct = predicted.eq(y.view(-1, 1).expand_as(predicted))
+                                running_topk_correct[k] += correct[:, :k].sum().item()
+                            total_samples += y.size(0)
+                        count("model.evaluate.samples", y.size(0))
 
                         top_k = {k: v / total_samples for k, v in running_topk_correct.items()}
                         top_k_strings = [f"Top-{k}: {v:.6f}" for k, v in list(top_k.items())[1:show_top_k]]
@@ -219,10 +233,12 @@ class ModelAdapter(ModelAdapterInterface, ABC):
                 print(f"Loss: {average_loss:.4f}, Acc: {top_k[1]:.6f}" + top_k_strings)
             else:
                 print(f"Acc: {top_k[1]:.6f}" + top_k_strings)
-            if len(top_k) == 1:
-                return top_k[1], average_loss
-            else:
-                return top_k, average_loss
+            result = (top_k[1], average_loss) if len(top_k) == 1 else (top_k, average_loss)
+            if fidelity is not None:
+                fidelity_metrics = fidelity.compute()
+                print(f"Agreement: {fidelity_metrics['agreement']:.6f}, KL: {fidelity_metrics['kl_divergence']:.6f}")
+                return result + (fidelity_metrics,)
+            return result
         finally:
             self.model.train(mode=original_train_mode)
         
@@ -331,6 +347,37 @@ class ModelAdapter(ModelAdapterInterface, ABC):
             self.model.load_state_dict(state_dict)            
             
 
+    def get_injected_weights(self, weights_vector: List[torch.Tensor], injection_combinations: FilterSelectorCombinations, debug=False) -> Dict[Union[nn.Module, str, Callable[[Self], nn.Conv2d]], torch.Tensor]:
+        """
+        Compute weights of the layers after injecting the specified weights according to created plan.
+        The model itself is left untouched.
+
+        Args:
+            weights_vector (List[torch.Tensor]): A list of weight tensors to be injected.
+            injection_combinations (FilterSelectorCombinations): The filter selector combinations for weight injection forming injection plan.
+            debug (bool, optional): Whether to inject random weights for debugging. Defaults to False.
+
+        Returns:
+            Dict[Union[nn.Module, str, Callable[[Self], nn.Conv2d]], torch.Tensor]: New weights of every layer touched by the plan.
+        """
+        layers = {}
+        with torch.inference_mode():
+            for weights, injection_plans in zip(weights_vector, injection_combinations.get_combinations()):
+                offset = 0
+                for sel in injection_plans.get_selectors():
+                    fp32_weights = layers[sel.selector] if sel.selector in layers else self.get_weights(sel.selector).clone()
+                    for w, size, out_selector in tensor_iterator(fp32_weights, sel.out):
+                        # print("Layer:", plan.layer_name, "Sel:", out_selector, "Size:", size)
+                        if not debug:
+                            fp32_weights[*out_selector] = quantize_per_tensor(weights[offset:offset+size], w.q_scale(), w.q_zero_point())
+                        else:
+                            fp32_weights[*out_selector] = quantize_per_tensor(torch.tensor([random.randint(-128, 127) for _ in range(size)], dtype=torch.int8), w.q_scale(), w.q_zero_point())                                      
+                        offset += size
+                    layers[sel.selector] = fp32_weights
+                # assert offset == reduce(operator.mul, weights.shape)
+        return layers
+
+    @traced("model.inject_weights")
     def inject_weights(self, weights_vector: List[torch.Tensor], injection_combinations: FilterSelectorCombinations, inline=False, debug=False):
         """
         Inject the specified weights into the model according to created plan.
@@ -349,20 +396,8 @@ class ModelAdapter(ModelAdapterInterface, ABC):
         try:
             model.eval()
             with torch.inference_mode():
-                for weights, injection_plans in zip(weights_vector, injection_combinations.get_combinations()):
-                    offset = 0
-                    for sel in injection_plans.get_selectors():
-                        fp32_weights = model.get_weights(sel.selector)
-                        for w, size, out_selector in tensor_iterator(fp32_weights, sel.out):
-                            # print("Layer:", plan.layer_name, "Sel:", out_selector, "Size:", size)
-                            if not debug:
-                                fp32_weights[*out_selector] = quantize_per_tensor(weights[offset:offset+size], w.q_scale(), w.q_zero_point())
-                            else:
-                                fp32_weights[*out_selector] = quantize_per_tensor(torch.tensor([random.randint(-128, 127) for _ in range(size)], dtype=torch.int8), w.q_scale(), w.q_zero_point())                                      
-                            offset += size
-                        model.set_weights(sel.selector, fp32_weights)
-                    print("offset:", offset, "size:", reduce(operator.mul, weights.shape))
-                    # assert offset == reduce(operator.mul, weights.shape)
+                for selector, fp32_weights in model.get_injected_weights(weights_vector, injection_combinations, debug=debug).items():
+                    model.set_weights(selector, fp32_weights)
                 return model
         finally:
             model.train(mode=original_train_mode)
@@ -35,7 +35,4 @@ def create_adapter(name: str, model_path: Optional[str]) -> ModelAdapter:
     if name != MobileNetV2Adapter.name:
         return BaseAdapter.load_base_model(name, model_path)
     else:
-        adapter = MobileNetV2Adapter()
-        if model_path:
-            adapter.load(model_path)        
-        return adapter
+        return MobileNetV2Adapter(model_path or None)
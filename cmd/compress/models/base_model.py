@@ -22,6 +22,7 @@ from pathlib import Path
 import copy
 from abc import ABC, abstractmethod
 from tqdm import tqdm
+from models.tensor_dataset import create_loader
 
 class BaseModel(ABC, nn.Module):
     """
@@ -270,8 +271,8 @@ class BaseModel(ABC, nn.Module):
         training_set_size = dataset_size - validation_set_size
         train_set, validation_set = random_split(dataset, [training_set_size, validation_set_size])
 
-        train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=shuffle)
-        validation_loader = DataLoader(validation_set, batch_size=batch_size, shuffle=False)
+        train_loader = create_loader(train_set, batch_size=batch_size, shuffle=shuffle)
+        validation_loader = create_loader(validation_set, batch_size=batch_size, shuffle=False)
 
         # Number of epochs with no improvement before stopping
         patience_counter = 0
@@ -337,6 +338,6 @@ class BaseModel(ABC, nn.Module):
         training_set_size = dataset_size - validation_set_size
         train_set, validation_set = random_split(dataset, [training_set_size, validation_set_size])
 
-        train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=shuffle)
-        validation_loader = DataLoader(validation_set, batch_size=batch_size, shuffle=False)
+        train_loader = create_loader(train_set, batch_size=batch_size, shuffle=shuffle)
+        validation_loader = create_loader(validation_set, batch_size=batch_size, shuffle=False)
         return train_loader, validation_loader    
\ No newline at end of file
@@ -15,6 +15,7 @@
 from typing import Optional, Self
 from models.base_model import BaseModel
 from commands.datastore import Datastore
+from models.tensor_dataset import InMemoryDataset
 import torch.nn as nn
 import torch
 from torch.utils.data import Dataset, random_split, DataLoader
@@ -27,7 +28,9 @@ class LeNet5(BaseModel):
     PyTorch implementation of LeNet-5 architecture proposed by LeCun in 1995.
     """
     name = "lenet"
-    transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5,), (0.5,))])
+    normalization_mean = 0.5
+    normalization_std = 0.5
+    transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize((normalization_mean,), (normalization_std,))])
     def __init__(self, model_path: str = None):
         super(LeNet5, self).__init__(model_path)
         self.conv1 = nn.Conv2d(1, 6, kernel_size=5)
@@ -43,25 +46,40 @@ class LeNet5(BaseModel):
     def _create_self(self, *args) -> Self:
         return LeNet5(self.model_path)
 
-    def get_train_data(self, dataset="mnist", split="digits", **kwargs):
+    def _get_torchvision_data(self, dataset: str, split: str, train: bool, transform=None):
         if dataset == "mnist" or dataset is None:
-            return torchvision.datasets.MNIST(root=Datastore().derive("./datasets"), train=True, download=True, transform=LeNet5.transforms)
+            return torchvision.datasets.MNIST(root=Datastore().derive("./datasets"), train=train, download=True, transform=transform)
         elif dataset == "emnist":
-            return torchvision.datasets.EMNIST(root=Datastore().derive("./datasets"), split=split, train=True, transform=LeNet5.transforms, download=False)
+            return torchvision.datasets.EMNIST(root=Datastore().derive("./datasets"), split=split, train=train, transform=transform, download=False)
         elif dataset == "qmnist":
-            return torchvision.datasets.QMNIST(root=Datastore().derive("./datasets"), what=split, train=True, transform=LeNet5.transforms, download=True)
+            return torchvision.datasets.QMNIST(root=Datastore().derive("./datasets"), what=split, train=train, transform=transform, download=True)
         else:
             raise ValueError(f"unknown dataset {dataset}")
 
-    def get_test_data(self, dataset="mnist", split="digits", **kwargs):
-        if dataset == "mnist" or dataset is None:
-            return torchvision.datasets.MNIST(root=Datastore().derive("./datasets"), train=False, download=True, transform=LeNet5.transforms)
-        elif dataset == "emnist":
-            return torchvision.datasets.EMNIST(root=Datastore().derive("./datasets"), split=split, train=False, transform=LeNet5.transforms, download=False)
-        elif dataset == "qmnist":
-            return torchvision.datasets.QMNIST(root=Datastore().derive("./datasets"), what=split, train=False, transform=LeNet5.transforms, download=True)        
-        else:
-            raise ValueError(f"unknown dataset {dataset}")
+    def _create_in_memory_data(self, dataset: str, split: str, train: bool) -> InMemoryDataset:
+        """
+        Convert the torchvision dataset to pre-normalised tensors at once. The result
+        is identical to applying LeNet5.transforms on every sample.
+        """
+        data = self._get_torchvision_data(dataset, split, train)
+        images = data.data.unsqueeze(1).to(torch.get_default_dtype()).div(255).sub(LeNet5.normalization_mean).div(LeNet5.normalization_std)
+        # QMNIST provides extended targets, only the class is used
+        targets = data.targets[:, 0] if data.targets.dim() == 2 else data.targets
+        return InMemoryDataset(images.contiguous(), targets.to(torch.int64))
+
+    def _get_data(self, dataset: str, split: str, train: bool, in_memory: bool):
+        if not in_memory:
+            return self._get_torchvision_data(dataset, split, train, transform=LeNet5.transforms)
+
+        dataset = dataset or "mnist"
+        name = f"{dataset}.{'train' if train else 'test'}.pt" if dataset == "mnist" else f"{dataset}.{split}.{'train' if train else 'test'}.pt"
+        return InMemoryDataset.load_or_create(Datastore().derive("datasets/tensors") / name, lambda: self._create_in_memory_data(dataset, split, train))
+
+    def get_train_data(self, dataset="mnist", split="digits", in_memory=True, **kwargs):
+        return self._get_data(dataset, split, True, in_memory)
+
+    def get_test_data(self, dataset="mnist", split="digits", in_memory=True, **kwargs):
+        return self._get_data(dataset, split, False, in_memory)
 
     def get_validation_data(self):
         raise ValueError("not supported")
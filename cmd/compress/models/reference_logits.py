@@ -0,0 +1,237 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# reference_logits.py: Store of baseline model logits and fidelity metrics of approximated models.
+
+from __future__ import annotations
+import hashlib
+import io
+import os
+from pathlib import Path
+from typing import Dict, Optional, Self, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from models.tensor_dataset import create_loader
+from tqdm import tqdm
+from commands.datastore import Datastore
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from models.adapters.model_adapter import ModelAdapter
+
+def get_model_digest(adapter: ModelAdapter) -> str:
+    """
+    Compute digest identifying the baseline model weights.
+
+    The digest is computed from the saved state dictionary file when the adapter
+    knows where it was loaded from, otherwise from the serialized in-memory state dictionary.
+
+    Args:
+        adapter (ModelAdapter): The adapter of the baseline model.
+
+    Returns:
+        str: Hexadecimal SHA-256 digest.
+    """
+    model_path = getattr(adapter, "model_path", None) or getattr(adapter.model, "model_path", None)
+    digest = hashlib.sha256()
+    if model_path is not None and Path(model_path).is_file():
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        buffer = io.BytesIO()
+        torch.save(adapter.model.state_dict(), buffer)
+        digest.update(buffer.getvalue())
+    return digest.hexdigest()
+
+class FidelityMeter(object):
+    """
+    Accumulates fidelity of an approximated model against the baseline logits.
+
+    Attributes:
+        agreement (int): Number of samples where both models predicted the same class.
+        kl_divergence (float): Sum of per-sample KL(reference || approximation).
+        flips (torch.Tensor): Number of changed predictions per reference class.
+        total_samples (int): Number of processed samples.
+    """
+    def __init__(self, num_classes: int) -> None:
+        """
+        Initialize an empty meter.
+
+        Args:
+            num_classes (int): Number of output classes.
+        """
+        self.agreement = 0
+        self.kl_divergence = 0.0
+        self.flips = torch.zeros(num_classes, dtype=torch.int64)
+        self.total_samples = 0
+
+    def update(self, reference: torch.Tensor, logits: torch.Tensor):
+        """
+        Add a batch of logits to the meter.
+
+        Args:
+            reference (torch.Tensor): Baseline logits of the batch.
+            logits (torch.Tensor): Logits of the approximated model for the same batch.
+        """
+        reference = reference.float()
+        logits = logits.detach().float().cpu()
+        reference_prediction = reference.argmax(dim=1)
+        prediction = logits.argmax(dim=1)
+        changed = reference_prediction != prediction
+        reference_log_p = F.log_softmax(reference, dim=1)
+        self.agreement += (~changed).sum().item()
+        self.kl_divergence += (reference_log_p.exp() * (reference_log_p - F.log_softmax(logits, dim=1))).sum().item()
+        self.flips += torch.bincount(reference_prediction[changed], minlength=self.flips.numel())
+        self.total_samples += reference.size(0)
+
+    def compute(self) -> Dict[str, Union[float, list]]:
+        """
+        Compute the fidelity metrics.
+
+        Returns:
+            Dict[str, Union[float, list]]: Agreement rate, mean KL divergence and per-class flips.
+        """
+        total_samples = max(self.total_samples, 1)
+        return {
+            "agreement": self.agreement / total_samples,
+            "kl_divergence": self.kl_divergence / total_samples,
+            "flips": self.flips.tolist()
+        }
+
+class ReferenceLogits(object):
+    """
+    Baseline model logits for a dataset split, stored as fp16 memory-mapped .npy file
+    keyed by the model digest.
+
+    Attributes:
+        path (Path): Path to the logits file.
+        logits (np.memmap): Memory-mapped logits of shape (samples, classes).
+    """
+    def __init__(self, path: Union[Path, str]) -> None:
+        """
+        Open an existing logits file.
+
+        Args:
+            path (Union[Path, str]): Path to the logits file.
+        """
+        self.path = Path(path)
+        self.logits = np.load(self.path, mmap_mode="r")
+
+    def __len__(self):
+        return self.logits.shape[0]
+
+    @property
+    def num_classes(self) -> int:
+        return self.logits.shape[1]
+
+    def get(self, start: int, end: int) -> torch.Tensor:
+        """
+        Get baseline logits of samples in the range [start, end).
+
+        Args:
+            start (int): Index of the first sample.
+            end (int): Index past the last sample.
+
+        Returns:
+            torch.Tensor: fp32 logits of the samples.
+        """
+        if end > len(self):
+            raise ValueError(f"reference logits {self.path} contain only {len(self)} samples, requested up to {end}")
+        return torch.from_numpy(np.asarray(self.logits[start:end], dtype=np.float32))
+
+    def create_meter(self) -> FidelityMeter:
+        """
+        Create an empty fidelity meter matching the stored logits.
+
+        Returns:
+            FidelityMeter: The meter.
+        """
+        return FidelityMeter(self.num_classes)
+
+    @staticmethod
+    def get_path(digest: str, dataset: Optional[str] = None, split: Optional[str] = None) -> Path:
+        """
+        Get path where logits of the model and dataset split are stored.
+
+        Args:
+            digest (str): Digest of the baseline model.
+            dataset (Optional[str]): The dataset name.
+            split (Optional[str]): The dataset split.
+
+        Returns:
+            Path: Path to the logits file.
+        """
+        return Datastore().derive("reference_logits") / digest[:16] / f"{dataset or 'default'}.{split or 'test'}.f16.npy"
+
+    @classmethod
+    def create(cls, adapter: ModelAdapter, batch_size: int = None, num_workers: int = None, custom_dataset=False, dataset: str = None, split: str = None, **kwargs) -> Self:
+        """
+        Run the baseline model over the dataset split and store its logits.
+
+        Args:
+            adapter (ModelAdapter): The baseline model adapter.
+            batch_size (int, optional): The batch size for evaluation. Defaults to None.
+            num_workers (int, optional): The number of workers for data loading. Defaults to None.
+            custom_dataset (bool, optional): Whether to use a custom dataset. Defaults to False.
+            dataset (str, optional): The dataset name. Defaults to None.
+            split (str, optional): The dataset split. Defaults to None.
+            **kwargs: Additional arguments passed to the dataset getters.
+
+        Returns:
+            ReferenceLogits: The stored reference logits.
+        """
+        path = cls.get_path(get_model_digest(adapter), dataset, split)
+        data = adapter.get_test_data(dataset=dataset, split=split, **kwargs) if not custom_dataset else adapter.get_custom_dataset(dataset=dataset, split=split, **kwargs)
+        loader = create_loader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        temporary_path = path.with_name(path.name + ".tmp")
+        original_train_mode = adapter.model.training
+        logits = None
+        offset = 0
+        try:
+            adapter.model.eval()
+            with torch.inference_mode():
+                for x, _ in tqdm(loader, unit="batch", total=len(loader), leave=True, desc="Reference logits"):
+                    y_hat = adapter.model(x).detach().cpu()
+                    if logits is None:
+                        logits = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=np.float16, shape=(len(data), y_hat.size(1)))
+                    logits[offset:offset+y_hat.size(0)] = y_hat.numpy().astype(np.float16)
+                    offset += y_hat.size(0)
+            logits.flush()
+            del logits
+            os.replace(temporary_path, path)
+        finally:
+            adapter.model.train(mode=original_train_mode)
+        print(f"saved reference logits to {path}")
+        return cls(path)
+
+    @classmethod
+    def load_or_create(cls, adapter: ModelAdapter, dataset: str = None, split: str = None, **kwargs) -> Self:
+        """
+        Load reference logits of the baseline model or create them if they do not exist yet.
+
+        Args:
+            adapter (ModelAdapter): The baseline model adapter.
+            dataset (str, optional): The dataset name. Defaults to None.
+            split (str, optional): The dataset split. Defaults to None.
+            **kwargs: Additional arguments passed to create.
+
+        Returns:
+            ReferenceLogits: The reference logits.
+        """
+        path = cls.get_path(get_model_digest(adapter), dataset, split)
+        if path.exists():
+            return cls(path)
+        return cls.create(adapter, dataset=dataset, split=split, **kwargs)
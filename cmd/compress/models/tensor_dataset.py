@@ -0,0 +1,160 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# tensor_dataset.py: In-memory datasets of pre-processed tensors and loaders slicing whole batches.
+
+import math
+import os
+from pathlib import Path
+from typing import Callable, Dict, Optional, Self, Union
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset, TensorDataset
+
+_loaded_datasets: Dict[str, "InMemoryDataset"] = {}
+
+class InMemoryDataset(TensorDataset):
+    """
+    Dataset of pre-processed samples and targets held in memory.
+
+    Attributes:
+        data (torch.Tensor): The samples.
+        targets (torch.Tensor): The targets.
+    """
+    def __init__(self, data: torch.Tensor, targets: torch.Tensor) -> None:
+        """
+        Initialize the dataset.
+
+        Args:
+            data (torch.Tensor): The samples.
+            targets (torch.Tensor): The targets.
+        """
+        super().__init__(data, targets)
+
+    @property
+    def data(self) -> torch.Tensor:
+        return self.tensors[0]
+
+    @property
+    def targets(self) -> torch.Tensor:
+        return self.tensors[1]
+
+    def save(self, path: Union[Path, str]):
+        """
+        Save the dataset to the file.
+
+        Args:
+            path (Union[Path, str]): The destination file.
+        """
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        temporary_path = path.with_name(path.name + ".tmp")
+        torch.save({"data": self.data, "targets": self.targets}, temporary_path)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> Self:
+        """
+        Load the dataset from the file.
+
+        Args:
+            path (Union[Path, str]): The source file.
+
+        Returns:
+            InMemoryDataset: The loaded dataset.
+        """
+        state = torch.load(path)
+        return cls(state["data"], state["targets"])
+
+    @classmethod
+    def load_or_create(cls, path: Union[Path, str], factory: Callable[[], Self]) -> Self:
+        """
+        Load the cached dataset, or create and cache it when it does not exist yet.
+        Loaded datasets are kept in memory for the rest of the process.
+
+        Args:
+            path (Union[Path, str]): The cache file.
+            factory (Callable[[], InMemoryDataset]): Function creating the dataset.
+
+        Returns:
+            InMemoryDataset: The dataset.
+        """
+        key = str(Path(path).absolute())
+        if key in _loaded_datasets:
+            return _loaded_datasets[key]
+
+        if Path(path).exists():
+            dataset = cls.load(path)
+        else:
+            dataset = factory()
+            dataset.save(path)
+            print(f"saved in-memory dataset to {path}")
+        _loaded_datasets[key] = dataset
+        return dataset
+
+class TensorLoader(object):
+    """
+    Data loader over in-memory tensors which slices whole batches instead of collating single samples.
+
+    Attributes:
+        data (torch.Tensor): The samples.
+        targets (torch.Tensor): The targets.
+        batch_size (int): The batch size.
+        shuffle (bool): Whether to shuffle samples on every iteration.
+        indices (Optional[torch.Tensor]): Indices of the samples to iterate over, all samples if None.
+    """
+    def __init__(self, data: torch.Tensor, targets: torch.Tensor, batch_size: int, shuffle: bool = False, indices: Optional[torch.Tensor] = None) -> None:
+        self.data = data
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.indices = indices
+
+    def _get_sample_count(self) -> int:
+        return self.data.size(0) if self.indices is None else self.indices.numel()
+
+    def __len__(self):
+        return math.ceil(self._get_sample_count() / self.batch_size)
+
+    def __iter__(self):
+        sample_count = self._get_sample_count()
+        order = self.indices
+        if self.shuffle:
+            permutation = torch.randperm(sample_count)
+            order = permutation if order is None else order[permutation]
+
+        for start in range(0, sample_count, self.batch_size):
+            if order is None:
+                yield self.data[start:start+self.batch_size], self.targets[start:start+self.batch_size]
+            else:
+                batch = order[start:start+self.batch_size]
+                yield self.data[batch], self.targets[batch]
+
+def create_loader(dataset: Dataset, batch_size: int = None, shuffle: bool = False, num_workers: int = None) -> Union[DataLoader, TensorLoader]:
+    """
+    Create data loader for the dataset. In-memory datasets and their subsets are
+    iterated by slicing, other datasets use the standard DataLoader.
+
+    Args:
+        dataset (Dataset): The dataset.
+        batch_size (int, optional): The batch size. Defaults to the whole dataset.
+        shuffle (bool, optional): Whether to shuffle the samples. Defaults to False.
+        num_workers (int, optional): The number of workers for DataLoader. Defaults to None.
+
+    Returns:
+        Union[DataLoader, TensorLoader]: The data loader.
+    """
+    batch_size = batch_size or len(dataset)
+    if isinstance(dataset, InMemoryDataset):
+        return TensorLoader(dataset.data, dataset.targets, batch_size, shuffle=shuffle)
+    if isinstance(dataset, Subset) and isinstance(dataset.dataset, InMemoryDataset):
+        return TensorLoader(dataset.dataset.data, dataset.dataset.targets, batch_size, shuffle=shuffle, indices=torch.as_tensor(dataset.indices))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers or 0)
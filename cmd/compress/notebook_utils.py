@@ -4,6 +4,7 @@ import scipy.stats as stats
 from models.adapters.mobilenet_adapter import MobileNetV2Adapter
 import scikit_posthocs as sp
 import pandas as pd
+from cgp.pareto import get_non_dominated
 
 metrics = {
     "lenet": {
@@ -63,6 +64,15 @@ def is_pareto_efficient_simple(costs):
             is_efficient[i] = True  # And keep self
     return is_efficient
 
+def is_pareto_efficient(costs):
+    """
+    Find the pareto-efficient points in O(n log n) for 2 and 3 costs, see cgp.pareto.get_non_dominated.
+    Unlike is_pareto_efficient_simple, duplicate efficient points are all kept.
+    :param costs: An (n_points, n_costs) array
+    :return: A (n_points, ) boolean array, indicating whether each point is Pareto efficient
+    """
+    return get_non_dominated(costs)
+
 def examine_mean_hypothesis(df, group1, group2, variable, alternative="less", df_column="Grid"):
     sign = "<" if alternative == "less" else "!=" if alternative == "two-sided" else ">"
     group1_df = df.loc[df[df_column] == group1, variable]
@@ -0,0 +1,476 @@
+# Copyright 2024 Marin Lorinc
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     LICENSE.txt file
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# tracing.py: Lightweight spans and counters exported as Chrome trace JSON and a per-stage summary,
+# optionally with peak memory of each stage.
+
+import atexit
+import functools
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_lock = threading.Lock()
+_enabled = False
+_output: Optional[Path] = None
+_origin = time.perf_counter()
+_events: List[dict] = []
+_stages: Dict[str, List[float]] = {}
+_counters: Dict[str, float] = {}
+_memory_enabled = False
+_memory_output: Optional[Path] = None
+_memory_tensors = False
+_active_spans: List["Span"] = []
+_watched_processes: Dict[int, int] = {}
+_memory_stages: Dict[str, int] = {}
+_tensor_allocations: Dict[str, Dict[str, dict]] = {}
+_experiment_peaks: Dict[str, int] = {}
+_context: Dict[str, str] = {}
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_top_tensor_allocations = 5
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+class Span(object):
+    """
+    Timed region of the program recorded as a complete Chrome trace event.
+
+    Attributes:
+        name (str): Name of the stage.
+        args (dict): Arguments shown with the event.
+        peak (int): Peak resident memory in bytes of the process and watched child processes
+            while the span was open, recorded only when memory profiling is enabled.
+    """
+    def __init__(self, name: str, args: dict) -> None:
+        self.name = name
+        self.args = args
+        self.peak = 0
+        self._start = None
+        self._memory = False
+        self._profiler = None
+
+    def __enter__(self):
+        if _memory_enabled:
+            self._memory = True
+            self.peak = _sample_memory()
+            with _lock:
+                _active_spans.append(self)
+                outermost = len(_active_spans) == 1
+            # torch profilers cannot be nested, so tensor allocations are attributed to the outermost stage
+            if _memory_tensors and outermost:
+                self._profiler = _start_tensor_profiler()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        duration = end - self._start
+        event = {"name": self.name, "ph": "X", "ts": (self._start - _origin) * 1e6, "dur": duration * 1e6, "pid": os.getpid(), "tid": threading.get_ident()}
+        if self.args:
+            event["args"] = dict([(key, str(value)) for key, value in self.args.items()])
+        if self._memory:
+            self._finish_memory()
+            event.setdefault("args", {})["peak_rss_mb"] = f"{self.peak / 2**20:.1f}"
+        with _lock:
+            _events.append(event)
+            stage = _stages.setdefault(self.name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += duration
+            stage[2] = max(stage[2], duration)
+        return False
+
+    def _finish_memory(self):
+        if self._profiler is not None:
+            _stop_tensor_profiler(self._profiler, self.name)
+            self._profiler = None
+        _update_memory(_sample_memory())
+        with _lock:
+            _active_spans.remove(self)
+            _memory_stages[self.name] = max(_memory_stages.get(self.name, 0), self.peak)
+        self._memory = False
+
+def get_rss(pid: Optional[int] = None, peak: bool = False) -> Optional[int]:
+    """
+    Reads resident memory of the process from /proc, or by psutil on other platforms if it is installed.
+
+    Args:
+        pid (Optional[int], optional): The process id. Defaults to the current process.
+        peak (bool, optional): Whether to read the high water mark of the process instead of its current size.
+            Only available on Linux, psutil reports the current size. Defaults to False.
+
+    Returns:
+        Optional[int]: Size in bytes or None if it cannot be read.
+    """
+    proc = Path("/proc") / (str(pid) if pid is not None else "self")
+    try:
+        if peak:
+            with open(proc / "status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        else:
+            with open(proc / "statm") as f:
+                return int(f.read().split()[1]) * _page_size
+    except (OSError, ValueError, IndexError):
+        pass
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            pass
+    return None
+
+def _sample_memory() -> int:
+    value = get_rss() or 0
+    for pid in list(_watched_processes):
+        peak = get_rss(pid, peak=True)
+        with _lock:
+            if pid not in _watched_processes:
+                continue
+            if peak is not None:
+                _watched_processes[pid] = max(_watched_processes[pid], peak)
+            value += _watched_processes[pid]
+    return value
+
+def _update_memory(value: int):
+    with _lock:
+        for active_span in _active_spans:
+            active_span.peak = max(active_span.peak, value)
+        experiment = _context.get("experiment")
+        if experiment is not None:
+            _experiment_peaks[experiment] = max(_experiment_peaks.get(experiment, 0), value)
+
+def _sample_loop(interval: float):
+    while _memory_enabled:
+        _update_memory(_sample_memory())
+        time.sleep(interval)
+
+def _start_tensor_profiler():
+    global _memory_tensors
+    try:
+        import torch
+        import torch.profiler
+    except ImportError:
+        print("warn: torch is not installed, tensor allocations are not recorded")
+        _memory_tensors = False
+        return None
+    activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+    profiler = torch.profiler.profile(activities=activities, profile_memory=True)
+    profiler.__enter__()
+    return profiler
+
+def _stop_tensor_profiler(profiler, name: str):
+    profiler.__exit__(None, None, None)
+    with _lock:
+        allocations = _tensor_allocations.setdefault(name, {})
+    for event in profiler.key_averages():
+        cpu_bytes = int(getattr(event, "self_cpu_memory_usage", 0))
+        device_bytes = int(getattr(event, "self_device_memory_usage", getattr(event, "self_cuda_memory_usage", 0)))
+        if max(cpu_bytes, device_bytes) <= 0:
+            continue
+        with _lock:
+            previous = allocations.get(event.key)
+            if previous is None or previous["cpu_bytes"] + previous["device_bytes"] < cpu_bytes + device_bytes:
+                allocations[event.key] = {"op": event.key, "cpu_bytes": cpu_bytes, "device_bytes": device_bytes, "calls": event.count}
+    with _lock:
+        top = sorted(allocations.values(), key=lambda allocation: -(allocation["cpu_bytes"] + allocation["device_bytes"]))[:_top_tensor_allocations]
+        _tensor_allocations[name] = dict([(allocation["op"], allocation) for allocation in top])
+
+def is_enabled() -> bool:
+    """
+    Checks whether tracing is enabled.
+
+    Returns:
+        bool: True if spans and counters are recorded.
+    """
+    return _enabled
+
+def enable(output: Optional[Union[Path, str]] = None):
+    """
+    Enables tracing. The trace and the summary are saved when the interpreter exits.
+
+    Args:
+        output (Optional[Union[Path, str]], optional): Path to the Chrome trace JSON. Defaults to None, which only prints the summary.
+    """
+    global _enabled, _output
+    if not _enabled:
+        atexit.register(_finish)
+    _enabled = True
+    _output = Path(output) if output is not None else _output
+
+def enable_memory(output: Optional[Union[Path, str]] = None, tensors: bool = False, interval: float = 0.01):
+    """
+    Enables tracing with memory profiling. A background thread samples resident memory of the process
+    and of child processes registered by watch_process, recording the peak of every open span and of
+    the experiment set by set_context. The memory profile is saved when the interpreter exits.
+
+    Args:
+        output (Optional[Union[Path, str]], optional): Path to the memory profile JSON. Defaults to None, which only prints the summary.
+        tensors (bool, optional): Whether to record the largest tensor allocations of each outermost stage
+            by the torch profiler, which slows down the program considerably. Defaults to False.
+        interval (float, optional): Sampling interval in seconds. Defaults to 0.01.
+    """
+    global _memory_enabled, _memory_output, _memory_tensors
+    enable()
+    _memory_output = Path(output) if output is not None else _memory_output
+    _memory_tensors = tensors or _memory_tensors
+    if not _memory_enabled:
+        _memory_enabled = True
+        threading.Thread(target=_sample_loop, args=(interval,), name="memory-sampler", daemon=True).start()
+
+def disable():
+    """
+    Disables tracing and memory profiling, recorded events are kept.
+    """
+    global _enabled, _memory_enabled
+    _enabled = False
+    _memory_enabled = False
+
+def reset():
+    """
+    Drops recorded events, stages, counters and memory peaks.
+    """
+    with _lock:
+        _events.clear()
+        _stages.clear()
+        _counters.clear()
+        _memory_stages.clear()
+        _tensor_allocations.clear()
+        _experiment_peaks.clear()
+
+def set_context(**values):
+    """
+    Sets the context memory peaks are attributed to. The experiment key names the experiment whose
+    peak memory is recorded in the memory profile; None removes the key.
+
+    Args:
+        **values: Context values.
+    """
+    with _lock:
+        for key, value in values.items():
+            if value is None:
+                _context.pop(key, None)
+            else:
+                _context[key] = str(value)
+
+def watch_process(pid: int):
+    """
+    Adds the peak memory of the child process to the sampled memory until unwatch_process is called.
+
+    Args:
+        pid (int): The process id.
+    """
+    if not _memory_enabled:
+        return
+    with _lock:
+        _watched_processes[pid] = 0
+
+def unwatch_process(pid: int):
+    """
+    Stops sampling the child process. Its peak is sampled once more so short-lived processes are accounted.
+
+    Args:
+        pid (int): The process id.
+    """
+    if pid not in _watched_processes:
+        return
+    _update_memory(_sample_memory())
+    with _lock:
+        _watched_processes.pop(pid, None)
+
+def span(name: str, **args):
+    """
+    Creates a span measuring the enclosed block. When tracing is disabled a shared no-op span is returned.
+
+    Args:
+        name (str): Name of the stage.
+        **args: Arguments shown with the event.
+
+    Returns:
+        A context manager.
+    """
+    return Span(name, args) if _enabled else _null_span
+
+def traced(name: Optional[str] = None) -> Callable:
+    """
+    Decorates a function so each call is measured by a span.
+
+    Args:
+        name (Optional[str], optional): Name of the stage. Defaults to the qualified function name.
+
+    Returns:
+        Callable: The decorator.
+    """
+    def decorator(function: Callable) -> Callable:
+        stage = name or function.__qualname__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(stage, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name: str, value: float = 1):
+    """
+    Increments the counter and records its new value.
+
+    Args:
+        name (str): Name of the counter.
+        value (float, optional): Increment. Defaults to 1.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        total = _counters.get(name, 0) + value
+        _counters[name] = total
+        _events.append({"name": name, "ph": "C", "ts": (time.perf_counter() - _origin) * 1e6, "pid": os.getpid(), "args": {name: total}})
+
+def get_summary() -> List[dict]:
+    """
+    Aggregates spans by stage.
+
+    Returns:
+        List[dict]: Stage name, call count, total, mean and maximum time in seconds and peak memory in bytes
+            if it was profiled, ordered by total time.
+    """
+    with _lock:
+        rows = [{"stage": name, "count": int(calls), "total": total, "mean": total / calls, "max": maximum, "peak_rss": _memory_stages.get(name)} for name, (calls, total, maximum) in _stages.items()]
+    return sorted(rows, key=lambda row: -row["total"])
+
+def format_summary() -> str:
+    """
+    Formats the per-stage summary and counters as a table.
+
+    Returns:
+        str: The table.
+    """
+    memory = bool(_memory_stages)
+    lines = [f"{'stage':<40} {'count':>8} {'total [s]':>12} {'mean [ms]':>12} {'max [ms]':>12}" + (f" {'peak [MB]':>12}" if memory else "")]
+    for row in get_summary():
+        peak = f" {row['peak_rss'] / 2**20:>12.1f}" if memory and row["peak_rss"] is not None else ""
+        lines.append(f"{row['stage']:<40} {row['count']:>8} {row['total']:>12.3f} {row['mean'] * 1e3:>12.3f} {row['max'] * 1e3:>12.3f}" + peak)
+    for name, value in sorted(_counters.items()):
+        lines.append(f"{name:<40} {value:>8g}")
+    return "\n".join(lines)
+
+def save_trace(file: Union[Path, str]):
+    """
+    Saves recorded events in the Chrome trace event format, viewable in chrome://tracing or Perfetto.
+
+    Args:
+        file (Union[Path, str]): Path to the JSON file.
+    """
+    with _lock:
+        events = list(_events)
+    Path(file).parent.mkdir(exist_ok=True, parents=True)
+    with open(file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def get_memory_profile() -> dict:
+    """
+    Gets peak memory of the profiled stages and experiments.
+
+    Returns:
+        dict: Peak resident memory in bytes and the largest tensor allocations keyed by stage under "stages"
+            and peak resident memory in bytes keyed by experiment name under "experiments".
+    """
+    with _lock:
+        stages = dict([(name, {"peak_rss": peak, "tensors": list(_tensor_allocations.get(name, {}).values())}) for name, peak in _memory_stages.items()])
+        return {"stages": stages, "experiments": dict(_experiment_peaks)}
+
+def save_memory_profile(file: Union[Path, str]):
+    """
+    Saves the memory profile, which is used to estimate memory of PBS jobs.
+
+    Args:
+        file (Union[Path, str]): Path to the JSON file.
+    """
+    profile = get_memory_profile()
+    Path(file).parent.mkdir(exist_ok=True, parents=True)
+    with open(file, "w") as f:
+        json.dump(profile, f, indent=4)
+
+def load_memory_profile(file: Union[Path, str]) -> dict:
+    """
+    Loads the memory profile saved by save_memory_profile.
+
+    Args:
+        file (Union[Path, str]): Path to the JSON file.
+
+    Returns:
+        dict: The memory profile.
+    """
+    with open(file, "r") as f:
+        return json.load(f)
+
+def estimate_memory(profile: dict, names: Optional[Iterable[str]] = None, margin: float = 1.25, default: Optional[str] = None) -> Optional[str]:
+    """
+    Estimates memory of a PBS job from peaks of the experiments it processes. Experiments which were not
+    profiled are estimated by the largest measured peak.
+
+    Args:
+        profile (dict): The memory profile.
+        names (Optional[Iterable[str]], optional): Names of the experiments, archives are matched by their stem. Defaults to all profiled experiments.
+        margin (float, optional): Multiplier of the measured peak. Defaults to 1.25.
+        default (Optional[str], optional): Memory used when nothing was measured. Defaults to None.
+
+    Returns:
+        Optional[str]: Memory in the PBS format rounded up to gigabytes, e.g. "12gb", or the default.
+    """
+    measured = dict([(name[:-len(".zip")] if name.endswith(".zip") else name, peak) for name, peak in profile.get("experiments", {}).items()])
+    if not measured:
+        return default
+    if names is None:
+        peaks = list(measured.values())
+    else:
+        names = [name[:-len(".zip")] if name.endswith(".zip") else name for name in names]
+        peaks = [measured[name] for name in names if name in measured]
+        if len(peaks) != len(names):
+            print(f"warn: memory of {len(names) - len(peaks)} experiments was not profiled, using the largest measured peak")
+            peaks.append(max(measured.values()))
+    if not peaks:
+        return default
+    return f"{max(1, math.ceil(max(peaks) * margin / 2**30))}gb"
+
+def _finish():
+    if not _stages and not _counters and not _experiment_peaks:
+        return
+    print(format_summary())
+    if _output is not None:
+        save_trace(_output)
+        print(f"trace saved to {_output}")
+    if _memory_output is not None:
+        save_memory_profile(_memory_output)
+        print(f"memory profile saved to {_memory_output}")
+
+if os.environ.get("cgp_trace"):
+    enable(None if os.environ["cgp_trace"] == "1" else os.environ["cgp_trace"])
+if os.environ.get("cgp_memory_profile"):
+    enable_memory(None if os.environ["cgp_memory_profile"] == "1" else os.environ["cgp_memory_profile"], tensors=os.environ.get("cgp_memory_tensors") == "1")